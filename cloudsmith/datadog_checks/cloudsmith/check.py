@@ -1,13 +1,15 @@
 from json import JSONDecodeError
+from multiprocessing.pool import ThreadPool
 from urllib.error import HTTPError
 
 from requests.exceptions import InvalidURL, Timeout
 
-from datadog_checks.base import AgentCheck, ConfigurationError
+from datadog_checks.base import AgentCheck, ConfigurationError, is_affirmative
 from datadog_checks.base.errors import CheckException
 
 METRIC = "/metrics/entitlements/"
 QUOTA = "/quota/"
+REPOS = "/repos/"
 WARNING_QUOTA = 75
 CRITICAL_QUOTA = 85
 
@@ -30,6 +32,17 @@ class CloudsmithCheck(AgentCheck):
         self.tags.append('base_url:{}'.format(self.base_url))
         self.tags.append('cloudsmith_org:{}'.format(self.org))
 
+        self.repository_metrics = is_affirmative(self.instance.get('repository_metrics', False))
+        self.page_size = int(self.instance.get('page_size', 100))
+        self.max_concurrent_requests = int(self.instance.get('max_concurrent_requests', 4))
+        self.headers = {"X-Api-Key": self.api_key, "content-type": "application/json"}
+
+        # By url and query parameters, the ETag, Last-Modified, json and headers of the last 200 response
+        self._responses = {}
+        # By API path or url, the last json returned and the values parsed from it
+        self._parsed = {}
+        self._pool = None
+
     def validate_config(self):
         if not self.api_key:
             raise ConfigurationError('Configuration error, please specify api token in conf.yaml.')
@@ -44,13 +57,35 @@ class CloudsmithCheck(AgentCheck):
         url = self.base_url.rstrip('/') + path + self.org
         return url
 
+    def get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_concurrent_requests)
+        return self._pool
+
+    def cancel(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
     # Get stats from REST API as json
-    def get_api_json(self, url):
+    def get_api_json(self, url, params=None):
+        return self.get_api_response(url, params)[0]
+
+    def get_api_response(self, url, params=None):
+        # Ask the API whether responses we already have changed, and reuse them when they didn't
+        cache_key = (url, tuple(sorted(params.items())) if params else None)
+        cached = self._responses.get(cache_key)
+        headers = self.headers
+        if cached is not None:
+            etag, last_modified = cached[:2]
+            headers = dict(headers)
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
 
         try:
-            key = self.api_key
-            headers = {"X-Api-Key": key, "content-type": "application/json"}
-            response = self.http.get(url, headers=headers)
+            response = self.http.get(url, headers=headers, params=params)
         except Timeout as e:
             error_message = "Request timeout: {}, {}".format(url, e)
             self.log.warning(error_message)
@@ -87,6 +122,10 @@ class CloudsmithCheck(AgentCheck):
             self.service_check("can_connect", AgentCheck.CRITICAL, message=error_message)
             raise
 
+        if response.status_code == 304 and cached is not None:
+            self.service_check("can_connect", AgentCheck.OK)
+            return cached[2], cached[3]
+
         if response.status_code != 200:
             error_message = (
                 "Expected status code 200 for url {}, but got status code: {} check your config information".format(
@@ -99,7 +138,12 @@ class CloudsmithCheck(AgentCheck):
         else:
             self.service_check("can_connect", AgentCheck.OK)
 
-        return response.json()
+        response_json = response.json()
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self._responses[cache_key] = (etag, last_modified, response_json, response.headers)
+        return response_json, response.headers
 
     def get_usage_info(self):
         url = self.get_full_path(QUOTA)
@@ -111,13 +155,41 @@ class CloudsmithCheck(AgentCheck):
         response_json = self.get_api_json(url)
         return response_json
 
+    def get_repositories(self):
+        # Only the first page tells how many there are, the others are then fetched concurrently
+        url = self.get_full_path(REPOS)
+        first_page, headers = self.get_api_response(url, {'page': 1, 'page_size': self.page_size})
+        page_total = int(headers.get('X-Pagination-PageTotal', 1))
+        pages = [first_page] + self.get_pool().map(
+            lambda page: self.get_api_json(url, {'page': page, 'page_size': self.page_size}), range(2, page_total + 1)
+        )
+        return [repository['slug'] for page in pages for repository in page]
+
+    def get_repository_entitlement_info(self, repository):
+        url = self.get_full_path(METRIC) + '/' + repository
+        try:
+            return self.get_parsed_info(url, self.get_api_json(url), self.parse_entitlement_info)
+        except Exception as e:
+            self.log.warning("Unable to get entitlement usage of repository %s: %s", repository, e)
+            return None
+
+    def get_parsed_info(self, url, response_json, parse):
+        # A 304 returns the same json as before, no need to parse it again
+        cached = self._parsed.get(url)
+        if cached is not None and cached[0] is response_json:
+            return cached[1]
+        parsed = parse(response_json)
+        self._parsed[url] = (response_json, parsed)
+        return parsed
+
     def get_parsed_entitlement_info(self):
+        return self.get_parsed_info(METRIC, self.get_entitlement_info(), self.parse_entitlement_info)
+
+    def parse_entitlement_info(self, response_json):
         token_count = -1
         bandwidth_total = -1
         download_total = -1
 
-        response_json = self.get_entitlement_info()
-
         if 'tokens' in response_json:
             if 'total' in response_json['tokens']:
                 token_count = response_json['tokens']['total']
@@ -150,8 +222,9 @@ class CloudsmithCheck(AgentCheck):
         return entitlement_info
 
     def get_parsed_usage_info(self):
-        response_json = self.get_usage_info()
+        return self.get_parsed_info(QUOTA, self.get_usage_info(), self.parse_usage_info)
 
+    def parse_usage_info(self, response_json):
         storage_used = -1
         bandwidth_used = -1
         storage_mark = self.UNKNOWN
@@ -214,8 +287,10 @@ class CloudsmithCheck(AgentCheck):
             'token_download_total': -1,
         }
 
-        usage_info = self.get_parsed_usage_info()
+        # Both requests are independent, wait for the slower one only
+        usage_result = self.get_pool().apply_async(self.get_parsed_usage_info)
         entitlement_info = self.get_parsed_entitlement_info()
+        usage_info = usage_result.get()
 
         # This is how you submit metrics
         # There are different types of metrics that you can submit (gauge, event).
@@ -240,3 +315,17 @@ class CloudsmithCheck(AgentCheck):
             usage_info['bandwidth_mark'],
             message=bandwith_msg if usage_info['bandwidth_mark'] != AgentCheck.OK else "",
         )
+
+        if self.repository_metrics:
+            self.collect_repository_metrics()
+
+    def collect_repository_metrics(self):
+        repositories = self.get_repositories()
+        results = self.get_pool().map(self.get_repository_entitlement_info, repositories)
+        for repository, entitlement_info in zip(repositories, results):
+            if entitlement_info is None:
+                continue
+            tags = self.tags + ['repository:{}'.format(repository)]
+            self.gauge("repository.token_count", entitlement_info['token_count'], tags=tags)
+            self.gauge("repository.token_bandwidth_total", entitlement_info['token_bandwidth_total'], tags=tags)
+            self.gauge("repository.token_download_total", entitlement_info['token_download_total'], tags=tags)
@@ -1,3 +1,4 @@
+import mock
 import pytest
 from mock import MagicMock
 
@@ -108,3 +109,92 @@ def test_check_badly_formatted_json(aggregator, instance_good, entitlements_test
     aggregator.assert_metric("cloudsmith.token_bandwidth_total", -1, count=1)
     aggregator.assert_metric("cloudsmith.token_count", -1, count=1)
     aggregator.assert_metric("cloudsmith.token_download_total", -1, count=1)
+
+
+class FakeCloudsmithApi(object):
+    """Answers GETs with `responses` by url and page, with a 304 when the ETag sent matches"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, headers=None, params=None):
+        page = (params or {}).get('page')
+        self.requests.append((url, page, headers.get('If-None-Match')))
+        body, response_headers = self.responses[(url, page)]
+        response = MagicMock(headers=response_headers)
+        response.json.return_value = body
+        if response_headers.get('ETag') and headers.get('If-None-Match') == response_headers['ETag']:
+            response.status_code = 304
+        else:
+            response.status_code = 200
+        return response
+
+
+def repository_entitlements(total):
+    return {
+        'tokens': {'total': total, 'bandwidth': {'total': {'value': 10 * total}}, 'downloads': {'total': {'value': 2}}}
+    }
+
+
+@pytest.mark.unit
+def test_conditional_requests(aggregator, instance_good, usage_resp_good, entitlements_test_json):
+    base_url = 'https://api.cloudsmith.io/v1'
+    api = FakeCloudsmithApi(
+        {
+            (base_url + '/quota/cloudsmith', None): (usage_resp_good, {'ETag': '"quota-1"'}),
+            (base_url + '/metrics/entitlements/cloudsmith', None): (entitlements_test_json, {}),
+        }
+    )
+    check = CloudsmithCheck('cloudsmith', {}, [instance_good])
+    check._http = api
+    check.check(None)
+    with mock.patch.object(check, 'parse_usage_info', wraps=check.parse_usage_info) as parse_usage_info:
+        check.check(None)
+        check.cancel()
+
+    # Only the response with an ETag is requested conditionally, its parsed values are reused
+    assert sorted(api.requests, key=str) == sorted(
+        [
+            (base_url + '/metrics/entitlements/cloudsmith', None, None),
+            (base_url + '/metrics/entitlements/cloudsmith', None, None),
+            (base_url + '/quota/cloudsmith', None, None),
+            (base_url + '/quota/cloudsmith', None, '"quota-1"'),
+        ],
+        key=str,
+    )
+    assert parse_usage_info.call_count == 0
+    aggregator.assert_metric("cloudsmith.storage_used", 0.914, count=2)
+    aggregator.assert_metric("cloudsmith.token_count", 119, count=2)
+    aggregator.assert_service_check('cloudsmith.can_connect', CloudsmithCheck.OK, count=4)
+
+
+@pytest.mark.unit
+def test_repository_metrics(aggregator, instance_good, usage_resp_good, entitlements_test_json):
+    base_url = 'https://api.cloudsmith.io/v1'
+    instance_good.update({'repository_metrics': True, 'page_size': 2})
+    api = FakeCloudsmithApi(
+        {
+            (base_url + '/quota/cloudsmith', None): (usage_resp_good, {}),
+            (base_url + '/metrics/entitlements/cloudsmith', None): (entitlements_test_json, {}),
+            (base_url + '/repos/cloudsmith', 1): (
+                [{'slug': 'repo-1'}, {'slug': 'repo-2'}],
+                {'X-Pagination-PageTotal': '2'},
+            ),
+            (base_url + '/repos/cloudsmith', 2): ([{'slug': 'repo-3'}], {'X-Pagination-PageTotal': '2'}),
+            (base_url + '/metrics/entitlements/cloudsmith/repo-1', None): (repository_entitlements(1), {}),
+            (base_url + '/metrics/entitlements/cloudsmith/repo-3', None): (repository_entitlements(3), {}),
+        }
+    )
+    check = CloudsmithCheck('cloudsmith', {}, [instance_good])
+    check._http = api
+    # repo-2 has no entitlement metrics, the other repositories are still reported
+    check.check(None)
+    check.cancel()
+
+    tags = ['base_url:https://api.cloudsmith.io/v1', 'cloudsmith_org:cloudsmith']
+    aggregator.assert_metric("cloudsmith.repository.token_count", 1, tags=tags + ['repository:repo-1'])
+    aggregator.assert_metric("cloudsmith.repository.token_bandwidth_total", 30, tags=tags + ['repository:repo-3'])
+    aggregator.assert_metric("cloudsmith.repository.token_download_total", 2, tags=tags + ['repository:repo-3'])
+    aggregator.assert_metric("cloudsmith.repository.token_count", count=0, tags=tags + ['repository:repo-2'])
+    aggregator.assert_metrics_using_metadata(get_metadata_metrics())
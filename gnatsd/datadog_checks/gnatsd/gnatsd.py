@@ -2,11 +2,44 @@
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
 
+from multiprocessing.pool import ThreadPool
+
 from datadog_checks.base import AgentCheck
 
 EVENT_TYPE = SOURCE_TYPE_NAME = 'gnatsd'
 
 
+class GenerationalCache(object):
+    """Values by key, forgetting the ones that went unused during `max_generations` generations"""
+
+    def __init__(self, max_generations=1):
+        self.max_generations = max_generations
+        # Most recent generation first
+        self.generations = [{}]
+
+    def __contains__(self, key):
+        return any(key in generation for generation in self.generations)
+
+    def get(self, key, default=None):
+        for generation in self.generations:
+            if key in generation:
+                value = self.generations[0][key] = generation.pop(key)
+                return value
+        return default
+
+    def set(self, key, value):
+        self.generations[0][key] = value
+
+    def new_generation(self):
+        self.generations.insert(0, {})
+        del self.generations[self.max_generations + 1 :]
+
+    def restore(self):
+        """Keep the values of the previous generations, for when the current one was interrupted"""
+        interrupted = self.generations.pop(0)
+        self.generations[0].update(interrupted)
+
+
 class GnatsdConfig:
     def __init__(self, instance):
         self.instance = instance
@@ -15,6 +48,9 @@ class GnatsdConfig:
         self.url = '{}:{}'.format(self.host, self.port)
         self.server_name = instance.get('server_name', '')
         self.tags = instance.get('tags', [])
+        self.connz_page_size = int(instance.get('connz_page_size', 1024))
+        self.connz_top = int(instance.get('connz_top', 0))
+        self.connz_sort = instance.get('connz_sort', 'bytes_to')
 
 
 class GnatsdCheckInvocation:
@@ -72,31 +108,68 @@ class GnatsdCheckInvocation:
         self.service_check_tags = self.tags + ['url:%s' % self.config.host]
 
     def check(self):
-        # Confirm monitor endpoint is available
-        self._status_check()
-
-        # Gather NATS metrics
-        for endpoint, metrics in self.METRICS.items():
-            self._check_endpoint(endpoint, metrics)
-
-    def _status_check(self):
-        try:
-            response = self.checker.http.get(self.config.url)
-
-            if response.status_code == 200:
-                self.checker.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK, tags=self.service_check_tags)
-            else:
-                raise ValueError('Non 200 response from NATS monitor port')
-        except Exception as e:
-            msg = "Unable to fetch NATS stats: %s" % str(e)
+        # Gather NATS metrics from all the endpoints at once, their responses tell whether the monitor port is up
+        results = [
+            self.checker.get_pool().apply_async(self._check_endpoint, (endpoint, metrics))
+            for endpoint, metrics in self.METRICS.items()
+        ]
+        error = None
+        for result in results:
+            try:
+                result.get()
+            except Exception as e:
+                error = error or e
+
+        if error is not None:
+            msg = "Unable to fetch NATS stats: %s" % str(error)
             self.checker.service_check(
                 self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL, message=msg, tags=self.service_check_tags
             )
-            raise e
+            raise error
+        self.checker.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK, tags=self.service_check_tags)
+
+    def _get_json(self, endpoint, params=None):
+        # Keep the connection open for the other endpoints and the next runs
+        response = self.checker.http.get('{}/{}'.format(self.config.url, endpoint), params=params, persist=True)
+        if response.status_code != 200:
+            raise ValueError('Non 200 response from NATS monitor port')
+        return response.json()
 
     def _check_endpoint(self, endpoint, metrics):
-        data = self.checker.http.get('{}/{}'.format(self.config.url, endpoint)).json()
-        self._track_metrics(endpoint, metrics, data)
+        if endpoint == 'connz':
+            return self._check_connz(metrics)
+        self._track_metrics(endpoint, metrics, self._get_json(endpoint))
+
+    def _check_connz(self, metrics):
+        """
+        Walks the connections a page at a time, so that only one page is held in memory.
+        With `connz_top`, only the top connections by `connz_sort` are fetched, in a single request.
+        """
+        connection_metrics = {'connections': metrics['connections']}
+        if self.config.connz_top > 0:
+            params = {'sort': self.config.connz_sort, 'limit': self.config.connz_top}
+        else:
+            params = {'limit': self.config.connz_page_size}
+
+        offset = 0
+        num_connections = 0
+        total = 0
+        while True:
+            params['offset'] = offset
+            data = self._get_json('connz', params)
+            connections = data.get('connections') or []
+            self._track_metrics('connz', connection_metrics, data)
+            num_connections += len(connections)
+            total = data.get('total', 0)
+            offset += len(connections)
+            if self.config.connz_top > 0 or not connections or offset >= total:
+                break
+
+        self._track_metrics(
+            'connz',
+            {name: mtype for name, mtype in metrics.items() if name != 'connections'},
+            {'num_connections': num_connections, 'total': total},
+        )
 
     def _track_metrics(self, namespace, metrics, data, tags=None):
         if not tags:
@@ -127,17 +200,25 @@ class GnatsdCheckInvocation:
                 getattr(self.checker, mtype)('gnatsd.{}'.format(path), metric, tags=tags)
 
     def _metric_tags(self, endpoint, data):
+        # The tags of a connection or route don't change during its life, build them once
+        tag_id = data.get('cid') or data.get('rid')
+        if tag_id is not None:
+            tags = self.checker.tag_cache.get((endpoint, tag_id))
+            if tags is not None:
+                return tags
+
         tags = self.tags[:]
         if endpoint in self.TAGS:
             for tag in self.TAGS[endpoint]:
                 if tag in data:
                     tags.append('gnatsd-{}:{}'.format(tag, data[tag]))
+        if tag_id is not None:
+            self.checker.tag_cache.set((endpoint, tag_id), tags)
         return tags
 
     def _count_delta(self, count_id, current_value):
-        self.checker.counts.setdefault(count_id, 0)
-        delta = current_value - self.checker.counts[count_id]
-        self.checker.counts[count_id] = current_value
+        delta = current_value - self.checker.counts.get(count_id, 0)
+        self.checker.counts.set(count_id, current_value)
 
         return delta
 
@@ -145,7 +226,30 @@ class GnatsdCheckInvocation:
 class GnatsdCheck(AgentCheck):
     def __init__(self, name, init_config, instances):
         super(GnatsdCheck, self).__init__(name, init_config, instances)
-        self.counts = {}
+        # Counter values and tags of connections and routes, dropped after `connection_eviction_runs` runs without
+        # them so that a connection leaving the `connz_top` connections for a while doesn't restart from zero
+        eviction_runs = int((self.instance or {}).get('connection_eviction_runs', 3))
+        self.counts = GenerationalCache(eviction_runs)
+        self.tag_cache = GenerationalCache(eviction_runs)
+        self._pool = None
+
+    def get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(len(GnatsdCheckInvocation.METRICS))
+        return self._pool
+
+    def cancel(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
 
     def check(self, instance):
-        GnatsdCheckInvocation(instance, self).check()
+        self.counts.new_generation()
+        self.tag_cache.new_generation()
+        try:
+            GnatsdCheckInvocation(instance, self).check()
+        except Exception:
+            # Keep the values of the connections this run didn't get to
+            self.counts.restore()
+            self.tag_cache.restore()
+            raise
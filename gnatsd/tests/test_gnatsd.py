@@ -2,10 +2,12 @@
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
 
+import mock
 import pytest
 
 from datadog_checks.dev.docker import get_container_ip
 from datadog_checks.gnatsd import GnatsdCheck
+from datadog_checks.gnatsd.gnatsd import GnatsdCheckInvocation
 
 CHECK_NAME = 'gnatsd'
 
@@ -102,3 +104,167 @@ def test_deltas(aggregator, instance):
     aggregator.reset()
     c.check(instance)
     aggregator.assert_metric('gnatsd.connz.connections.foo-sub.out_msgs', metric_type=aggregator.COUNT, value=0)
+
+
+class FakeMonitor(object):
+    """Serves varz, routez and the pages of connz for `connections`"""
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.requests = []
+        self.persisted = []
+
+    def get(self, url, params=None, persist=False):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.requests.append((endpoint, params and dict(params)))
+        self.persisted.append(persist)
+        if endpoint == 'varz':
+            data = dict.fromkeys(GnatsdCheckInvocation.METRICS['varz'], 0)
+            data.update({'server_id': 'nats-1', 'connections': len(self.connections)})
+        elif endpoint == 'routez':
+            data = {'num_routes': 0, 'routes': []}
+        elif endpoint == 'connz':
+            connections = self.connections
+            if 'sort' in params:
+                connections = sorted(connections, key=lambda c: c['out_bytes'], reverse=True)
+            page = connections[params['offset'] : params['offset'] + params['limit']]
+            data = {'num_connections': len(page), 'total': len(self.connections), 'connections': page}
+        else:
+            data = {}
+        response = mock.MagicMock(status_code=200)
+        response.json.return_value = data
+        return response
+
+
+def connection(cid, out_msgs):
+    data = dict.fromkeys(GnatsdCheckInvocation.METRICS['connz']['connections'], 0)
+    data.update({'cid': cid, 'name': 'conn-{}'.format(cid), 'out_msgs': out_msgs, 'out_bytes': 100 * out_msgs})
+    return data
+
+
+@pytest.mark.unit
+def test_connz_pages(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222, 'connz_page_size': 2}
+    c = GnatsdCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeMonitor([connection(cid, cid) for cid in range(1, 6)])
+    c.check(instance)
+
+    assert [params['offset'] for endpoint, params in c._http.requests if endpoint == 'connz'] == [0, 2, 4]
+    aggregator.assert_metric('gnatsd.connz.num_connections', 5)
+    aggregator.assert_metric('gnatsd.connz.total', 5)
+    for cid in range(1, 6):
+        aggregator.assert_metric('gnatsd.connz.connections.conn-{}.out_msgs'.format(cid), cid)
+
+
+@pytest.mark.unit
+def test_connz_top(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222, 'connz_top': 2, 'connz_sort': 'bytes_to'}
+    c = GnatsdCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeMonitor([connection(cid, cid) for cid in range(1, 6)])
+    c.check(instance)
+
+    assert [params for endpoint, params in c._http.requests if endpoint == 'connz'] == [
+        {'sort': 'bytes_to', 'limit': 2, 'offset': 0}
+    ]
+    aggregator.assert_metric('gnatsd.connz.num_connections', 2)
+    aggregator.assert_metric('gnatsd.connz.total', 5)
+    aggregator.assert_metric('gnatsd.connz.connections.conn-5.out_msgs', 5)
+    aggregator.assert_metric('gnatsd.connz.connections.conn-4.out_msgs', 4)
+    aggregator.assert_metric('gnatsd.connz.connections.conn-3.out_msgs', count=0)
+
+
+@pytest.mark.unit
+def test_closed_connections_evicted(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222, 'connection_eviction_runs': 2}
+    c = GnatsdCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeMonitor([connection(1, 10), connection(2, 20)])
+    c.check(instance)
+    assert 'connz.connections.conn-2.out_msgs.2' in c.counts
+
+    # Connection 2 closed, its counters are dropped once enough runs went without it
+    c._http.connections = [connection(1, 15)]
+    aggregator.reset()
+    c.check(instance)
+    aggregator.assert_metric('gnatsd.connz.connections.conn-1.out_msgs', 5)
+    assert 'connz.connections.conn-2.out_msgs.2' in c.counts
+    c.check(instance)
+    assert 'connz.connections.conn-2.out_msgs.2' in c.counts
+    c.check(instance)
+    assert 'connz.connections.conn-2.out_msgs.2' not in c.counts
+
+    # A failed run keeps every value
+    c._http.connections = [connection(1, 15), connection(3, 30)]
+    with mock.patch.object(c._http, 'get', side_effect=Exception('Connection refused')), pytest.raises(Exception):
+        c.check(instance)
+    assert 'connz.connections.conn-1.out_msgs.1' in c.counts
+    assert c.counts.get('connz.connections.conn-1.out_msgs.1') == 15
+
+
+@pytest.mark.unit
+def test_connection_back_in_top(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222, 'connz_top': 1}
+    c = GnatsdCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeMonitor([connection(1, 100), connection(2, 50)])
+    c.check(instance)
+
+    # Connection 2 overtakes connection 1 for a run, then falls behind again
+    c._http.connections = [connection(1, 110), connection(2, 150)]
+    c.check(instance)
+    c._http.connections = [connection(1, 300), connection(2, 160)]
+    aggregator.reset()
+    c.check(instance)
+
+    # Connection 1 restarts from its last value instead of zero
+    aggregator.assert_metric('gnatsd.connz.connections.conn-1.out_msgs', 200)
+    aggregator.assert_metric('gnatsd.connz.connections.conn-2.out_msgs', count=0)
+
+
+@pytest.mark.unit
+def test_concurrent_endpoints(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222, 'tags': ['team:nats']}
+    c = GnatsdCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeMonitor([connection(1, 10)])
+    c.check(instance)
+
+    # Liveness comes from the metric endpoints, over connections kept open between requests
+    assert sorted(endpoint for endpoint, _ in c._http.requests) == ['connz', 'routez', 'varz']
+    assert all(c._http.persisted)
+    aggregator.assert_service_check('gnatsd.can_connect', status=GnatsdCheck.OK, count=1)
+    c.cancel()
+
+
+@pytest.mark.unit
+def test_endpoint_failure(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222}
+    c = GnatsdCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeMonitor([connection(1, 10)])
+    get = c._http.get
+
+    def failing_get(url, **kwargs):
+        response = get(url, **kwargs)
+        if url.endswith('/routez'):
+            response.status_code = 500
+        return response
+
+    c._http.get = failing_get
+    with pytest.raises(ValueError):
+        c.check(instance)
+    aggregator.assert_service_check('gnatsd.can_connect', status=GnatsdCheck.CRITICAL, count=1)
+    aggregator.assert_service_check('gnatsd.can_connect', status=GnatsdCheck.OK, count=0)
+
+
+@pytest.mark.unit
+def test_connection_tags_cached(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222}
+    c = GnatsdCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeMonitor([connection(1, 10), connection(2, 20)])
+    c.check(instance)
+    tags = c.tag_cache.get(('connz.connections', 1))
+    assert 'gnatsd-cid:1' in tags
+
+    c._http.connections = [connection(1, 15)]
+    c.check(instance)
+    assert c.tag_cache.get(('connz.connections', 1)) is tags
+    for _ in range(3):
+        c.check(instance)
+    assert ('connz.connections', 2) not in c.tag_cache
@@ -4,11 +4,45 @@
 
 import time
 
-from datadog_checks.base import AgentCheck
+from datadog_checks.base import AgentCheck, is_affirmative
 
 EVENT_TYPE = SOURCE_TYPE_NAME = 'gnatsd_streaming'
 
 
+class ChannelCounters(object):
+    """Last values of the counters of every channel, forgotten once a channel went unseen for `max_idle_runs` runs.
+
+    Each channel holds a single tuple: the run it was last seen in followed by the value of each of `fields`.
+    """
+
+    def __init__(self, fields, max_idle_runs):
+        self.fields = {field: i + 1 for i, field in enumerate(fields)}
+        self.max_idle_runs = max_idle_runs
+        self.values = {}
+        self.run = 0
+
+    def start_run(self):
+        self.run += 1
+
+    def end_run(self):
+        expired = [channel for channel, values in self.values.items() if self.run - values[0] >= self.max_idle_runs]
+        for channel in expired:
+            del self.values[channel]
+
+    def delta(self, channel, field, current_value):
+        index = self.fields[field]
+        values = self.values.get(channel)
+        if values is None:
+            values = (self.run,) + (0,) * len(self.fields)
+        previous_value = values[index]
+        self.values[channel] = (self.run,) + values[1:index] + (current_value,) + values[index + 1 :]
+
+        # Counters going backwards belong to a channel that was deleted and created again
+        if current_value < previous_value:
+            return current_value
+        return current_value - previous_value
+
+
 class GnatsdStreamingConfig:
     def __init__(self, instance):
         self.instance = instance
@@ -16,7 +50,11 @@ class GnatsdStreamingConfig:
         self.port = int(instance.get('port', 8222))
         self.url = self.host + ':' + str(self.port) + '/streaming'
         self.server_name = instance.get('server_name', '')
-        self.pagination_limit = instance.get('pagination_limit', 1024)
+        self.pagination_limit = int(instance.get('pagination_limit', 1024))
+        self.max_pagination_limit = max(int(instance.get('max_pagination_limit', 8192)), self.pagination_limit)
+        self.pagination_target_time = float(instance.get('pagination_target_time', 1))
+        self.collect_subscriptions = is_affirmative(instance.get('collect_subscriptions', False))
+        self.channel_eviction_runs = int(instance.get('channel_eviction_runs', 3))
         self.tags = instance.get('tags', [])
 
 
@@ -95,19 +133,45 @@ class GnatsdStreamingCheckInvocation:
 
         self.checker.ft_status = response['state']
 
-    def _check_endpoint(self, endpoint, metrics, pagination=None):
-        params = self._params(endpoint)
-        if pagination:
-            params.update(pagination)
-
-        data = self.checker.http.get(self.config.url + '/' + endpoint, params=params).json()
+    def _check_endpoint(self, endpoint, metrics):
+        if endpoint == 'channelsz':
+            return self._check_channelsz(metrics)
+        data = self.checker.http.get(self.config.url + '/' + endpoint).json()
         self._track_metrics(endpoint, metrics, data)
 
-        if data.get('count', 0) > 0:
-            offset = data.get('offset') + data.get('limit')
-            self._check_endpoint(endpoint, metrics, pagination={'offset': offset})
-
-    def _track_metrics(self, namespace, metrics, data, tags=None):
+    def _check_channelsz(self, metrics):
+        # One page at a time, each one is released before the next one is fetched
+        offset = 0
+        limit = self.checker.page_size or self.config.pagination_limit
+        while True:
+            params = {'offset': offset, 'limit': limit}
+            if self.config.collect_subscriptions:
+                params['subs'] = 1
+
+            start = time.time()
+            data = self.checker.http.get(self.config.url + '/channelsz', params=params).json()
+            elapsed = time.time() - start
+            self._track_metrics('channelsz', metrics, data)
+
+            count = data.get('count', 0)
+            # The server may return fewer channels than requested, page on what it says it used
+            if count == 0 or count < data.get('limit', limit):
+                break
+            offset = data.get('offset', offset) + count
+            limit = self._adapt_page_size(limit, elapsed)
+
+        # Start from the size that worked for this server on the next run
+        self.checker.page_size = limit
+
+    def _adapt_page_size(self, limit, elapsed):
+        """Grows the page size while pages come back well within the target time, shrinks it when they don't"""
+        if elapsed > self.config.pagination_target_time:
+            return max(limit // 2, 1)
+        if elapsed < self.config.pagination_target_time / 2:
+            return min(limit * 2, self.config.max_pagination_limit)
+        return limit
+
+    def _track_metrics(self, namespace, metrics, data, tags=None, channel=None):
         if not tags:
             tags = self._metric_tags(namespace, data)
 
@@ -118,10 +182,16 @@ class GnatsdStreamingCheckInvocation:
                 for instance in data.get(mname, []):
                     title = str(instance.get('name')) if 'channels' in namespace else ''
                     self._track_metrics(
-                        path + '.' + title.replace(".", "_"), mtype, instance, tags=self._metric_tags(path, instance)
+                        path + '.' + title.replace(".", "_"),
+                        mtype,
+                        instance,
+                        tags=self._metric_tags(path, instance),
+                        channel=instance.get('name'),
                     )
             else:
-                if mtype == 'count':
+                if mtype == 'count' and channel is not None:
+                    metric = self.checker.channel_counts.delta(channel, mname, data[mname])
+                elif mtype == 'count':
                     metric = self._count_delta(path, data[mname])
                 else:
                     metric = data[mname]
@@ -129,9 +199,6 @@ class GnatsdStreamingCheckInvocation:
                 # Send metric to Datadog
                 getattr(self.checker, mtype)('gnatsd.streaming.' + path, metric, tags=tags)
 
-    def _params(self, endpoint):
-        return {'channelsz': {'subs': 1, 'limit': self.config.pagination_limit}}.get(endpoint, {})
-
     def _metric_tags(self, endpoint, data):
         tags = []
         if endpoint in self.TAGS:
@@ -153,6 +220,18 @@ class GnatsdStreamingCheck(AgentCheck):
         super(GnatsdStreamingCheck, self).__init__(name, init_config, instances)
         self.counts = {}
         self.ft_status = None
+        self.page_size = None
+        self.channel_counts = None
 
     def check(self, instance):
-        GnatsdStreamingCheckInvocation(instance, self).check()
+        invocation = GnatsdStreamingCheckInvocation(instance, self)
+        if self.channel_counts is None:
+            metrics = invocation.METRICS['channelsz']['channels']
+            self.channel_counts = ChannelCounters(
+                [name for name, mtype in metrics.items() if mtype == 'count'], invocation.config.channel_eviction_runs
+            )
+
+        self.channel_counts.start_run()
+        invocation.check()
+        # Only after a complete run, channels on the pages not fetched would be evicted otherwise
+        self.channel_counts.end_run()
@@ -2,9 +2,11 @@
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
 
+import mock
 import pytest
 
 from datadog_checks.gnatsd_streaming import GnatsdStreamingCheck
+from datadog_checks.gnatsd_streaming.gnatsd_streaming import ChannelCounters, GnatsdStreamingCheckInvocation
 
 CHECK_NAME = 'gnatsd_streaming'
 
@@ -93,3 +95,128 @@ def test_deltas(aggregator, instance):
     aggregator.assert_metric(
         'gnatsd.streaming.channelsz.channels.test_channel1.msgs', metric_type=aggregator.COUNT, value=0
     )
+
+
+class FakeStreamingMonitor(object):
+    """Serves the monitoring endpoints of a server with `channels`, as (name, msgs, bytes)"""
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.pages = []
+
+    def get(self, url, params=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        if endpoint == 'serverz':
+            data = dict.fromkeys(GnatsdStreamingCheckInvocation.METRICS['serverz'], 0)
+            data.update({'cluster_id': 'test-cluster', 'server_id': 'nss-1', 'state': 'STANDALONE'})
+        elif endpoint == 'channelsz':
+            self.pages.append(dict(params))
+            page = self.channels[params['offset'] : params['offset'] + params['limit']]
+            data = {
+                'cluster_id': 'test-cluster',
+                'server_id': 'nss-1',
+                'offset': params['offset'],
+                'limit': params['limit'],
+                'count': len(page),
+                'total': len(self.channels),
+                'channels': [{'name': name, 'msgs': msgs, 'bytes': size} for name, msgs, size in page],
+            }
+        else:
+            data = {'total': 0, 'total_msgs': 0, 'total_bytes': 0}
+        response = mock.MagicMock(status_code=200)
+        response.json.return_value = data
+        return response
+
+
+@pytest.mark.unit
+def test_channel_pages(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222, 'pagination_limit': 1, 'pagination_target_time': 10}
+    c = GnatsdStreamingCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeStreamingMonitor([('channel.{}'.format(i), i, 10 * i) for i in range(7)])
+    c.check(instance)
+
+    # Fast pages grow the page size, which the next run starts from
+    assert [(page['offset'], page['limit']) for page in c._http.pages] == [(0, 1), (1, 2), (3, 4), (7, 8)]
+    assert c.page_size == 8
+    assert all('subs' not in page for page in c._http.pages)
+    for i in range(7):
+        aggregator.assert_metric('gnatsd.streaming.channelsz.channels.channel_{}.msgs'.format(i), i)
+    aggregator.assert_metric('gnatsd.streaming.channelsz.total', 7)
+
+
+@pytest.mark.unit
+def test_channel_pages_iterative():
+    instance = {'host': 'http://localhost', 'port': 8222, 'pagination_limit': 1, 'max_pagination_limit': 1}
+    c = GnatsdStreamingCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeStreamingMonitor([('channel.{}'.format(i), i, i) for i in range(3000)])
+    c.check(instance)
+
+    assert len(c._http.pages) == 3001
+
+
+@pytest.mark.unit
+def test_page_size_adapts():
+    instance = {'host': 'http://localhost', 'port': 8222, 'max_pagination_limit': 4096, 'pagination_target_time': 2}
+    invocation = GnatsdStreamingCheckInvocation(instance, GnatsdStreamingCheck(CHECK_NAME, {}, [instance]))
+
+    assert invocation._adapt_page_size(1024, 0.5) == 2048
+    assert invocation._adapt_page_size(4096, 0.5) == 4096
+    assert invocation._adapt_page_size(1024, 1.5) == 1024
+    assert invocation._adapt_page_size(1024, 3) == 512
+    assert invocation._adapt_page_size(1, 3) == 1
+
+
+@pytest.mark.unit
+def test_collect_subscriptions():
+    instance = {'host': 'http://localhost', 'port': 8222, 'collect_subscriptions': True}
+    c = GnatsdStreamingCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeStreamingMonitor([('channel', 1, 1)])
+    c.check(instance)
+
+    assert all(page['subs'] == 1 for page in c._http.pages)
+
+
+@pytest.mark.unit
+def test_channel_counters():
+    counters = ChannelCounters(['msgs', 'bytes'], 2)
+    counters.start_run()
+    assert counters.delta('orders', 'msgs', 10) == 10
+    assert counters.delta('orders', 'bytes', 100) == 100
+    counters.end_run()
+
+    counters.start_run()
+    assert counters.delta('orders', 'msgs', 15) == 5
+    # The channel was deleted and created again
+    assert counters.delta('orders', 'bytes', 30) == 30
+    counters.end_run()
+    assert counters.values == {'orders': (2, 15, 30)}
+
+    counters.start_run()
+    counters.end_run()
+    assert 'orders' in counters.values
+    counters.start_run()
+    counters.end_run()
+    assert counters.values == {}
+
+
+@pytest.mark.unit
+def test_deleted_channels_evicted(aggregator):
+    instance = {'host': 'http://localhost', 'port': 8222, 'channel_eviction_runs': 1}
+    c = GnatsdStreamingCheck(CHECK_NAME, {}, [instance])
+    c._http = FakeStreamingMonitor([('orders', 10, 100), ('payments', 20, 200)])
+    c.check(instance)
+    assert sorted(c.channel_counts.values) == ['orders', 'payments']
+    assert not any(key.startswith('channelsz.channels') for key in c.counts)
+
+    c._http.channels = [('orders', 12, 120)]
+    aggregator.reset()
+    c.check(instance)
+    aggregator.assert_metric('gnatsd.streaming.channelsz.channels.orders.msgs', 2)
+    assert sorted(c.channel_counts.values) == ['orders']
+
+    # Recreated, it counts from zero instead of going negative
+    c._http.channels = [('orders', 3, 30)]
+    aggregator.reset()
+    c.check(instance)
+    aggregator.assert_metric('gnatsd.streaming.channelsz.channels.orders.msgs', 3)
+    aggregator.assert_metric('gnatsd.streaming.channelsz.channels.orders.bytes', 30)
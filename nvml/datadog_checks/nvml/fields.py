@@ -0,0 +1,50 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+
+# Field ids from nvml.h, spelled out since older pynvml releases don't define all of them.
+# See https://docs.nvidia.com/deploy/nvml-api/group__nvmlFieldValueQueries.html
+NVML_FI_DEV_ECC_SBE_VOL_TOTAL = 3
+NVML_FI_DEV_ECC_DBE_VOL_TOTAL = 4
+NVML_FI_DEV_ECC_SBE_AGG_TOTAL = 5
+NVML_FI_DEV_ECC_DBE_AGG_TOTAL = 6
+NVML_FI_DEV_RETIRED_SBE = 29
+NVML_FI_DEV_RETIRED_DBE = 30
+NVML_FI_DEV_RETIRED_PENDING = 31
+NVML_FI_DEV_NVLINK_CRC_FLIT_ERROR_COUNT_TOTAL = 38
+NVML_FI_DEV_NVLINK_CRC_DATA_ERROR_COUNT_TOTAL = 45
+NVML_FI_DEV_NVLINK_REPLAY_ERROR_COUNT_TOTAL = 52
+NVML_FI_DEV_NVLINK_RECOVERY_ERROR_COUNT_TOTAL = 59
+NVML_FI_DEV_MEMORY_TEMP = 82
+NVML_FI_DEV_TOTAL_ENERGY_CONSUMPTION = 83
+NVML_FI_DEV_PCIE_REPLAY_COUNTER = 94
+NVML_FI_DEV_POWER_AVERAGE = 185
+
+VALUE_ATTRIBUTES = ('dVal', 'uiVal', 'ulVal', 'ullVal', 'sllVal', 'siVal', 'usVal')
+"""Attribute of the c_nvmlValue_t union holding the value, by nvmlValueType_t"""
+
+FIELD_METRICS = (
+    # (field id, metric name, submission method, pynvml function used when the field fails)
+    # The averaged power, as reported by nvmlDeviceGetPowerUsage on recent GPUs
+    (NVML_FI_DEV_POWER_AVERAGE, 'power_usage', 'gauge', 'nvmlDeviceGetPowerUsage'),
+    (
+        NVML_FI_DEV_TOTAL_ENERGY_CONSUMPTION,
+        'total_energy_consumption',
+        'monotonic_count',
+        'nvmlDeviceGetTotalEnergyConsumption',
+    ),
+    (NVML_FI_DEV_MEMORY_TEMP, 'memory_temperature', 'gauge', None),
+    (NVML_FI_DEV_ECC_SBE_VOL_TOTAL, 'ecc_errors.volatile.single_bit', 'gauge', None),
+    (NVML_FI_DEV_ECC_DBE_VOL_TOTAL, 'ecc_errors.volatile.double_bit', 'gauge', None),
+    (NVML_FI_DEV_ECC_SBE_AGG_TOTAL, 'ecc_errors.aggregate.single_bit', 'gauge', None),
+    (NVML_FI_DEV_ECC_DBE_AGG_TOTAL, 'ecc_errors.aggregate.double_bit', 'gauge', None),
+    (NVML_FI_DEV_RETIRED_SBE, 'retired_pages.single_bit', 'gauge', None),
+    (NVML_FI_DEV_RETIRED_DBE, 'retired_pages.double_bit', 'gauge', None),
+    (NVML_FI_DEV_RETIRED_PENDING, 'retired_pages.pending', 'gauge', None),
+    (NVML_FI_DEV_PCIE_REPLAY_COUNTER, 'pcie_replay_count', 'monotonic_count', None),
+    (NVML_FI_DEV_NVLINK_CRC_FLIT_ERROR_COUNT_TOTAL, 'nvlink.crc_flit_errors', 'monotonic_count', None),
+    (NVML_FI_DEV_NVLINK_CRC_DATA_ERROR_COUNT_TOTAL, 'nvlink.crc_data_errors', 'monotonic_count', None),
+    (NVML_FI_DEV_NVLINK_REPLAY_ERROR_COUNT_TOTAL, 'nvlink.replay_errors', 'monotonic_count', None),
+    (NVML_FI_DEV_NVLINK_RECOVERY_ERROR_COUNT_TOTAL, 'nvlink.recovery_errors', 'monotonic_count', None),
+)
+"""Metrics gathered with a single nvmlDeviceGetFieldValues call per GPU, adding one here costs no extra call"""
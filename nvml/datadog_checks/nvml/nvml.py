@@ -2,31 +2,33 @@
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
 
+import heapq
 import os.path
 import threading
-import time
+from collections import defaultdict
 
 import grpc
 import pynvml
 
-from datadog_checks.base import AgentCheck
+from datadog_checks.base import AgentCheck, is_affirmative
 
 from .api_pb2 import ListPodResourcesRequest
 from .api_pb2_grpc import PodResourcesListerStub
+from .fields import FIELD_METRICS, VALUE_ATTRIBUTES
+from .processes import ContainerMap
+from .sampler import GpuSampler
 
 METRIC_PREFIX = "nvml."
 SOCKET_PATH = "/var/lib/kubelet/pod-resources/kubelet.sock"
 """Assumed to be a UDS accessible from this running code"""
+MIN_REFRESH_INTERVAL = 10
+MAX_REFRESH_INTERVAL = 80
+"""Bounds in seconds of the delay between two k8s tag refreshes, which grows while pods don't change"""
+LIST_TIMEOUT = 10
 
 
-class NvmlInit(object):
-    """Wraps an nvmlInit and an nvmlShutdown inside the same context"""
-
-    def __enter__(self):
-        NvmlCheck.N.nvmlInit()
-
-    def __exit__(self, exception_type, exception_value, traceback):
-        NvmlCheck.N.nvmlShutdown()
+RESET_ERRORS = (pynvml.NVMLError_Uninitialized, pynvml.NVMLError_GpuIsLost, pynvml.NVMLError_ResetRequired)
+"""NVML errors after which the library must be initialized and the devices resolved again"""
 
 
 class NvmlCall(object):
@@ -54,6 +56,9 @@ class NvmlCall(object):
             return False
         if not issubclass(exception_type, pynvml.NVMLError):
             return False
+        # Let the check start a new NVML session, every other call would fail the same way
+        if issubclass(exception_type, RESET_ERRORS):
+            return False
 
         # Suppress pynvml exceptions so we can continue
         if self.name in NvmlCall.previously_printed_errors:
@@ -68,16 +73,37 @@ class NvmlCheck(AgentCheck):
     N = pynvml
     """The pynvml package, explicitly assigned, used for easy test mocking."""
     known_tags = {}
-    """A map of GPU UUIDs to the k8s tags we should assign that GPU."""
+    """A map of GPU UUIDs, as both bytes and strings, to the k8s tags we should assign that GPU."""
     lock = threading.Lock()
     """Lock for the object known_tags."""
     _thread = None
     """Daemon thread updating k8s tag information in the background."""
     should_run = False
     """Whether libnvml can be found and the check can thus run."""
+    DEFAULT_SAMPLING_BUFFER_SIZE = 600
+    DEFAULT_MAX_PROCESSES = 100
 
     def __init__(self, name, init_config, instances):
         super(NvmlCheck, self).__init__(name, init_config, instances)
+        self._sampler = None
+        """Background sampler of bursty metrics, when sampling_rate is set"""
+        self._initialized = False
+        """Whether NVML is initialized, it stays so between runs until an error requires a reset"""
+        self._devices = []
+        """Cached (handle, uuid) of each GPU, by index"""
+        self._fields = {}
+        """By GPU UUID, the FIELD_METRICS to get with nvmlDeviceGetFieldValues and the ones to get one by one"""
+        self._pods = {}
+        """By (namespace, name) of pod, its serialized resources and the tags of its GPUs"""
+        self._channel = None
+        self._stub = None
+        """Kubelet pod resources client, kept open between refreshes"""
+        self._stop_discovery = threading.Event()
+        self._containers = None
+        """PID to container id map, when collect_processes is enabled"""
+        self._max_processes = self.DEFAULT_MAX_PROCESSES
+        self._process_timestamps = {}
+        """By GPU UUID, timestamp of the last process utilization sample"""
         # self.N = pynvml
         if self.is_nvml_library_available():
             # Start thread once and keep it running in the background
@@ -97,21 +123,69 @@ class NvmlCheck(AgentCheck):
         if not self.should_run:
             # No kubelet socket or no NVML library, skip the check
             return
-        with NvmlInit():
+        sampling_rate = float(instance.get('sampling_rate', 0))
+        if sampling_rate > 0 and self._sampler is None:
+            buffer_size = int(instance.get('sampling_buffer_size', self.DEFAULT_SAMPLING_BUFFER_SIZE))
+            self._sampler = GpuSampler(NvmlCheck.N, sampling_rate, buffer_size, self.log)
+            self._sampler.start()
+        if self._containers is None and is_affirmative(instance.get('collect_processes', False)):
+            self._max_processes = int(instance.get('max_processes', self.DEFAULT_MAX_PROCESSES))
+            self._containers = ContainerMap(instance.get('procfs_path', '/proc'), self._max_processes)
+        if not self._initialized:
+            NvmlCheck.N.nvmlInit()
+            self._initialized = True
+        try:
             self.gather(instance)
+        except RESET_ERRORS as e:
+            self.log.warning("NVML was reset, reinitializing it on the next run: %s", e)
+            self.shutdown()
+
+    def cancel(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        self._stop_discovery.set()
+        self.shutdown()
+
+    def shutdown(self):
+        """Ends the NVML session and forgets the device handles obtained from it"""
+        self._devices = []
+        self._fields = {}
+        self._process_timestamps = {}
+        if self._initialized:
+            self._initialized = False
+            with NvmlCall("shutdown", self.log):
+                NvmlCheck.N.nvmlShutdown()
+
+    def get_devices(self, device_count):
+        """Returns the (handle, uuid) of every GPU, resolving them again only when the number of GPUs changed"""
+        if len(self._devices) != device_count:
+            devices = []
+            for i in range(device_count):
+                handle = NvmlCheck.N.nvmlDeviceGetHandleByIndex(i)
+                devices.append((handle, NvmlCheck.N.nvmlDeviceGetUUID(handle)))
+            self._devices = devices
+        return self._devices
 
     def gather(self, instance):
+        if self._containers is not None:
+            self._containers.start_run()
         with NvmlCall("device_count", self.log):
             deviceCount = NvmlCheck.N.nvmlDeviceGetCount()
             self.gauge('device_count', deviceCount)
-            for i in range(deviceCount):
-                handle = NvmlCheck.N.nvmlDeviceGetHandleByIndex(i)
-                uuid = NvmlCheck.N.nvmlDeviceGetUUID(handle)
+            for i, (handle, uuid) in enumerate(self.get_devices(deviceCount)):
                 # The tags used by https://github.com/NVIDIA/gpu-monitoring-tools/blob/master/exporters/prometheus-dcgm/dcgm-exporter/dcgm-exporter # noqa: E501
                 tags = ["gpu:" + str(i)]
                 # Appends k8s specific tags
                 tags += self.get_tags(uuid)
                 self.gather_gpu(handle, tags)
+                self.gather_fields(handle, uuid, tags)
+                if self._sampler is not None:
+                    self.gather_samples(i, tags)
+                if self._containers is not None:
+                    self.gather_processes(handle, uuid, tags)
+        if self._containers is not None:
+            self._containers.end_run()
 
     def gather_gpu(self, handle, tags):
         """Gather metrics for a specific GPU"""
@@ -132,16 +206,6 @@ class NvmlCheck(AgentCheck):
             self.gauge('fb_used', mem_info.used, tags=tags)
             self.gauge('fb_total', mem_info.total, tags=tags)
 
-        # See https://docs.nvidia.com/deploy/nvml-api/group__nvmlDeviceQueries.html#group__nvmlDeviceQueries_1g7ef7dff0ff14238d08a19ad7fb23fc87 # noqa: E501
-        with NvmlCall("power", self.log):
-            power = NvmlCheck.N.nvmlDeviceGetPowerUsage(handle)
-            self.gauge('power_usage', power, tags=tags)
-
-        # https://docs.nvidia.com/deploy/nvml-api/group__nvmlDeviceQueries.html#group__nvmlDeviceQueries_1g732ab899b5bd18ac4bfb93c02de4900a
-        with NvmlCall("total_energy_consumption", self.log):
-            consumption = NvmlCheck.N.nvmlDeviceGetTotalEnergyConsumption(handle)
-            self.monotonic_count('total_energy_consumption', consumption, tags=tags)
-
         # https://docs.nvidia.com/deploy/nvml-api/group__nvmlDeviceQueries.html#group__nvmlDeviceQueries_1ga5c77a2154a20d4e660221d8592d21fb
         with NvmlCall("enc_utilization", self.log):
             encoder_util = NvmlCheck.N.nvmlDeviceGetEncoderUtilization(handle)
@@ -159,6 +223,91 @@ class NvmlCheck(AgentCheck):
             self.monotonic_count('pcie_tx_throughput', tx_bytes, tags=tags)
             self.monotonic_count('pcie_rx_throughput', rx_bytes, tags=tags)
 
+    def gather_fields(self, handle, uuid, tags):
+        """Gather the FIELD_METRICS of a GPU in one call, falling back to a call per metric for the failing fields"""
+        if uuid not in self._fields:
+            if hasattr(NvmlCheck.N, 'nvmlDeviceGetFieldValues'):
+                self._fields[uuid] = (FIELD_METRICS, ())
+            else:
+                self._fields[uuid] = ((), tuple(field for field in FIELD_METRICS if field[3]))
+        bulk_fields, fallback_fields = self._fields[uuid]
+
+        if bulk_fields:
+            unsupported = []
+            with NvmlCall("field_values", self.log):
+                try:
+                    values = NvmlCheck.N.nvmlDeviceGetFieldValues(handle, [field[0] for field in bulk_fields])
+                except (pynvml.NVMLError_FunctionNotFound, pynvml.NVMLError_NotSupported) as e:
+                    self.log.debug("Field values are not supported by this driver: %s", e)
+                    unsupported = bulk_fields
+                else:
+                    for field, value in zip(bulk_fields, values):
+                        if value.nvmlReturn == pynvml.NVML_SUCCESS:
+                            submit = getattr(self, field[2])
+                            submit(field[1], getattr(value.value, VALUE_ATTRIBUTES[value.valueType]), tags=tags)
+                        elif value.nvmlReturn == pynvml.NVML_ERROR_NOT_SUPPORTED or field[3]:
+                            # Older drivers fail with other errors on the field ids they don't know
+                            unsupported.append(field)
+                        else:
+                            self.log.debug("Unable to get field %s: error %s", field[1], value.nvmlReturn)
+            if unsupported:
+                # Don't ask for these again, get the ones that have their own NVML function from it instead
+                self.log.debug("Fields not supported by GPU %s: %s", uuid, [field[1] for field in unsupported])
+                bulk_fields = tuple(field for field in bulk_fields if field not in unsupported)
+                fallback_fields += tuple(field for field in unsupported if field[3])
+                self._fields[uuid] = (bulk_fields, fallback_fields)
+
+        for _, name, method, function in fallback_fields:
+            with NvmlCall(name, self.log):
+                getattr(self, method)(name, getattr(NvmlCheck.N, function)(handle), tags=tags)
+
+    def gather_samples(self, index, tags):
+        """Submit aggregates of the samples taken by the background sampler since the last run"""
+        for metric, (minimum, maximum, average, p95) in self._sampler.collect(index):
+            self.gauge(metric + '.min', minimum, tags=tags)
+            self.gauge(metric + '.max', maximum, tags=tags)
+            self.gauge(metric + '.avg', average, tags=tags)
+            self.gauge(metric + '.p95', p95, tags=tags)
+
+    def gather_processes(self, handle, uuid, tags):
+        """Gather the GPU memory and SM utilization of the processes running on a GPU, summed by container"""
+        processes = []
+        with NvmlCall("compute_processes", self.log):
+            processes = NvmlCheck.N.nvmlDeviceGetComputeRunningProcesses(handle)
+        if len(processes) > self._max_processes:
+            # Bound the work with many MPS clients, keeping the processes using the most memory
+            processes = heapq.nlargest(self._max_processes, processes, key=lambda p: p.usedGpuMemory or 0)
+
+        sm_utilization = {}
+        if processes and hasattr(NvmlCheck.N, 'nvmlDeviceGetProcessUtilization'):
+            with NvmlCall("process_utilization", self.log):
+                try:
+                    samples = NvmlCheck.N.nvmlDeviceGetProcessUtilization(handle, self._process_timestamps.get(uuid, 0))
+                except pynvml.NVMLError_NotFound:
+                    # No sample since the previous run
+                    samples = []
+                latest = {}
+                for sample in samples:
+                    if sample.timeStamp >= latest.get(sample.pid, 0):
+                        latest[sample.pid] = sample.timeStamp
+                        sm_utilization[sample.pid] = sample.smUtil
+                if latest:
+                    self._process_timestamps[uuid] = max(latest.values())
+
+        memory_used = defaultdict(int)
+        sm_used = defaultdict(int)
+        for process in processes:
+            container_id = self._containers.get(process.pid)
+            if container_id is None:
+                continue
+            memory_used[container_id] += process.usedGpuMemory or 0
+            sm_used[container_id] += sm_utilization.get(process.pid, 0)
+
+        for container_id, used in memory_used.items():
+            container_tags = tags + ['container_id:' + container_id]
+            self.gauge('container.gpu_memory_used', used, tags=container_tags)
+            self.gauge('container.sm_utilization', sm_used[container_id], tags=container_tags)
+
     def _start_discovery(self):
         """Start daemon thread to discover which k8s pod is assigned to a GPU"""
         # type: () -> None
@@ -166,44 +315,87 @@ class NvmlCheck(AgentCheck):
             self.log.info("No kubelet socket at %s.  Not monitoring k8s pod tags", SOCKET_PATH)
             return
         self.log.info("Monitoring kubelet tags at %s", SOCKET_PATH)
-        self._thread = threading.Thread(target=self.discover_instances, args=(10,), name=self.name, daemon=True)
+        self._thread = threading.Thread(
+            target=self.discover_instances, args=(MIN_REFRESH_INTERVAL, MAX_REFRESH_INTERVAL), name=self.name
+        )
         self._thread.daemon = True
         self._thread.start()
 
-    def discover_instances(self, interval):
+    def discover_instances(self, interval, max_interval):
+        """Refresh the tags every `interval` seconds, doubling the delay up to `max_interval` while pods don't change"""
+        delay = interval
         try:
-            while True:
-                self.refresh_tags()
-                time.sleep(interval)
+            while not self._stop_discovery.is_set():
+                try:
+                    changed = self.refresh_tags()
+                except grpc.RpcError as e:
+                    # Keep the known tags, the kubelet may be restarting
+                    self.log.debug("Unable to list kubelet pod resources: %s", e)
+                    self.close_channel()
+                    changed = False
+                delay = interval if changed else min(delay * 2, max_interval)
+                self._stop_discovery.wait(delay)
         except Exception as ex:
             self.log.error(ex)
         finally:
+            self.close_channel()
             self.log.warning("discover_instances finished.  No longer refreshing instance tags")
 
+    def close_channel(self):
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+            self._stub = None
+
     def get_tags(self, device_id):
         with self.lock:
-            # Note: device ID comes in as bytes, but we get strings from grpc
-            return self.known_tags.get(device_id, self.known_tags.get(device_id.decode("utf-8"), []))
+            return self.known_tags.get(device_id, [])
 
     def refresh_tags(self):
-        channel = grpc.insecure_channel('unix://' + SOCKET_PATH)
-        stub = PodResourcesListerStub(channel)
-        response = stub.List(ListPodResourcesRequest())
-        new_tags = {}
+        """Update the tags of the pods whose resources changed since the last refresh, returns whether any did"""
+        if self._stub is None:
+            self._channel = grpc.insecure_channel('unix://' + SOCKET_PATH)
+            self._stub = PodResourcesListerStub(self._channel)
+        response = self._stub.List(ListPodResourcesRequest(), timeout=LIST_TIMEOUT)
+
+        pods = {}
+        changed = False
         for pod_res in response.pod_resources:
-            for container in pod_res.containers:
-                for device in container.devices:
-                    if device.resource_name != "nvidia.com/gpu":
-                        continue
-                    pod_name = pod_res.name
-                    kube_namespace = pod_res.namespace
-                    kube_container_name = container.name
-                    for device_id in device.device_ids:
-                        # These are the tag names that datadog seems to use
-                        new_tags[device_id] = [
-                            "pod_name:" + pod_name,
-                            "kube_namespace:" + kube_namespace,
-                            "kube_container_name:" + kube_container_name,
-                        ]
+            key = (pod_res.namespace, pod_res.name)
+            resources = pod_res.SerializeToString()
+            known = self._pods.get(key)
+            if known is not None and known[0] == resources:
+                pods[key] = known
+            else:
+                pods[key] = (resources, self.get_pod_tags(pod_res))
+                changed = True
+        if not changed and len(pods) == len(self._pods):
+            return False
+
+        new_tags = {}
+        for _, pod_tags in pods.values():
+            new_tags.update(pod_tags)
+        self._pods = pods
         with self.lock:
             self.known_tags = new_tags
+        return True
+
+    @staticmethod
+    def get_pod_tags(pod_res):
+        """Returns the tags of each GPU of a pod, by device id as both a string and bytes"""
+        pod_tags = {}
+        for container in pod_res.containers:
+            for device in container.devices:
+                if device.resource_name != "nvidia.com/gpu":
+                    continue
+                # These are the tag names that datadog seems to use
+                tags = [
+                    "pod_name:" + pod_res.name,
+                    "kube_namespace:" + pod_res.namespace,
+                    "kube_container_name:" + container.name,
+                ]
+                for device_id in device.device_ids:
+                    # Device ids come as strings from grpc, but NVML gives UUIDs as bytes
+                    pod_tags[device_id] = tags
+                    pod_tags[device_id.encode("utf-8")] = tags
+        return pod_tags
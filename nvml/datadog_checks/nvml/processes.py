@@ -0,0 +1,55 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import os.path
+import re
+
+CONTAINER_ID = re.compile(r'[0-9a-f]{64}')
+"""Container ids as they appear in the cgroup paths of docker, containerd and cri-o"""
+
+
+class ContainerMap(object):
+    """Maps PIDs to the id of the container they run in, read from /proc/<pid>/cgroup.
+
+    Only PIDs not seen on the previous run are looked up, at most `max_lookups` per run, the
+    others are retried on the next run. PIDs that are gone are forgotten.
+    """
+
+    def __init__(self, procfs_path, max_lookups):
+        self.procfs_path = procfs_path
+        self.max_lookups = max_lookups
+        self.containers = {}
+        """By PID, the container id or None for processes running outside of a container"""
+        self.seen = set()
+        self.lookups = 0
+
+    def start_run(self):
+        self.seen = set()
+        self.lookups = 0
+
+    def end_run(self):
+        for pid in set(self.containers) - self.seen:
+            del self.containers[pid]
+
+    def get(self, pid):
+        """Returns the container id of `pid`, or None when it isn't in a container or isn't known yet"""
+        self.seen.add(pid)
+        if pid in self.containers:
+            return self.containers[pid]
+        if self.lookups >= self.max_lookups:
+            return None
+        self.lookups += 1
+
+        container_id = None
+        try:
+            with open(os.path.join(self.procfs_path, str(pid), 'cgroup')) as f:
+                for line in f:
+                    match = CONTAINER_ID.search(line)
+                    if match:
+                        container_id = match.group()
+                        break
+        except (IOError, OSError):
+            # The process exited, or runs in a PID namespace we can't see
+            return None
+        self.containers[pid] = container_id
+        return container_id
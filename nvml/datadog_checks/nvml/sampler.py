@@ -0,0 +1,137 @@
+# (C) Datadog, Inc. 2020-present
+# All rights reserved
+# Licensed under a 3-clause BSD style license (see LICENSE)
+import threading
+import time
+from array import array
+
+import pynvml
+
+SAMPLED_METRICS = ('gpu_utilization', 'mem_copy_utilization', 'power_usage', 'pcie_tx_throughput', 'pcie_rx_throughput')
+"""Metrics sampled in the background, in the order they are stored"""
+
+
+class RingBuffer(object):
+    """Fixed-size buffer of floats keeping the most recent samples"""
+
+    __slots__ = ('values', 'size', 'count', 'position')
+
+    def __init__(self, size):
+        self.values = array('d', [0.0]) * size
+        self.size = size
+        self.count = 0
+        self.position = 0
+
+    def append(self, value):
+        self.values[self.position] = value
+        self.position = (self.position + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def drain(self):
+        """Returns the samples in the buffer, oldest first, and empties it"""
+        start = (self.position - self.count) % self.size
+        if self.count and start >= self.position:
+            samples = self.values[start:] + self.values[: self.position]
+        else:
+            samples = self.values[start : self.position]
+        self.count = 0
+        return samples
+
+
+def summarize(samples):
+    """Returns the min, max, average and 95th percentile of non-empty `samples`"""
+    ordered = sorted(samples)
+    count = len(ordered)
+    p95 = ordered[min(count - 1, int(round(0.95 * (count - 1))))]
+    return ordered[0], ordered[-1], sum(ordered) / count, p95
+
+
+class GpuSampler(object):
+    """Samples bursty GPU metrics in a background thread at `rate` Hz.
+
+    Samples of each GPU are kept in a ring buffer per metric until the check collects them,
+    the buffers keep the most recent `buffer_size` samples.
+    """
+
+    def __init__(self, nvml, rate, buffer_size, log):
+        self.nvml = nvml
+        self.interval = 1.0 / rate
+        self.buffer_size = buffer_size
+        self.log = log
+        self.lock = threading.Lock()
+        self.buffers = []
+        """Per GPU index, a ring buffer per metric of SAMPLED_METRICS"""
+        self.handles = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='nvml-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        # NVML counts its initializations, this one keeps it loaded for the sampler
+        self.nvml.nvmlInit()
+        try:
+            while not self._stop.is_set():
+                started = time.time()
+                try:
+                    self.sample()
+                except pynvml.NVMLError as e:
+                    # Devices may have been reset, resolve them again on the next sample
+                    self.log.debug("Unable to sample GPUs: %s", e)
+                    self.handles = []
+                self._stop.wait(max(0, self.interval - (time.time() - started)))
+        finally:
+            self.nvml.nvmlShutdown()
+
+    def sample(self):
+        """Takes one sample of every metric of every GPU"""
+        nvml = self.nvml
+        if not self.handles:
+            count = nvml.nvmlDeviceGetCount()
+            self.handles = [nvml.nvmlDeviceGetHandleByIndex(i) for i in range(count)]
+            with self.lock:
+                if len(self.buffers) != count:
+                    self.buffers = [[RingBuffer(self.buffer_size) for _ in SAMPLED_METRICS] for _ in range(count)]
+
+        for handle, buffers in zip(self.handles, self.buffers):
+            values = [None] * len(SAMPLED_METRICS)
+            # Not every GPU supports every query, skip the ones that fail
+            try:
+                util = nvml.nvmlDeviceGetUtilizationRates(handle)
+                values[0], values[1] = util.gpu, util.memory
+            except pynvml.NVMLError:
+                pass
+            try:
+                values[2] = nvml.nvmlDeviceGetPowerUsage(handle)
+            except pynvml.NVMLError:
+                pass
+            try:
+                values[3] = nvml.nvmlDeviceGetPcieThroughput(handle, pynvml.NVML_PCIE_UTIL_TX_BYTES)
+                values[4] = nvml.nvmlDeviceGetPcieThroughput(handle, pynvml.NVML_PCIE_UTIL_RX_BYTES)
+            except pynvml.NVMLError:
+                pass
+
+            with self.lock:
+                for buffer, value in zip(buffers, values):
+                    if value is not None:
+                        buffer.append(value)
+
+    def collect(self, index):
+        """Returns (metric, (min, max, avg, p95)) for the samples of GPU `index` taken since the last
+        call, and empties its buffers
+        """
+        with self.lock:
+            if index >= len(self.buffers):
+                return []
+            drained = [buffer.drain() for buffer in self.buffers[index]]
+        return [(metric, summarize(samples)) for metric, samples in zip(SAMPLED_METRICS, drained) if samples]
@@ -1,8 +1,16 @@
 # (C) Datadog, Inc. 2020-present
 # All rights reserved
 # Licensed under a 3-clause BSD style license (see LICENSE)
+import os
+from concurrent import futures
+
+import grpc
+import mock
 import pytest
 
+from datadog_checks.nvml.api_pb2 import ContainerDevices, ContainerResources, ListPodResourcesResponse, PodResources
+from datadog_checks.nvml.api_pb2_grpc import PodResourcesListerServicer, add_PodResourcesListerServicer_to_server
+
 
 @pytest.fixture(scope='session')
 def dd_environment():
@@ -12,3 +20,45 @@ def dd_environment():
 @pytest.fixture
 def instance():
     return {}
+
+
+class FakeKubelet(PodResourcesListerServicer):
+    """Serves the pod resources of `pods`, a list of (namespace, name, {container: [GPU ids]})"""
+
+    def __init__(self):
+        self.pods = []
+        self.requests = 0
+
+    def List(self, request, context):
+        self.requests += 1
+        return ListPodResourcesResponse(
+            pod_resources=[
+                PodResources(
+                    name=name,
+                    namespace=namespace,
+                    containers=[
+                        ContainerResources(
+                            name=container,
+                            devices=[ContainerDevices(resource_name='nvidia.com/gpu', device_ids=device_ids)],
+                        )
+                        for container, device_ids in containers.items()
+                    ],
+                )
+                for namespace, name, containers in self.pods
+            ]
+        )
+
+
+@pytest.fixture
+def kubelet(tmpdir):
+    socket_path = os.path.join(str(tmpdir), 'kubelet.sock')
+    kubelet = FakeKubelet()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    add_PodResourcesListerServicer_to_server(kubelet, server)
+    server.add_insecure_port('unix://' + socket_path)
+    server.start()
+    try:
+        with mock.patch('datadog_checks.nvml.nvml.SOCKET_PATH', socket_path):
+            yield kubelet
+    finally:
+        server.stop(None)
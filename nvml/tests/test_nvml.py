@@ -4,9 +4,12 @@
 from types import SimpleNamespace
 
 import mock
+import pynvml
 import pytest
 
-from datadog_checks.nvml import NvmlCheck
+from datadog_checks.nvml import NvmlCheck, fields
+from datadog_checks.nvml.processes import ContainerMap
+from datadog_checks.nvml.sampler import GpuSampler, RingBuffer
 
 
 class MockNvml:
@@ -87,3 +90,303 @@ def test_check(aggregator, instance):
     aggregator.assert_metric('nvml.power_usage', tags=expected_tags, count=1)
 
     aggregator.assert_all_metrics_covered()
+
+
+@pytest.mark.unit
+def test_ring_buffer():
+    buffer = RingBuffer(3)
+    assert list(buffer.drain()) == []
+    buffer.append(1)
+    buffer.append(2)
+    assert list(buffer.drain()) == [1, 2]
+    for value in range(3, 8):
+        buffer.append(value)
+    # Only the most recent samples are kept, oldest first
+    assert list(buffer.drain()) == [5, 6, 7]
+    assert list(buffer.drain()) == []
+
+
+@pytest.mark.unit
+def test_sampled_metrics(aggregator, instance):
+    instance['sampling_rate'] = 10
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml):
+        check = NvmlCheck('nvml', {}, [instance])
+        with mock.patch.object(GpuSampler, 'start'):
+            check.check(instance)
+        aggregator.reset()
+
+        sampler = check._sampler
+        with mock.patch.object(MockNvml, 'nvmlDeviceGetPowerUsage', side_effect=[10, 30, 20]):
+            for _ in range(3):
+                sampler.sample()
+        check.check(instance)
+        check.cancel()
+
+    expected_tags = ["gpu:0"]
+    aggregator.assert_metric('nvml.power_usage.min', 10, tags=expected_tags, count=1)
+    aggregator.assert_metric('nvml.power_usage.max', 30, tags=expected_tags, count=1)
+    aggregator.assert_metric('nvml.power_usage.avg', 20, tags=expected_tags, count=1)
+    aggregator.assert_metric('nvml.power_usage.p95', 30, tags=expected_tags, count=1)
+    aggregator.assert_metric('nvml.gpu_utilization.max', 2, tags=expected_tags, count=1)
+    aggregator.assert_metric('nvml.pcie_tx_throughput.avg', 11, tags=expected_tags, count=1)
+    assert check._sampler is None
+
+    # The buffers are drained by each run
+    aggregator.reset()
+    assert sampler.collect(0) == []
+
+
+@pytest.mark.unit
+def test_persistent_session(aggregator, instance):
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml):
+        check = NvmlCheck('nvml', {}, [instance])
+        with mock.patch.object(MockNvml, 'nvmlInit') as init, mock.patch.object(
+            MockNvml, 'nvmlShutdown'
+        ) as shutdown, mock.patch.object(MockNvml, 'nvmlDeviceGetHandleByIndex', return_value='test-handle') as handle:
+            check.check(instance)
+            check.check(instance)
+            assert init.call_count == 1
+            assert handle.call_count == 1
+            assert shutdown.call_count == 0
+
+            # A new GPU shows up, the devices are resolved again in the same session
+            with mock.patch.object(MockNvml, 'nvmlDeviceGetCount', return_value=2):
+                check.check(instance)
+            assert init.call_count == 1
+            assert handle.call_count == 3
+
+            check.cancel()
+            assert shutdown.call_count == 1
+
+    aggregator.assert_metric('nvml.fb_total', tags=["gpu:1"], count=1)
+
+
+@pytest.mark.unit
+def test_reset_session(aggregator, instance):
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml):
+        check = NvmlCheck('nvml', {}, [instance])
+        with mock.patch.object(MockNvml, 'nvmlInit') as init, mock.patch.object(MockNvml, 'nvmlShutdown') as shutdown:
+            check.check(instance)
+            lost = pynvml.NVMLError(pynvml.NVML_ERROR_GPU_IS_LOST)
+            with mock.patch.object(MockNvml, 'nvmlDeviceGetMemoryInfo', side_effect=lost):
+                check.check(instance)
+            assert shutdown.call_count == 1
+            assert check._devices == []
+
+            check.check(instance)
+            assert init.call_count == 2
+
+    # Metrics submitted before the error are kept, later ones of that run are skipped
+    aggregator.assert_metric('nvml.gpu_utilization', tags=["gpu:0"], count=3)
+    aggregator.assert_metric('nvml.fb_total', tags=["gpu:0"], count=2)
+
+
+def field_value(field_id, value, nvml_return=pynvml.NVML_SUCCESS):
+    return SimpleNamespace(
+        fieldId=field_id,
+        nvmlReturn=nvml_return,
+        valueType=pynvml.NVML_VALUE_TYPE_UNSIGNED_LONG_LONG,
+        value=SimpleNamespace(ullVal=value),
+    )
+
+
+@pytest.mark.unit
+def test_field_values(aggregator, instance):
+    requested = []
+
+    def get_field_values(handle, field_ids):
+        requested.append(field_ids)
+        values = {fields.NVML_FI_DEV_TOTAL_ENERGY_CONSUMPTION: 13, fields.NVML_FI_DEV_MEMORY_TEMP: 40}
+        return [
+            (
+                field_value(field_id, values[field_id])
+                if field_id in values
+                else field_value(field_id, 0, pynvml.NVML_ERROR_NOT_SUPPORTED)
+            )
+            for field_id in field_ids
+        ]
+
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml):
+        check = NvmlCheck('nvml', {}, [instance])
+        with mock.patch.object(MockNvml, 'nvmlDeviceGetFieldValues', side_effect=get_field_values, create=True):
+            check.check(instance)
+            check.check(instance)
+
+    assert len(requested[0]) == len(fields.FIELD_METRICS)
+    # Unsupported fields are not requested anymore
+    assert requested[1] == [fields.NVML_FI_DEV_TOTAL_ENERGY_CONSUMPTION, fields.NVML_FI_DEV_MEMORY_TEMP]
+
+    expected_tags = ["gpu:0"]
+    aggregator.assert_metric('nvml.memory_temperature', 40, tags=expected_tags, count=2)
+    aggregator.assert_metric('nvml.total_energy_consumption', tags=expected_tags, count=2)
+    # Falls back to nvmlDeviceGetPowerUsage
+    aggregator.assert_metric('nvml.power_usage', 12, tags=expected_tags, count=2)
+    aggregator.assert_metric('nvml.ecc_errors.volatile.single_bit', count=0)
+
+
+@pytest.mark.unit
+def test_field_values_unknown_field(aggregator, instance):
+    requested = []
+
+    def get_field_values(handle, field_ids):
+        requested.append(field_ids)
+        # Drivers predating NVML_FI_DEV_POWER_AVERAGE don't know its id
+        return [
+            (
+                field_value(field_id, 0, pynvml.NVML_ERROR_INVALID_ARGUMENT)
+                if field_id == fields.NVML_FI_DEV_POWER_AVERAGE
+                else field_value(field_id, 13)
+            )
+            for field_id in field_ids
+        ]
+
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml):
+        check = NvmlCheck('nvml', {}, [instance])
+        with mock.patch.object(MockNvml, 'nvmlDeviceGetFieldValues', side_effect=get_field_values, create=True):
+            check.check(instance)
+            check.check(instance)
+
+    assert fields.NVML_FI_DEV_POWER_AVERAGE not in requested[1]
+    # Falls back to nvmlDeviceGetPowerUsage
+    aggregator.assert_metric('nvml.power_usage', 12, tags=["gpu:0"], count=2)
+    aggregator.assert_metric('nvml.total_energy_consumption', tags=["gpu:0"], count=2)
+
+
+@pytest.mark.unit
+def test_field_values_not_found(aggregator, instance):
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml):
+        check = NvmlCheck('nvml', {}, [instance])
+        not_found = pynvml.NVMLError(pynvml.NVML_ERROR_FUNCTION_NOT_FOUND)
+        with mock.patch.object(MockNvml, 'nvmlDeviceGetFieldValues', side_effect=not_found, create=True) as bulk:
+            check.check(instance)
+            check.check(instance)
+        assert bulk.call_count == 1
+
+    aggregator.assert_metric('nvml.power_usage', 12, tags=["gpu:0"], count=2)
+    aggregator.assert_metric('nvml.total_energy_consumption', 8, tags=["gpu:0"], count=2)
+
+
+@pytest.mark.unit
+def test_refresh_tags(aggregator, instance, kubelet):
+    kubelet.pods = [('default', 'train', {'worker': ['test-guid']}), ('default', 'idle', {'main': []})]
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml), mock.patch.object(NvmlCheck, '_start_discovery'):
+        check = NvmlCheck('nvml', {}, [instance])
+        try:
+            assert check.refresh_tags()
+            channel = check._channel
+            check.check(instance)
+
+            expected_tags = ['gpu:0', 'pod_name:train', 'kube_namespace:default', 'kube_container_name:worker']
+            aggregator.assert_metric('nvml.fb_total', tags=expected_tags, count=1)
+            assert check.get_tags('test-guid') == expected_tags[1:]
+            train_tags = check.get_tags(b'test-guid')
+
+            # Unchanged pods keep their tags and the channel is reused
+            kubelet.pods.append(('other', 'serve', {'main': ['other-guid']}))
+            assert check.refresh_tags()
+            assert check.get_tags(b'test-guid') is train_tags
+            assert check.get_tags(b'other-guid') == [
+                'pod_name:serve',
+                'kube_namespace:other',
+                'kube_container_name:main',
+            ]
+            assert not check.refresh_tags()
+            assert check._channel is channel
+            assert kubelet.requests == 3
+
+            del kubelet.pods[0]
+            assert check.refresh_tags()
+            assert check.get_tags(b'test-guid') == []
+        finally:
+            check.close_channel()
+
+
+@pytest.mark.unit
+def test_discovery_backoff(instance, kubelet):
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml), mock.patch.object(NvmlCheck, '_start_discovery'):
+        check = NvmlCheck('nvml', {}, [instance])
+    delays = []
+
+    def wait(delay):
+        delays.append(delay)
+        if len(delays) == 3:
+            kubelet.pods = [('default', 'train', {'worker': ['test-guid']})]
+        return len(delays) == 6
+
+    with mock.patch.object(check._stop_discovery, 'wait', side_effect=wait), mock.patch.object(
+        check._stop_discovery, 'is_set', side_effect=lambda: len(delays) >= 6
+    ):
+        check.discover_instances(1, 4)
+
+    # Backs off while there are no pods, refreshes quickly again once a pod shows up
+    assert delays == [2, 4, 4, 1, 2, 4]
+    assert check._channel is None
+
+
+CONTAINER_1 = 'a' * 64
+CONTAINER_2 = 'b' * 64
+
+
+@pytest.fixture
+def procfs(tmpdir):
+    cgroups = {
+        100: '12:memory:/kubepods/besteffort/pod1234/{}\n'.format(CONTAINER_1),
+        101: '0::/system.slice/docker-{}.scope\n'.format(CONTAINER_1),
+        102: '0::/system.slice/cri-containerd-{}.scope\n'.format(CONTAINER_2),
+        103: '0::/user.slice/user-1000.slice/session-1.scope\n',
+    }
+    for pid, cgroup in cgroups.items():
+        tmpdir.mkdir(str(pid)).join('cgroup').write(cgroup)
+    return str(tmpdir)
+
+
+@pytest.mark.unit
+def test_container_map(procfs):
+    containers = ContainerMap(procfs, 3)
+    containers.start_run()
+    assert [containers.get(pid) for pid in (100, 101, 102, 103)] == [CONTAINER_1, CONTAINER_1, CONTAINER_2, None]
+    containers.end_run()
+    assert set(containers.containers) == {100, 101, 102}
+
+    # Known PIDs don't count as lookups, PIDs that are gone are forgotten
+    containers.start_run()
+    assert [containers.get(pid) for pid in (103, 101, 999)] == [None, CONTAINER_1, None]
+    assert containers.lookups == 2
+    containers.end_run()
+    assert set(containers.containers) == {101, 103}
+
+
+@pytest.mark.unit
+def test_container_processes(aggregator, instance, procfs):
+    instance.update({'collect_processes': True, 'max_processes': 3, 'procfs_path': procfs})
+    processes = [
+        SimpleNamespace(pid=pid, usedGpuMemory=memory)
+        for pid, memory in ((100, 10), (101, 20), (102, 30), (103, 40), (104, 1))
+    ]
+    samples = [
+        SimpleNamespace(pid=101, timeStamp=5, smUtil=7),
+        SimpleNamespace(pid=101, timeStamp=9, smUtil=3),
+        SimpleNamespace(pid=102, timeStamp=8, smUtil=50),
+    ]
+    with mock.patch('datadog_checks.nvml.NvmlCheck.N', MockNvml), mock.patch.object(
+        MockNvml, 'nvmlDeviceGetComputeRunningProcesses', return_value=processes, create=True
+    ), mock.patch.object(MockNvml, 'nvmlDeviceGetProcessUtilization', return_value=samples, create=True) as util:
+        check = NvmlCheck('nvml', {}, [instance])
+        check.check(instance)
+        util.side_effect = pynvml.NVMLError(pynvml.NVML_ERROR_NOT_FOUND)
+        check.check(instance)
+
+    # Only the samples since the previous run are requested
+    assert util.call_args_list == [mock.call('test-handle', 0), mock.call('test-handle', 9)]
+    # PID 100 isn't among the 3 processes using the most memory, PID 103 isn't in a container
+    aggregator.assert_metric(
+        'nvml.container.gpu_memory_used', 20, tags=['gpu:0', 'container_id:' + CONTAINER_1], count=2
+    )
+    aggregator.assert_metric('nvml.container.sm_utilization', 3, tags=['gpu:0', 'container_id:' + CONTAINER_1], count=1)
+    aggregator.assert_metric('nvml.container.sm_utilization', 0, tags=['gpu:0', 'container_id:' + CONTAINER_1], count=1)
+    aggregator.assert_metric(
+        'nvml.container.gpu_memory_used', 30, tags=['gpu:0', 'container_id:' + CONTAINER_2], count=2
+    )
+    aggregator.assert_metric(
+        'nvml.container.sm_utilization', 50, tags=['gpu:0', 'container_id:' + CONTAINER_2], count=1
+    )
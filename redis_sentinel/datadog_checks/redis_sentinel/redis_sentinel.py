@@ -1,17 +1,29 @@
 import time
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 import redis
 
-from datadog_checks.base import AgentCheck, ConfigurationError
+from datadog_checks.base import AgentCheck, ConfigurationError, is_affirmative, to_native_string
+
+from .subscriber import SentinelEventSubscriber, parse_event
 
 EVENT_TYPE = SOURCE_TYPE_NAME = 'redis_sentinel'
+DEFAULT_EVENT_QUEUE_SIZE = 1000
+DEFAULT_TIMEOUT = 5
+DEFAULT_SENTINEL_WORKERS = 4
 
 
 class RedisSentinelCheck(AgentCheck):
     def __init__(self, name, init_config, instances=None):
         super(RedisSentinelCheck, self).__init__(name, init_config, instances)
         self._masters = defaultdict(lambda: "")
+        self._subscriber = None
+        self._connections = {}
+        """Clients by (host, port, password), each keeping its pool of connections open between runs"""
+        self._quorum = set()
+        """(ip, port) of the other sentinels monitoring the masters, as reported on the previous run"""
+        self._pool = None
 
     def _load_config(self, instance):
         host = instance.get('sentinel_host')
@@ -32,21 +44,179 @@ class RedisSentinelCheck(AgentCheck):
 
         host, port, password = self._load_config(instance)
 
-        redis_conn = redis.StrictRedis(host=host, port=port, password=password, db=0)
-
-        for master_name in instance['masters']:
+        timeout = float(instance.get('timeout', DEFAULT_TIMEOUT))
+        redis_conn = self._get_connection(host, port, password, timeout)
+        masters = instance['masters']
+        query_all_sentinels = is_affirmative(instance.get('query_all_sentinels', False))
+
+        if is_affirmative(instance.get('subscribe_events', False)):
+            if self._subscriber is None:
+                queue_size = int(instance.get('event_queue_size', DEFAULT_EVENT_QUEUE_SIZE))
+                self._subscriber = SentinelEventSubscriber(host, port, password, queue_size, self.log)
+                self._subscriber.start()
+            # Before polling, so that failovers already seen as events are not reported again
+            self._process_events(masters, instance.get('tags', []))
+
+        # Ask the other sentinels for their view of the masters while this one is queried
+        views = []
+        if query_all_sentinels and self._quorum:
+            if self._pool is None:
+                self._pool = ThreadPool(int(instance.get('sentinel_workers', DEFAULT_SENTINEL_WORKERS)))
+            for sentinel_host, sentinel_port in sorted(self._quorum):
+                conn = self._get_connection(sentinel_host, sentinel_port, password, timeout)
+                result = self._pool.apply_async(self._get_master_addrs, (conn, masters))
+                views.append(('%s:%s' % (sentinel_host, sentinel_port), result))
+
+        # Send the commands of every master at once and read all the replies, in a single round trip
+        pipeline = redis_conn.pipeline(transaction=False)
+        for master_name in masters:
+            pipeline.sentinel_master(master_name)
+            pipeline.sentinel_slaves(master_name)
+            pipeline.sentinel_sentinels(master_name)
+        try:
+            replies = pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            # Start over with new connections on the next run
+            redis_conn.connection_pool.disconnect()
+            self.warning("Error collecting metrics from sentinel %s:%s: %s", host, port, e)
+            return
+
+        for i, master_name in enumerate(masters):
             base_tags = ['redis_name:%s' % master_name] + instance.get('tags', [])
             try:
-                self._process_instance_master(redis_conn, master_name, base_tags)
+                self._process_instance_master(master_name, base_tags, *replies[3 * i : 3 * i + 3])
             except Exception as e:
                 self.warning("Error collecting metrics for master %s: %s", master_name, e)
 
-    def _process_instance_master(self, redis_conn, master_name, base_tags):
-        master_tags = self._process_master_stats(redis_conn, master_name, base_tags)
-        self._process_slaves_stats(redis_conn, master_name, base_tags, master_tags)
-        self._process_sentinels_stats(redis_conn, master_name, base_tags, master_tags)
+        if query_all_sentinels:
+            self._process_quorum_views(masters, instance.get('tags', []), replies, views)
+            # Close the connections to the sentinels that left the quorum
+            for key in list(self._connections):
+                if key[:2] != (host, port) and key[:2] not in self._quorum:
+                    self._connections.pop(key).connection_pool.disconnect()
+
+    def cancel(self):
+        if self._subscriber is not None:
+            self._subscriber.stop()
+            self._subscriber = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        for conn in self._connections.values():
+            conn.connection_pool.disconnect()
+        self._connections = {}
+
+    def _get_connection(self, host, port, password, timeout):
+        key = (host, port, password)
+        conn = self._connections.get(key)
+        if conn is None:
+            conn = redis.StrictRedis(
+                host=host,
+                port=port,
+                password=password,
+                db=0,
+                socket_timeout=timeout,
+                socket_connect_timeout=timeout,
+                socket_keepalive=True,
+            )
+            self._connections[key] = conn
+        return conn
+
+    @staticmethod
+    def _get_master_addrs(conn, masters):
+        """Returns the (ip, port) of each master according to the sentinel of `conn`, in a single round trip"""
+        pipeline = conn.pipeline(transaction=False)
+        for master_name in masters:
+            pipeline.sentinel_get_master_addr_by_name(master_name)
+        try:
+            return pipeline.execute(raise_on_error=False)
+        except Exception:
+            conn.connection_pool.disconnect()
+            raise
+
+    def _process_quorum_views(self, masters, tags, replies, views):
+        """Compares the address of each master according to every sentinel, to detect a split brain"""
+        sentinel_views = []
+        for name, result in views:
+            try:
+                sentinel_views.append(result.get())
+            except Exception as e:
+                self.log.debug("Unable to get the view of sentinel %s: %s", name, e)
+
+        quorum = set()
+        for i, master_name in enumerate(masters):
+            master_stats, _, sentinels_stats = replies[3 * i : 3 * i + 3]
+            if isinstance(master_stats, Exception) or isinstance(sentinels_stats, Exception):
+                continue
+            for stats in sentinels_stats:
+                if not (stats['is_odown'] or stats['is_sdown']):
+                    quorum.add((stats['ip'], stats['port']))
+
+            addresses = {(master_stats['ip'], master_stats['port'])}
+            for master_addrs in sentinel_views:
+                if master_addrs[i] is not None and not isinstance(master_addrs[i], Exception):
+                    # The ip of the reply is left as bytes, the one of the stats is a native string
+                    ip, master_port = master_addrs[i]
+                    addresses.add((to_native_string(ip), master_port))
+
+            base_tags = ['redis_name:%s' % master_name] + tags
+            self.gauge('redis.sentinel.master_addresses', len(addresses), tags=base_tags)
+            if len(addresses) > 1:
+                message = 'Sentinels disagree on the master address: %s' % ', '.join(
+                    '%s:%s' % address for address in sorted(addresses)
+                )
+                self.service_check('redis.sentinel.split_brain', AgentCheck.CRITICAL, tags=base_tags, message=message)
+            else:
+                self.service_check('redis.sentinel.split_brain', AgentCheck.OK, tags=base_tags)
+        self._quorum = quorum
+
+    def _process_events(self, masters, tags):
+        events, dropped = self._subscriber.drain()
+        if dropped:
+            self.count('redis.sentinel.dropped_events', dropped, tags=tags)
+
+        counts = defaultdict(int)
+        for timestamp, channel, data in events:
+            master_name, details = parse_event(channel, data)
+            if master_name not in masters:
+                continue
+            counts[(master_name, channel)] += 1
+            if channel == '+switch-master' and len(details) >= 3:
+                base_tags = ['redis_name:%s' % master_name] + tags
+                self._report_failover(master_name, details[0], details[2], base_tags, timestamp)
+
+        for (master_name, channel), count in counts.items():
+            self.count(
+                'redis.sentinel.events',
+                count,
+                tags=['redis_name:%s' % master_name, 'sentinel_event:%s' % channel] + tags,
+            )
 
-    def _process_sentinels_stats(self, redis_conn, master_name, base_tags, master_tags):
+    def _report_failover(self, master_name, old_ip, new_ip, base_tags, timestamp):
+        self.increment('redis.sentinel.failover', tags=base_tags)
+        self.event(
+            {
+                'timestamp': timestamp,
+                'event_type': EVENT_TYPE,
+                'msg_title': '%s failover from %s to %s' % (master_name, old_ip, new_ip),
+                'alert_type': 'info',
+                "source_type_name": SOURCE_TYPE_NAME,
+                "event_object": master_name,
+                "tags": base_tags,
+            }
+        )
+        self._masters[master_name] = new_ip
+
+    def _process_instance_master(self, master_name, base_tags, master_stats, slaves_stats, sentinels_stats):
+        # Failed commands come back as the exception in place of their reply
+        for reply in (master_stats, slaves_stats, sentinels_stats):
+            if isinstance(reply, Exception):
+                raise reply
+        master_tags = self._process_master_stats(master_stats, master_name, base_tags)
+        self._process_slaves_stats(slaves_stats, base_tags, master_tags)
+        self._process_sentinels_stats(sentinels_stats, base_tags, master_tags)
+
+    def _process_sentinels_stats(self, sentinels_stats, base_tags, master_tags):
         """
         [{
             'down-after-milliseconds': 5000,
@@ -72,7 +242,6 @@ class RedisSentinelCheck(AgentCheck):
             'voted-leader-epoch': 0,
         }]
         """
-        sentinels_stats = redis_conn.sentinel_sentinels(master_name)
         # sentinel_stats returns stats for other sentinels only
         # so increment once for current sentinel
         self.increment('redis.sentinel.ok_sentinels', tags=master_tags)
@@ -95,7 +264,7 @@ class RedisSentinelCheck(AgentCheck):
             if ok_reply is not None and sent is not None:
                 self.gauge('redis.sentinel.last_ok_ping_latency', reply - ok_reply, sentinel_tags)
 
-    def _process_slaves_stats(self, redis_conn, master_name, base_tags, master_tags):
+    def _process_slaves_stats(self, slaves_stats, base_tags, master_tags):
         """
         [{
             'down-after-milliseconds': 5000,
@@ -126,7 +295,6 @@ class RedisSentinelCheck(AgentCheck):
             'slave-repl-offset': 12345678,
         }]
         """
-        slaves_stats = redis_conn.sentinel_slaves(master_name)
         slaves_odown = 0
         slaves_sdown = 0
 
@@ -160,7 +328,7 @@ class RedisSentinelCheck(AgentCheck):
         self.gauge('redis.sentinel.odown_slaves', slaves_odown, tags=master_tags)
         self.gauge('redis.sentinel.sdown_slaves', slaves_sdown, tags=master_tags)
 
-    def _process_master_stats(self, redis_conn, master_name, base_tags):
+    def _process_master_stats(self, stats, master_name, base_tags):
         """
         {
             'config-epoch': 94,
@@ -191,7 +359,6 @@ class RedisSentinelCheck(AgentCheck):
             'runid': '123456789abcdef',
         }
         """
-        stats = redis_conn.sentinel_master(master_name)
         master_tags = ['master_ip:%s' % stats['ip']] + base_tags
 
         pending = stats.get('link-pending-commands', stats.get('pending-commands'))
@@ -220,19 +387,7 @@ class RedisSentinelCheck(AgentCheck):
 
         if self._masters[master_name] != stats['ip']:
             if self._masters[master_name] != "":  # avoid check initialization
-                self.increment('redis.sentinel.failover', tags=base_tags)
-                self.event(
-                    {
-                        'timestamp': int(time.time()),
-                        'event_type': EVENT_TYPE,
-                        'msg_title': '%s failover from %s to %s'
-                        % (master_name, self._masters[master_name], stats['ip']),
-                        'alert_type': 'info',
-                        "source_type_name": SOURCE_TYPE_NAME,
-                        "event_object": master_name,
-                        "tags": base_tags,
-                    }
-                )
+                self._report_failover(master_name, self._masters[master_name], stats['ip'], base_tags, int(time.time()))
 
             self._masters[master_name] = stats['ip']
 
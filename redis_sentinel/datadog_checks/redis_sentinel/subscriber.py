@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import deque
+
+import redis
+
+EVENT_CHANNELS = ['+switch-master', '+sdown', '-sdown', '+odown', '-odown']
+EVENT_PATTERNS = ['+failover-*']
+MAX_RECONNECT_DELAY = 60
+
+
+def parse_event(channel, data):
+    """
+    Returns the master name of a sentinel event and its details, from payloads like:
+
+        +switch-master: mymaster 10.1.2.3 6379 10.1.2.4 6379
+        +sdown: slave 10.1.2.4:6379 10.1.2.4 6379 @ mymaster 10.1.2.3 6379
+        +odown: master mymaster 10.1.2.3 6379 #quorum 2/2
+    """
+    parts = data.split()
+    if channel == '+switch-master':
+        return parts[0], parts[1:]
+    if '@' in parts:
+        return parts[parts.index('@') + 1], parts
+    if len(parts) > 1 and parts[0] == 'master':
+        return parts[1], parts
+    return None, parts
+
+
+class SentinelEventSubscriber(object):
+    """
+    Listens to the failover related channels of a sentinel in a background thread.
+
+    Events are kept in a queue of at most `queue_size` events until the check drains them,
+    the oldest ones are dropped when the queue is full.
+    """
+
+    def __init__(self, host, port, password, queue_size, log):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.log = log
+        self.events = deque(maxlen=queue_size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='redis-sentinel-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        delay = 1
+        while not self._stop.is_set():
+            pubsub = None
+            try:
+                conn = redis.StrictRedis(host=self.host, port=self.port, password=self.password, decode_responses=True)
+                pubsub = conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(*EVENT_CHANNELS)
+                pubsub.psubscribe(*EVENT_PATTERNS)
+                delay = 1
+                while not self._stop.is_set():
+                    message = pubsub.get_message(timeout=1)
+                    if message is not None:
+                        self.add(message['channel'], message['data'])
+            except redis.RedisError as e:
+                self.log.debug("Lost the subscription to sentinel %s:%s events: %s", self.host, self.port, e)
+                # Events sent while disconnected are lost, the check's polling still detects the failovers
+                self._stop.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+    def add(self, channel, data):
+        with self.lock:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append((int(time.time()), channel, data))
+
+    def drain(self):
+        """Returns the buffered (timestamp, channel, data) events and the number dropped since the last call"""
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+            dropped, self.dropped = self.dropped, 0
+        return events, dropped
@@ -1,8 +1,10 @@
 import mock
 import pytest
+import redis
 
 from datadog_checks.base import ConfigurationError
 from datadog_checks.redis_sentinel import RedisSentinelCheck
+from datadog_checks.redis_sentinel.subscriber import SentinelEventSubscriber, parse_event
 
 METRICS = [
     'redis.sentinel.odown_slaves',
@@ -23,6 +25,34 @@ SERVICE_CHECKS = [
 
 CHECK_NAME = 'redis_sentinel'
 
+SENTINEL_COMMANDS = ['SENTINEL MASTER', 'SENTINEL SLAVES', 'SENTINEL SENTINELS']
+
+MASTER_STATS = {
+    'ip': '10.1.2.3',
+    'is_disconnected': False,
+    'is_master_down': False,
+    'num-other-sentinels': 2,
+    'num-slaves': 1,
+    'pending-commands': 0,
+}
+SLAVE_STATS = {
+    'ip': '10.1.2.4',
+    'is_disconnected': False,
+    'is_odown': False,
+    'is_sdown': False,
+    'master-link-status': 'ok',
+    'pending-commands': 0,
+}
+SENTINEL_STATS = {
+    'ip': '10.1.2.5',
+    'is_odown': False,
+    'is_sdown': False,
+    'last-ok-ping-reply': 10,
+    'last-ping-reply': 10,
+    'last-ping-sent': 4,
+    'link-pending-commands': 0,
+}
+
 
 @pytest.mark.unit
 def test_load_config():
@@ -92,8 +122,185 @@ def test_down_slaves(aggregator, instance):
     for _ in range(7):
         sentinel_slaves.append({'is_odown': False, 'is_sdown': True})
 
-    with mock.patch('redis.StrictRedis.sentinel_slaves', return_value=sentinel_slaves):
+    execute = redis.client.BasePipeline.execute
+
+    def execute_with_down_slaves(pipeline, raise_on_error=True):
+        replies = execute(pipeline, raise_on_error)
+        replies[1] = sentinel_slaves
+        return replies
+
+    with mock.patch('redis.client.BasePipeline.execute', execute_with_down_slaves):
         check.check(instance)
 
         aggregator.assert_metric('redis.sentinel.odown_slaves', 5)
         aggregator.assert_metric('redis.sentinel.sdown_slaves', 7)
+
+
+@pytest.mark.unit
+def test_pipelined_commands(aggregator):
+    instance = {'sentinel_host': 'localhost', 'sentinel_port': 26379, 'masters': ['master1', 'master2', 'master3']}
+    check = RedisSentinelCheck(CHECK_NAME, {}, [instance])
+    replies = [MASTER_STATS, [SLAVE_STATS], [SENTINEL_STATS]]
+    replies += [redis.ResponseError('No such master with that name'), [], []]
+    replies += [dict(MASTER_STATS, ip='10.1.2.6'), [SLAVE_STATS], []]
+    commands = []
+
+    def execute(pipeline, raise_on_error=True):
+        commands.extend(args for args, _ in pipeline.command_stack)
+        return replies
+
+    with mock.patch('redis.client.BasePipeline.execute', autospec=True, side_effect=execute) as pipeline_execute:
+        check.check(instance)
+
+    # A single round trip for every command of every master
+    assert pipeline_execute.call_count == 1
+    assert commands == [(command, master) for master in instance['masters'] for command in SENTINEL_COMMANDS]
+
+    assert 'Error collecting metrics for master master2: No such master with that name' in check.warnings
+    aggregator.assert_metric('redis.sentinel.known_slaves', 1, tags=['master_ip:10.1.2.3', 'redis_name:master1'])
+    aggregator.assert_metric('redis.sentinel.known_slaves', 1, tags=['master_ip:10.1.2.6', 'redis_name:master3'])
+    aggregator.assert_metric('redis.sentinel.ok_sentinels', 2, tags=['master_ip:10.1.2.3', 'redis_name:master1'])
+    aggregator.assert_metric('redis.sentinel.ok_sentinels', 1, tags=['master_ip:10.1.2.6', 'redis_name:master3'])
+    aggregator.assert_metric('redis.sentinel.ping_latency', 6, tags=['sentinel_ip:10.1.2.5', 'redis_name:master1'])
+
+
+@pytest.mark.unit
+def test_sentinel_unreachable(aggregator):
+    instance = {'sentinel_host': 'localhost', 'sentinel_port': 26379, 'masters': ['master1', 'master2']}
+    check = RedisSentinelCheck(CHECK_NAME, {}, [instance])
+    with mock.patch('redis.client.BasePipeline.execute', side_effect=redis.ConnectionError('Connection refused')):
+        check.check(instance)
+
+    assert check.warnings == ['Error collecting metrics from sentinel localhost:26379: Connection refused']
+    aggregator.assert_all_metrics_covered()
+
+
+@pytest.mark.unit
+def test_parse_event():
+    assert parse_event('+switch-master', 'mymaster 10.1.2.3 6379 10.1.2.4 6379') == (
+        'mymaster',
+        ['10.1.2.3', '6379', '10.1.2.4', '6379'],
+    )
+    assert parse_event('+sdown', 'slave 10.1.2.4:6379 10.1.2.4 6379 @ mymaster 10.1.2.3 6379')[0] == 'mymaster'
+    assert parse_event('+odown', 'master mymaster 10.1.2.3 6379 #quorum 2/2')[0] == 'mymaster'
+    assert parse_event('+failover-end', 'master mymaster 10.1.2.3 6379')[0] == 'mymaster'
+
+
+@pytest.mark.unit
+def test_subscribed_events(aggregator):
+    instance = {
+        'sentinel_host': 'localhost',
+        'sentinel_port': 26379,
+        'masters': ['master1'],
+        'subscribe_events': True,
+        'event_queue_size': 4,
+        'tags': ['team:test'],
+    }
+    check = RedisSentinelCheck(CHECK_NAME, {}, [instance])
+    replies = [MASTER_STATS, [], []]
+    with mock.patch.object(SentinelEventSubscriber, 'start'), mock.patch(
+        'redis.client.BasePipeline.execute', return_value=replies
+    ):
+        check.check(instance)
+        subscriber = check._subscriber
+        # Failover and failback between two runs
+        subscriber.add('+sdown', 'master master1 10.1.2.3 6379')
+        subscriber.add('+odown', 'master master1 10.1.2.3 6379 #quorum 2/2')
+        subscriber.add('+switch-master', 'master1 10.1.2.3 6379 10.1.2.4 6379')
+        subscriber.add('+switch-master', 'other 10.1.3.3 6379 10.1.3.4 6379')
+        subscriber.add('+switch-master', 'master1 10.1.2.4 6379 10.1.2.3 6379')
+        check.check(instance)
+        check.cancel()
+
+    base_tags = ['redis_name:master1', 'team:test']
+    aggregator.assert_metric('redis.sentinel.dropped_events', 1, tags=['team:test'])
+    # The first +sdown was dropped from the full queue
+    aggregator.assert_metric(
+        'redis.sentinel.events', count=0, tags=['redis_name:master1', 'sentinel_event:+sdown', 'team:test']
+    )
+    aggregator.assert_metric(
+        'redis.sentinel.events', 1, tags=['redis_name:master1', 'sentinel_event:+odown', 'team:test']
+    )
+    aggregator.assert_metric(
+        'redis.sentinel.events', 2, tags=['redis_name:master1', 'sentinel_event:+switch-master', 'team:test']
+    )
+    # Both switches are reported, and the poll seeing the original master again doesn't report a third one
+    aggregator.assert_metric('redis.sentinel.failover', count=2, tags=base_tags)
+    assert [e['msg_title'] for e in aggregator.events] == [
+        'master1 failover from 10.1.2.3 to 10.1.2.4',
+        'master1 failover from 10.1.2.4 to 10.1.2.3',
+    ]
+    assert check._subscriber is None
+
+
+@pytest.mark.unit
+def test_persistent_connection(aggregator):
+    instance = {'sentinel_host': 'localhost', 'sentinel_port': 26379, 'masters': ['master1']}
+    check = RedisSentinelCheck(CHECK_NAME, {}, [instance])
+    with mock.patch('redis.client.BasePipeline.execute', return_value=[MASTER_STATS, [], []]):
+        check.check(instance)
+        conn = check._connections[('localhost', 26379, None)]
+        check.check(instance)
+        assert list(check._connections.values()) == [conn]
+
+    # The connections are dropped after an error, and reopened on the next run
+    with mock.patch('redis.client.BasePipeline.execute', side_effect=redis.ConnectionError('Connection reset')):
+        with mock.patch.object(conn.connection_pool, 'disconnect') as disconnect:
+            check.check(instance)
+    assert disconnect.call_count == 1
+
+    with mock.patch.object(conn.connection_pool, 'disconnect') as disconnect:
+        check.cancel()
+    assert disconnect.call_count == 1
+    assert check._connections == {}
+
+
+@pytest.mark.unit
+def test_split_brain(aggregator):
+    instance = {
+        'sentinel_host': 'localhost',
+        'sentinel_port': 26379,
+        'masters': ['master1', 'master2'],
+        'query_all_sentinels': True,
+    }
+    check = RedisSentinelCheck(CHECK_NAME, {}, [instance])
+    sentinels = [dict(SENTINEL_STATS, port=26379), dict(SENTINEL_STATS, ip='10.1.2.6', port=26379, is_sdown=True)]
+    replies = [dict(MASTER_STATS, port=6379), [], sentinels, dict(MASTER_STATS, ip='10.1.2.7', port=6379), [], []]
+    # As parsed by redis-py, which leaves the ip as bytes
+    views = [
+        redis.client.parse_sentinel_get_master([b'10.1.2.3', b'6379']),
+        redis.client.parse_sentinel_get_master([b'10.1.2.8', b'6379']),
+    ]
+
+    with mock.patch('redis.client.BasePipeline.execute', return_value=replies), mock.patch.object(
+        RedisSentinelCheck, '_get_master_addrs', return_value=views
+    ) as get_master_addrs:
+        # The first run only learns the other sentinels
+        check.check(instance)
+        assert get_master_addrs.call_count == 0
+        aggregator.assert_service_check('redis.sentinel.split_brain', RedisSentinelCheck.OK, count=2)
+        aggregator.reset()
+
+        check.check(instance)
+
+    # Only the sentinel that isn't down is asked
+    assert get_master_addrs.call_count == 1
+    aggregator.assert_metric('redis.sentinel.master_addresses', 1, tags=['redis_name:master1'])
+    aggregator.assert_service_check('redis.sentinel.split_brain', RedisSentinelCheck.OK, tags=['redis_name:master1'])
+    aggregator.assert_metric('redis.sentinel.master_addresses', 2, tags=['redis_name:master2'])
+    aggregator.assert_service_check(
+        'redis.sentinel.split_brain',
+        RedisSentinelCheck.CRITICAL,
+        tags=['redis_name:master2'],
+        message='Sentinels disagree on the master address: 10.1.2.7:6379, 10.1.2.8:6379',
+    )
+    assert sorted(check._connections) == [('10.1.2.5', 26379, None), ('localhost', 26379, None)]
+
+    # The other sentinel left, its connection is closed
+    replies[2] = []
+    with mock.patch('redis.client.BasePipeline.execute', return_value=replies), mock.patch.object(
+        RedisSentinelCheck, '_get_master_addrs', return_value=views
+    ):
+        check.check(instance)
+    assert sorted(check._connections) == [('localhost', 26379, None)]
+    check.cancel()
@@ -1,17 +1,87 @@
 import os
 import re
+import subprocess
+import tempfile
+from array import array
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
+from datadog_checks.base import is_affirmative
 from datadog_checks.base.checks import NetworkCheck, Status
-from datadog_checks.base.utils.subprocess_output import get_subprocess_output
 
 EVENT_TYPE = SOURCE_TYPE_NAME = 'snmpwalk'
 
+UNSIGNED_TYPES = frozenset(
+    ('Counter32', 'Counter64', 'ZeroBasedCounter64', 'CounterBasedGauge64', 'Gauge32', 'Unsigned32')
+)
+SIGNED_TYPES = frozenset(('Integer32',))
+INTEGER_TYPES = UNSIGNED_TYPES | SIGNED_TYPES
+
+# Array typecodes of the integer types, Python 2 has none for 64-bit integers and keeps them in lists
+INTEGER_TYPECODES = {}
+try:
+    array('Q')
+except ValueError:
+    pass
+else:
+    INTEGER_TYPECODES.update(dict.fromkeys(UNSIGNED_TYPES, 'Q'))
+    INTEGER_TYPECODES.update(dict.fromkeys(SIGNED_TYPES, 'q'))
+
 
 class BinaryUnavailable(Exception):
     pass
 
 
+class Column(object):
+    """Values of one symbol along with the index of the row they belong to.
+
+    Numeric values are kept in arrays so that large tables don't cost an object per sample.
+    """
+
+    __slots__ = ('type', 'indexes', 'values')
+
+    def __init__(self, typ):
+        self.type = typ
+        self.indexes = array('L')
+        typecode = INTEGER_TYPECODES.get(typ)
+        if typecode is not None:
+            self.values = array(typecode)
+        else:
+            # INTEGER values may be enums, e.g. up(1)
+            self.values = []
+
+    def append(self, index, value):
+        if value == '':
+            # No value, ignore
+            return
+        if self.type == 'INTEGER':
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+        elif self.type in INTEGER_TYPES:
+            try:
+                value = int(value)
+            except ValueError:
+                return
+        self.indexes.append(index)
+        self.values.append(value)
+
+    def items(self):
+        return zip(self.indexes, self.values)
+
+    def update(self, other):
+        """Adds the rows of `other`, its values replacing those of the rows both columns have"""
+        positions = {index: position for position, index in enumerate(self.indexes)}
+        for index, value in other.items():
+            position = positions.get(index)
+            if position is None:
+                self.indexes.append(index)
+                self.values.append(value)
+            else:
+                self.values[position] = value
+
+
 class SnmpwalkCheck(NetworkCheck):
     """
     This is a work-alike for checks.d/snmp.py that makes use of snmpwalk for
@@ -26,6 +96,10 @@ class SnmpwalkCheck(NetworkCheck):
     DEFAULT_SNMPWALK_PATH = '/usr/bin/snmpwalk'
     DEFAULT_RETRIES = 2
     DEFAULT_TIMEOUT = 1
+    DEFAULT_CONCURRENT_WALKS = 4
+    SNMPBULKWALK = 'snmpbulkwalk'
+    DEFAULT_MAX_REPETITIONS = 10
+    DEFAULT_NON_REPEATERS = 0
     COUNTER_TYPES = frozenset(('Counter32', 'Counter64', 'ZeroBasedCounter64'))
     GAUGE_TYPES = frozenset(('Gauge32', 'Unsigned32', 'CounterBasedGauge64', 'INTEGER', 'Integer32'))
     SC_NAME = '{}.can_check'.format(SOURCE_TYPE_NAME)
@@ -39,6 +113,14 @@ class SnmpwalkCheck(NetworkCheck):
         if os.path.isfile(self.expected_bin):
             self.binary = self.expected_bin
 
+        # snmpbulkwalk ships with snmpwalk in net-snmp, look for it next to it by default
+        self.bulk_binary = None
+        self.expected_bulk_bin = init_config.get(
+            'bulk_binary', os.path.join(os.path.dirname(self.expected_bin), self.SNMPBULKWALK)
+        )
+        if os.path.isfile(self.expected_bulk_bin):
+            self.bulk_binary = self.expected_bulk_bin
+
         self.mib_dirs = init_config.get('mibs_folder')
 
         if instances is not None:
@@ -77,46 +159,69 @@ class SnmpwalkCheck(NetworkCheck):
         retries = int(instance.get('retries', self.DEFAULT_RETRIES))
 
         hostname = instance.get('metric_host', None)
+        concurrent_walks = int(instance.get('concurrent_walks', self.DEFAULT_CONCURRENT_WALKS))
 
-        # Build up our dataset
-        data = defaultdict(dict)
-        types = {}
+        # GETBULK doesn't exist in SNMP v1
+        snmp_version = int(instance.get('snmp_version', 2))
+        bulk_walk = is_affirmative(instance.get('bulk_walk', False)) and snmp_version != 1
+        if bulk_walk and not self.bulk_binary:
+            self.log.warning('Cannot find executable: %s, falling back to snmpwalk', self.expected_bulk_bin)
+            bulk_walk = False
+
+        if bulk_walk:
+            base_cmd = [
+                self.bulk_binary,
+                '-c{}'.format(community_string),
+                '-v2c',
+                '-Cr{}'.format(int(instance.get('max_repetitions', self.DEFAULT_MAX_REPETITIONS))),
+                '-Cn{}'.format(int(instance.get('non_repeaters', self.DEFAULT_NON_REPEATERS))),
+            ]
+        else:
+            version = '-v1' if snmp_version == 1 else '-v2c'
+            base_cmd = [self.binary, '-c{}'.format(community_string), version]
+        base_cmd.extend(['-t', str(timeout), '-r', str(retries)])
+
+        cmds = []
         for metric in metrics:
-            mib = metric['MIB']
-            table = metric['table']
-            cmd = [self.binary, '-c{}'.format(community_string), '-v2c', '-t', str(timeout), '-r', str(retries)]
+            # Both tools print the same output, so it goes through the same parser
+            cmd = list(base_cmd)
             if self.mib_dirs:
                 cmd.extend(['-M', self.mib_dirs])
-            cmd.extend([ip_address, '{}:{}'.format(mib, table)])
+            cmd.extend([ip_address, '{}:{}'.format(metric['MIB'], metric['table'])])
+            cmds.append(cmd)
 
+        # Walk all the tables of the device at once, each walk is mostly spent
+        # waiting on the device.
+        if concurrent_walks > 1 and len(cmds) > 1:
+            pool = ThreadPool(min(concurrent_walks, len(cmds)))
             try:
-                output = get_subprocess_output(cmd, self.log)[0]
-            except Exception as e:
-                error = "Fail to collect metrics for {0} - {1}".format(instance['name'], e)
-                self.log.warning(error)
-                return [(self.SC_NAME, Status.CRITICAL, error)]
+                results = pool.map(self._walk_table, cmds)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._walk_table(cmd) for cmd in cmds]
 
-            for line in output.splitlines():
-                if not line:
-                    continue
-                match = self.output_re.match(line)
-                if match is not None:
-                    symbol = match.group('symbol')
-                    index = int(match.group('index'))
-                    value = match.group('value')
-                    typ = match.group('type')
-                    types[symbol] = typ
-                    if typ == 'INTEGER':
-                        try:
-                            value = int(value)
-                        except ValueError:
-                            pass
-                    elif value == '':
-                        value = None
-                    data[symbol][index] = value
+        # Build up our dataset, a column of values per symbol
+        columns = {}
+        errors = []
+        for metric, (table_columns, error) in zip(metrics, results):
+            if error is not None:
+                error = "Fail to collect {0}:{1} metrics for {2} - {3}".format(
+                    metric['MIB'], metric['table'], instance['name'], error
+                )
+                self.log.warning(error)
+                errors.append(error)
+                continue
+            # A symbol may be walked by several tables, merge its rows
+            for symbol, column in table_columns.items():
+                if symbol in columns:
+                    columns[symbol].update(column)
                 else:
-                    # TODO: remove this
-                    self.log.warning('Problem parsing output of snmp walk: %s', line)
+                    columns[symbol] = column
+
+        if errors and len(errors) == len(cmds):
+            return [(self.SC_NAME, Status.CRITICAL, '\n'.join(errors))]
 
         # Get any base configured tags and add our primary tag
         tags = instance.get('tags', []) + ['snmp_device:{}'.format(ip_address)]
@@ -137,22 +242,21 @@ class SnmpwalkCheck(NetworkCheck):
             for metric_tag in metric.get('metric_tags', []):
                 if 'column' in metric_tag:
                     tag = metric_tag['tag']
-                    column = metric_tag['column']
+                    column = columns.get(metric_tag['column'])
+                    if column is None:
+                        continue
                     regex = metric_tag.get('regex', None)
                     if regex is not None:
                         # pre-compile our regex
                         regex = re.compile(regex)
-                    for i, v in data[column].items():
-                        if v is None:
-                            # No value for the column, ignore
-                            continue
-                        elif types[column] == 'INTEGER':
+                    for i, v in column.items():
+                        if column.type == 'INTEGER':
                             # enum/bool etc, use the human readable name
-                            v = v.split('(')[0]
+                            v = str(v).split('(')[0]
 
                         if regex is not None:
                             # There's a regex for this tag
-                            match = regex.match(v)
+                            match = regex.match(str(v))
                             if match is not None:
                                 # It matches so we'll apply it, group(1) becomes
                                 # the value
@@ -168,28 +272,90 @@ class SnmpwalkCheck(NetworkCheck):
                     self.log.debug('unsupported metric_tag: %s', metric_tag)
                     continue
 
+            # Build the complete tag list of each row once, rows with the same
+            # dynamic tags share the same list
+            interned = {}
+            row_tags = {}
+            for i, index_tags in dynamic_tags.items():
+                key = tuple(index_tags)
+                tag_list = interned.get(key)
+                if tag_list is None:
+                    tag_list = interned[key] = tags + index_tags
+                row_tags[i] = tag_list
+
             symbols = metric.get('symbols', [])
             # For each of the symbols we'll be recording as a metric
             for symbol in symbols:
+                column = columns.get(symbol)
+                if column is None:
+                    continue
+
+                # metric key
+                key = '{}.{}'.format(SOURCE_TYPE_NAME, symbol)
+                typ = column.type
+                if typ in self.COUNTER_TYPES:
+                    submit = self.rate
+                elif typ in self.GAUGE_TYPES:
+                    submit = self.gauge
+                else:
+                    raise Exception('unsupported metric symbol type: {}'.format(typ))
+
                 # For each value for that symbol
-                for i, value in data[symbol].items():
-                    if value is None:
-                        # skip empty
-                        continue
-                    # metric key
-                    key = '{}.{}'.format(SOURCE_TYPE_NAME, symbol)
-                    value = int(value)
-
-                    typ = types[symbol]
-                    if typ in self.COUNTER_TYPES:
-                        self.rate(key, value, tags + dynamic_tags[i], hostname=hostname)
-                    elif typ in self.GAUGE_TYPES:
-                        self.gauge(key, value, tags + dynamic_tags[i], hostname=hostname)
-                    else:
-                        raise Exception('unsupported metric symbol type: {}'.format(typ))
+                for i, value in column.items():
+                    submit(key, int(value), row_tags.get(i, tags), hostname=hostname)
 
+        if errors:
+            return [(self.SC_NAME, Status.WARNING, '\n'.join(errors))]
         return [(self.SC_NAME, Status.UP, None)]
 
+    def _walk_table(self, cmd):
+        """Runs snmpwalk for a single table and returns a tuple (columns, error)"""
+        columns = {}
+        # snmpwalk doesn't write much to stderr, but don't risk blocking on a full pipe
+        # while we are reading stdout
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+            except Exception as e:
+                return columns, e
+
+            # Parse the rows as they come in rather than buffering the whole walk
+            empty = True
+            try:
+                with proc.stdout:
+                    for raw_line in proc.stdout:
+                        # Devices don't always send UTF-8, e.g. in the interface aliases
+                        line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+                        if not line:
+                            continue
+                        empty = False
+                        match = self.output_re.match(line)
+                        if match is not None:
+                            symbol = match.group('symbol')
+                            column = columns.get(symbol)
+                            if column is None:
+                                column = columns[symbol] = Column(match.group('type'))
+                            column.append(int(match.group('index')), match.group('value'))
+                        else:
+                            # TODO: remove this
+                            self.log.warning('Problem parsing output of snmp walk: %s', line)
+                returncode = proc.wait()
+            except Exception as e:
+                return columns, e
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    proc.wait()
+
+            if empty:
+                stderr.seek(0)
+                err = stderr.read().decode('utf-8', 'replace').strip()
+                return columns, Exception(
+                    'no output from {}, return code: {}{}'.format(cmd, returncode, ', stderr: ' + err if err else '')
+                )
+
+        return columns, None
+
     def report_as_service_check(self, sc_name, status, instance, msg=None):
         sc_tags = ['snmp_device:{0}'.format(instance['name'])]
         custom_tags = instance.get('tags', [])
@@ -2,3 +2,4 @@ import os
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 DOCKER_DIR = os.path.join(HERE, 'docker')
+FAKE_SNMPWALK = os.path.join(HERE, 'fixtures', 'snmpwalk')
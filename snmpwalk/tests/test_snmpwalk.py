@@ -3,10 +3,12 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 import os
+import time
 
-from datadog_checks.snmpwalk import SnmpwalkCheck
+from datadog_checks.snmpwalk import SnmpwalkCheck, snmpwalk
+from datadog_checks.snmpwalk.snmpwalk import Column
 
-from .common import HERE
+from .common import FAKE_SNMPWALK, HERE
 
 RESULTS_TIMEOUT = 10
 
@@ -74,3 +76,211 @@ def test_unavailable_binary(caplog):
     check.check(instance)
 
     assert 'Cannot find executable: /path/to/nonexistent/snmpwalk' in caplog.text
+
+
+IF_TABLES = [
+    {
+        'MIB': "IF-MIB",
+        'table': "ifTable",
+        'symbols': ["ifInOctets", "ifOutOctets"],
+        'metric_tags': [{'tag': "interface", 'column': "ifDescr"}, {'tag': "type", 'column': "ifType"}],
+    },
+    {
+        'MIB': "IF-MIB",
+        'table': "ifXTable",
+        'symbols': ["ifHCInOctets", "ifHighSpeed"],
+        'metric_tags': [{'tag': "interface", 'column': "ifName"}, {'tag': "alias", 'column': "ifAlias"}],
+    },
+]
+
+
+def test_concurrent_walks(aggregator, monkeypatch):
+    monkeypatch.setenv('SNMPWALK_DELAY', '0.5')
+    instance = generate_instance_config({'ip_address': 'localhost', 'tags': ['foo:bar']}, IF_TABLES * 2)
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK}, {})
+
+    start = time.time()
+    check.check(instance)
+    # The four walks run at the same time
+    assert time.time() - start < 1.5
+
+    tags = ['foo:bar', 'snmp_device:localhost']
+    for metric_type, symbol, value, index_tags in (
+        ('rate', 'ifInOctets', 41384, ['interface:lo', 'type:softwareLoopback']),
+        ('rate', 'ifInOctets', 1802135, ['interface:eth0', 'type:ethernetCsmacd']),
+        ('rate', 'ifOutOctets', 41384, ['interface:lo', 'type:softwareLoopback']),
+        ('rate', 'ifOutOctets', 52380, ['interface:eth0', 'type:ethernetCsmacd']),
+        ('rate', 'ifHCInOctets', 41384, ['interface:lo']),
+        ('rate', 'ifHCInOctets', 1802135, ['interface:eth0', 'alias:uplink']),
+        ('gauge', 'ifHighSpeed', 10, ['interface:lo']),
+        ('gauge', 'ifHighSpeed', 10000, ['interface:eth0', 'alias:uplink']),
+    ):
+        aggregator.assert_metric(
+            '{}.{}'.format(CHECK_NAME, symbol),
+            metric_type=getattr(aggregator, metric_type.upper()),
+            value=value,
+            tags=tags + index_tags,
+            count=2,
+        )
+    aggregator.assert_all_metrics_covered()
+    aggregator.assert_service_check('{}.can_check'.format(CHECK_NAME), status=SnmpwalkCheck.OK, count=1)
+
+
+def test_failed_walk_keeps_other_tables(aggregator):
+    tables = IF_TABLES + [{'MIB': "IP-MIB", 'table': "ipSystemStatsTable", 'symbols': ["ipSystemStatsInReceives"]}]
+    instance = generate_instance_config({'ip_address': 'localhost'}, tables)
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK}, {})
+    check.check(instance)
+
+    aggregator.assert_metric('{}.ifInOctets'.format(CHECK_NAME), count=2)
+    aggregator.assert_metric('{}.ifHighSpeed'.format(CHECK_NAME), count=2)
+    aggregator.assert_metric('{}.ipSystemStatsInReceives'.format(CHECK_NAME), count=0)
+    aggregator.assert_service_check('{}.can_check'.format(CHECK_NAME), status=SnmpwalkCheck.WARNING, count=1)
+    assert 'IP-MIB:ipSystemStatsTable' in aggregator.service_checks('{}.can_check'.format(CHECK_NAME))[0].message
+
+
+def test_all_walks_failed(aggregator):
+    tables = [{'MIB': "IP-MIB", 'table': "ipSystemStatsTable", 'symbols': ["ipSystemStatsInReceives"]}]
+    instance = generate_instance_config({'ip_address': 'localhost'}, tables)
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK}, {})
+    check.check(instance)
+
+    aggregator.assert_all_metrics_covered()
+    aggregator.assert_service_check('{}.can_check'.format(CHECK_NAME), status=SnmpwalkCheck.CRITICAL, count=1)
+
+
+def read_walks(path):
+    with open(path) as f:
+        return sorted(f.read().splitlines())
+
+
+def test_bulk_walk(aggregator, monkeypatch, tmp_path):
+    log = str(tmp_path / 'walks.log')
+    monkeypatch.setenv('SNMPWALK_LOG', log)
+    instance = generate_instance_config(
+        {'ip_address': 'localhost', 'bulk_walk': True, 'max_repetitions': 50, 'non_repeaters': 1}, IF_TABLES
+    )
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK}, {})
+    check.check(instance)
+
+    assert read_walks(log) == [
+        'snmpbulkwalk -cpublic -v2c -Cr50 -Cn1 -t 1 -r 2 localhost IF-MIB:ifTable',
+        'snmpbulkwalk -cpublic -v2c -Cr50 -Cn1 -t 1 -r 2 localhost IF-MIB:ifXTable',
+    ]
+    aggregator.assert_metric('{}.ifInOctets'.format(CHECK_NAME), count=2)
+    aggregator.assert_metric('{}.ifHighSpeed'.format(CHECK_NAME), count=2)
+    aggregator.assert_service_check('{}.can_check'.format(CHECK_NAME), status=SnmpwalkCheck.OK, count=1)
+
+
+def test_bulk_walk_snmp_v1(aggregator, monkeypatch, tmp_path):
+    log = str(tmp_path / 'walks.log')
+    monkeypatch.setenv('SNMPWALK_LOG', log)
+    instance = generate_instance_config({'ip_address': 'localhost', 'bulk_walk': True, 'snmp_version': 1}, IF_TABLES)
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK}, {})
+    check.check(instance)
+
+    assert read_walks(log) == [
+        'snmpwalk -cpublic -v1 -t 1 -r 2 localhost IF-MIB:ifTable',
+        'snmpwalk -cpublic -v1 -t 1 -r 2 localhost IF-MIB:ifXTable',
+    ]
+    aggregator.assert_metric('{}.ifInOctets'.format(CHECK_NAME), count=2)
+
+
+def test_bulk_walk_unavailable_binary(aggregator, monkeypatch, tmp_path):
+    log = str(tmp_path / 'walks.log')
+    monkeypatch.setenv('SNMPWALK_LOG', log)
+    instance = generate_instance_config({'ip_address': 'localhost', 'bulk_walk': True}, IF_TABLES[:1])
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK, 'bulk_binary': '/path/to/nonexistent'}, {})
+    check.check(instance)
+
+    assert read_walks(log) == ['snmpwalk -cpublic -v2c -t 1 -r 2 localhost IF-MIB:ifTable']
+    aggregator.assert_metric('{}.ifInOctets'.format(CHECK_NAME), count=2)
+
+
+def test_column():
+    counters = Column('Counter64')
+    for i in range(50000):
+        counters.append(i + 1, str(2**64 - 1 - i))
+    counters.append(50001, '')
+    assert counters.values.typecode == 'Q'
+    assert len(counters.values) == len(counters.indexes) == 50000
+    assert next(iter(counters.items())) == (1, 2**64 - 1)
+
+    merged = Column('Counter32')
+    merged.append(1, '10')
+    merged.append(2, '20')
+    other = Column('Counter32')
+    other.append(2, '25')
+    other.append(3, '30')
+    merged.update(other)
+    assert list(merged.items()) == [(1, 10), (2, 25), (3, 30)]
+
+    enums = Column('INTEGER')
+    enums.append(1, 'up(1)')
+    enums.append(2, '1500')
+    assert list(enums.items()) == [(1, 'up(1)'), (2, 1500)]
+
+
+def test_column_without_64_bit_arrays(monkeypatch):
+    # As on Python 2, which has no typecode for 64-bit integers
+    monkeypatch.setattr(snmpwalk, 'INTEGER_TYPECODES', {})
+    counters = Column('Counter64')
+    counters.append(1, str(2**64 - 1))
+    counters.append(2, 'garbage')
+    counters.append(3, '42')
+    assert list(counters.items()) == [(1, 2**64 - 1), (3, 42)]
+
+
+def test_walk_not_utf8(aggregator):
+    tables = [
+        IF_TABLES[0],
+        {
+            'MIB': "IF-MIB",
+            'table': "ifXEntry",
+            'symbols': ["ifHCInOctets"],
+            'metric_tags': [{'tag': "alias", 'column': "ifAlias"}],
+        },
+    ]
+    instance = generate_instance_config({'ip_address': 'localhost'}, tables)
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK}, {})
+    check.check(instance)
+
+    aggregator.assert_metric('{}.ifInOctets'.format(CHECK_NAME), count=2)
+    aggregator.assert_metric(
+        '{}.ifHCInOctets'.format(CHECK_NAME), value=1802135, tags=['snmp_device:localhost', u'alias:caf\ufffd']
+    )
+    aggregator.assert_service_check('{}.can_check'.format(CHECK_NAME), status=SnmpwalkCheck.OK, count=1)
+
+
+def test_regex_tag_on_numeric_column(aggregator):
+    tables = [
+        {
+            'MIB': "IF-MIB",
+            'table': "ifXTable",
+            'symbols': ["ifHCInOctets"],
+            'metric_tags': [
+                {'tag': "speed", 'column': "ifHighSpeed", 'regex': r'(\d+)'},
+                {'tag': "fast", 'column': "ifHighSpeed", 'regex': r'(\d{5,})', 'additional_tags': ['tier:1']},
+            ],
+        }
+    ]
+    instance = generate_instance_config({'ip_address': 'localhost'}, tables)
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK}, {})
+    check.check(instance)
+
+    tags = ['snmp_device:localhost']
+    aggregator.assert_metric('{}.ifHCInOctets'.format(CHECK_NAME), value=41384, tags=tags + ['speed:10'])
+    aggregator.assert_metric(
+        '{}.ifHCInOctets'.format(CHECK_NAME), value=1802135, tags=tags + ['speed:10000', 'fast:10000', 'tier:1']
+    )
+
+
+def test_symbol_walked_by_several_tables(aggregator):
+    tables = [IF_TABLES[0], {'MIB': "IF-MIB", 'table': "ifInOctets.3", 'symbols': ["ifInOctets"]}]
+    instance = generate_instance_config({'ip_address': 'localhost'}, tables)
+    check = SnmpwalkCheck(CHECK_NAME, {'binary': FAKE_SNMPWALK}, {})
+    check.check(instance)
+
+    # The rows of both walks are kept
+    for value in (41384, 1802135, 777):
+        aggregator.assert_metric('{}.ifInOctets'.format(CHECK_NAME), value=value, count=2)
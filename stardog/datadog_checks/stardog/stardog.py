@@ -1,6 +1,7 @@
 import re
+from multiprocessing.pool import ThreadPool
 
-from datadog_checks.base import AgentCheck
+from datadog_checks.base import AgentCheck, ConfigurationError, is_affirmative
 
 EVENT_TYPE = SOURCE_TYPE_NAME = 'stardog'
 
@@ -95,38 +96,129 @@ _g_bd_specific_map = {
 }
 
 
+class MetricMatcher(object):
+    """
+    Matches keys against all the patterns of a metric map with a single regex, an alternation
+    of the patterns in the order of the map, so the first matching pattern wins.
+    """
+
+    def __init__(self, metrics):
+        branches = ['(?P<m{}>{})'.format(i, regex) for i, regex in enumerate(metrics)]
+        # An empty alternation would match every key, there is nothing to match without patterns
+        self.pattern = re.compile('|'.join(branches)) if branches else None
+        # By the index of the group wrapping each pattern: its conversion function and the group
+        # capturing the database name, the first one inside the pattern if it has any
+        self.branches = {}
+        for i, (regex, convert_func) in enumerate(metrics.items()):
+            group = self.pattern.groupindex['m{}'.format(i)]
+            self.branches[group] = (convert_func, group + 1 if re.compile(regex).groups else None)
+
+    def match(self, key):
+        """Returns the conversion function for `key` and the database name it captured, or None"""
+        if self.pattern is None:
+            return None
+        m = self.pattern.match(key)
+        if m is None:
+            return None
+        # The wrapping group is the last one to close
+        convert_func, db_group = self.branches[m.lastindex]
+        return convert_func, m.group(db_group) if db_group else None
+
+
+def metric_family(regex):
+    """Returns the family of a database specific metric pattern, the first part after the database name"""
+    return regex.split(r'(.*).', 1)[1].split('.', 1)[0]
+
+
+_g_metrics_matcher = MetricMatcher(_g_metrics_map)
+_g_bd_specific_matcher = MetricMatcher(_g_bd_specific_map)
+
+DEFAULT_DATABASE_STATUS_PATH = '/admin/status/{database}'
+
+
 class StardogCheck(AgentCheck):
-    def _process_doc(self, doc, metrics, tags, add_db_tags=False):
+    def __init__(self, name, init_config, instances):
+        super(StardogCheck, self).__init__(name, init_config, instances)
+        instance = self.instance or {}
+        self.databases = instance.get('databases') or []
+        self.database_status_path = instance.get('database_status_path', DEFAULT_DATABASE_STATUS_PATH)
+        self.collect_server_metrics = is_affirmative(instance.get('collect_server_metrics', not self.databases))
+        self.max_concurrent_requests = int(instance.get('max_concurrent_requests', 4))
+        self.bd_matcher = _g_bd_specific_matcher
+        metric_families = instance.get('metric_families')
+        if metric_families:
+            known_families = {metric_family(regex) for regex in _g_bd_specific_map}
+            unknown_families = set(metric_families) - known_families
+            if unknown_families:
+                raise ConfigurationError(
+                    'Unknown metric families: {}, the known ones are: {}'.format(
+                        ', '.join(sorted(unknown_families)), ', '.join(sorted(known_families))
+                    )
+                )
+            self.bd_matcher = MetricMatcher(
+                {regex: func for regex, func in _g_bd_specific_map.items() if metric_family(regex) in metric_families}
+            )
+        # By matcher and document, the match of every key of the last document, most keys are the
+        # same from one run to the next
+        self._matches = {}
+        self._pool = None
+
+    def get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_concurrent_requests)
+        return self._pool
+
+    def cancel(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _process_doc(self, doc, matcher, tags, add_db_tags=False, doc_id=None):
+        previous_matches = self._matches.get((matcher, doc_id), {})
+        matches = self._matches[(matcher, doc_id)] = {}
+        db_tags = {}
         for k in doc:
-            # find match
-            for regex in metrics:
-                p = re.compile(regex)
-                m = p.match(k)
-                if m is not None:
-                    convert_func = metrics[regex]
-                    local_tags = tags[:]
-                    db_name = None
-                    if add_db_tags:
-                        try:
-                            db_name = m.group(1)
-                            local_tags.append("database:%s" % db_name)
-                        except Exception:
-                            self.log.warning("No database name was found")
-                    values_map = convert_func(k, doc[k], db_name)
-                    for report_key in values_map:
-                        self.log.debug("Sending %s=%s to Datadog", report_key, values_map[report_key])
-                        self.gauge(report_key, values_map[report_key], tags=local_tags)
-                    break
+            if k in previous_matches:
+                match = matches[k] = previous_matches[k]
+            else:
+                match = matches[k] = matcher.match(k)
+            if match is None:
+                continue
+
+            convert_func, db_name = match
+            local_tags = tags
+            if add_db_tags:
+                if db_name is None:
+                    self.log.warning("No database name was found")
+                else:
+                    local_tags = db_tags.get(db_name)
+                    if local_tags is None:
+                        local_tags = db_tags[db_name] = tags + ["database:%s" % db_name]
+            values_map = convert_func(k, doc[k], db_name)
+            for report_key in values_map:
+                self.log.debug("Sending %s=%s to Datadog", report_key, values_map[report_key])
+                self.gauge(report_key, values_map[report_key], tags=local_tags)
+
+    def _get_status(self, path):
+        response = self.http.get(self.instance['stardog_url'] + path)
+        if response.status_code != 200:
+            response.raise_for_status()
+        return response.json()
 
     def check(self, _):
-        try:
-            response = self.http.get(self.instance['stardog_url'] + '/admin/status')
-        except KeyError:
+        if 'stardog_url' not in self.instance:
             raise Exception('The Stardog check instance is not properly configured')
 
-        if response.status_code != 200:
-            response.raise_for_status()
-        json_doc = response.json()
+        # Only the metrics of the configured databases are requested, each from its own endpoint
+        results = [
+            (
+                database,
+                self.get_pool().apply_async(self._get_status, (self.database_status_path.format(database=database),)),
+            )
+            for database in self.databases
+        ]
+        json_doc = self._get_status('/admin/status') if self.collect_server_metrics else None
+
         try:
             tags = self.instance['tags']
             if type(tags) != list:
@@ -135,6 +227,16 @@ class StardogCheck(AgentCheck):
         except KeyError:
             tags = []
 
-        tags.append("stardog_url:%s" % self.instance['stardog_url'])
-        self._process_doc(json_doc, _g_metrics_map, tags)
-        self._process_doc(json_doc, _g_bd_specific_map, tags, add_db_tags=True)
+        tags = tags + ["stardog_url:%s" % self.instance['stardog_url']]
+        if json_doc is not None:
+            self._process_doc(json_doc, _g_metrics_matcher, tags)
+            if not self.databases:
+                self._process_doc(json_doc, self.bd_matcher, tags, add_db_tags=True)
+
+        for database, result in results:
+            try:
+                database_doc = result.get()
+            except Exception as e:
+                self.log.warning("Unable to fetch the metrics of database %s: %s", database, e)
+                continue
+            self._process_doc(database_doc, self.bd_matcher, tags, add_db_tags=True, doc_id=database)
@@ -0,0 +1,27 @@
+import copy
+
+from datadog_checks.stardog import StardogCheck
+from datadog_checks.stardog.stardog import _g_bd_specific_matcher, _g_metrics_matcher
+
+from .test_stardog import DATA, SPEED
+
+
+def test_process_500_databases(benchmark, aggregator):
+    doc = copy.deepcopy(DATA)
+    for i in range(500):
+        doc['databases.db{}.txns.openTransactions'.format(i)] = {'count': 0}
+        doc['databases.db{}.txns.speed'.format(i)] = SPEED
+        doc['databases.db{}.queries.running'.format(i)] = {'count': 1}
+        doc['databases.db{}.queries.speed'.format(i)] = SPEED
+        doc['databases.db{}.openConnections'.format(i)] = {'count': 2}
+        # Keys of no collected metric, which must be ruled out as well
+        doc['databases.db{}.index.size'.format(i)] = {'value': 1000}
+        doc['databases.db{}.planCache.size'.format(i)] = {'value': 3}
+
+    check = StardogCheck('stardog', {}, [{'stardog_url': 'http://localhost:5820'}])
+
+    def process():
+        check._process_doc(doc, _g_metrics_matcher, ['foo:bar'])
+        check._process_doc(doc, _g_bd_specific_matcher, ['foo:bar'], add_db_tags=True)
+
+    benchmark(process)
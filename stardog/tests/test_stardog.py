@@ -1,12 +1,16 @@
 import copy
 import json
 import threading
+from collections import OrderedDict
 
+import mock
+import pytest
 import requests
 from six import PY3
 
-from datadog_checks.base import ensure_bytes
+from datadog_checks.base import ConfigurationError, ensure_bytes
 from datadog_checks.stardog import StardogCheck
+from datadog_checks.stardog.stardog import MetricMatcher, _g_bd_specific_matcher
 
 if PY3:
     from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -49,6 +53,107 @@ def test_check_all_metrics(aggregator):
     aggregator.assert_all_metrics_covered
 
 
+def test_database_metrics(aggregator):
+    check = StardogCheck('stardog', {}, [copy.deepcopy(INSTANCE)])
+    doc = dict(DATABASE_DATA)
+    doc['databases.my.db.openConnections'] = {'count': 4}
+    check._process_doc(doc, _g_bd_specific_matcher, ['test1'], add_db_tags=True)
+
+    aggregator.assert_metric('stardog.databases.openConnections', value=2, tags=['test1', 'database:db1'])
+    aggregator.assert_metric('stardog.databases.openConnections', value=4, tags=['test1', 'database:my.db'])
+    aggregator.assert_metric('stardog.databases.queries.running', value=1, tags=['test1', 'database:db1'])
+    aggregator.assert_metric('stardog.databases.txns.speed.p99', value=0.5, tags=['test1', 'database:db1'])
+    aggregator.assert_metric('stardog.dbms.mem.heap.max', count=0)
+    assert check._matches[(_g_bd_specific_matcher, None)]['dbms.mem.heap.max'] is None
+
+    # Keys of the previous document are not matched again, those gone are forgotten
+    del doc['databases.my.db.openConnections']
+    with mock.patch.object(_g_bd_specific_matcher, 'match', side_effect=AssertionError):
+        check._process_doc(doc, _g_bd_specific_matcher, ['test1'], add_db_tags=True)
+    assert 'databases.my.db.openConnections' not in check._matches[(_g_bd_specific_matcher, None)]
+
+
+class FakeStardog(object):
+    """Serves the metrics of every database of `databases` from its own endpoint"""
+
+    def __init__(self, databases):
+        self.databases = databases
+        self.paths = []
+
+    def get(self, url):
+        path = url.split('5820', 1)[1]
+        self.paths.append(path)
+        database = path.rsplit('/', 1)[-1]
+        response = mock.MagicMock(status_code=200)
+        if path == '/admin/status':
+            response.json.return_value = dict(DATA, **{k: v for db in self.databases.values() for k, v in db.items()})
+        elif database in self.databases:
+            response.json.return_value = self.databases[database]
+        else:
+            response.status_code = 404
+            response.raise_for_status.side_effect = requests.exceptions.HTTPError('404 Client Error')
+        return response
+
+
+def database_data(database):
+    return {key.replace('db1', database): value for key, value in DATABASE_DATA.items() if key.startswith('databases.')}
+
+
+def test_selected_databases(aggregator):
+    instance = {
+        'stardog_url': 'http://localhost:5820',
+        'tags': ['test1'],
+        'databases': ['db1', 'db2', 'missing'],
+        'metric_families': ['queries', 'openConnections'],
+    }
+    check = StardogCheck('stardog', {}, [instance])
+    check._http = FakeStardog({'db1': database_data('db1'), 'db2': database_data('db2'), 'db3': database_data('db3')})
+    check.check({})
+    check.cancel()
+
+    assert sorted(check._http.paths) == ['/admin/status/db1', '/admin/status/db2', '/admin/status/missing']
+    tags = ['test1', 'stardog_url:http://localhost:5820']
+    for database in ('db1', 'db2'):
+        aggregator.assert_metric('stardog.databases.openConnections', value=2, tags=tags + ['database:' + database])
+        aggregator.assert_metric('stardog.databases.queries.running', value=1, tags=tags + ['database:' + database])
+    aggregator.assert_metric_has_tag('stardog.databases.openConnections', 'database:db3', count=0)
+    aggregator.assert_metric('stardog.databases.txns.openTransactions', count=0)
+    aggregator.assert_metric('stardog.dbms.mem.heap.max', count=0)
+    assert instance['tags'] == ['test1']
+
+
+def test_selected_databases_with_server_metrics(aggregator):
+    instance = {'stardog_url': 'http://localhost:5820', 'databases': ['db1'], 'collect_server_metrics': True}
+    check = StardogCheck('stardog', {}, [instance])
+    check._http = FakeStardog({'db1': database_data('db1'), 'db2': database_data('db2')})
+    check.check({})
+    check.cancel()
+
+    aggregator.assert_metric('stardog.dbms.mem.heap.max', count=1)
+    aggregator.assert_metric('stardog.databases.openConnections', count=1)
+    aggregator.assert_metric_has_tag('stardog.databases.openConnections', 'database:db1', count=1)
+
+
+def test_unknown_metric_families():
+    instance = {'stardog_url': 'http://localhost:5820', 'databases': ['db1'], 'metric_families': ['txns', 'query']}
+    with pytest.raises(ConfigurationError, match='Unknown metric families: query'):
+        StardogCheck('stardog', {}, [instance])
+
+
+def test_empty_matcher():
+    assert MetricMatcher({}).match('databases.db1.openConnections') is None
+
+
+def test_matcher_order():
+    matcher = MetricMatcher(
+        OrderedDict([(r'databases\.(.*)\.queries\.running', 'running'), (r'databases\.system\.(.*)', 'system')])
+    )
+
+    assert matcher.match('databases.system.queries.running') == ('running', 'system')
+    assert matcher.match('databases.system.planCache.size') == ('system', 'planCache.size')
+    assert matcher.match('dbms.mem.heap.max') is None
+
+
 class HttpServerThread(threading.Thread):
     def __init__(self):
         super(HttpServerThread, self).__init__()
@@ -98,3 +203,32 @@ DATA = {
     "dbms.mem.direct.buffer.max": {"value": 281857228},
     "dbms.mem.direct.pool.max": {"value": 402653184},
 }
+
+SPEED = {
+    'duration_units': 'seconds',
+    'rate_units': 'calls/second',
+    'count': 10,
+    'max': 1.0,
+    'mean': 0.2,
+    'min': 0.1,
+    'p50': 0.2,
+    'p75': 0.3,
+    'p95': 0.4,
+    'p98': 0.45,
+    'p99': 0.5,
+    'p999': 0.9,
+    'stddev': 0.1,
+    'm15_rate': 1.0,
+    'm1_rate': 1.0,
+    'm5_rate': 1.0,
+    'mean_rate': 1.0,
+}
+
+DATABASE_DATA = {
+    'dbms.mem.heap.max': {'value': 2058354688},
+    'databases.db1.txns.openTransactions': {'count': 0},
+    'databases.db1.txns.speed': SPEED,
+    'databases.db1.queries.running': {'count': 1},
+    'databases.db1.queries.speed': SPEED,
+    'databases.db1.openConnections': {'count': 2},
+}
@@ -0,0 +1,98 @@
+import socket
+import ssl
+
+# Version of the remote control protocol spoken by unbound-control, see
+# daemon/remote.c in the unbound sources.
+UNBOUND_CONTROL_VERSION = 1
+DEFAULT_CONTROL_PORT = 8953
+DEFAULT_SERVER_CERT_FILE = '/etc/unbound/unbound_server.pem'
+DEFAULT_CONTROL_KEY_FILE = '/etc/unbound/unbound_control.key'
+DEFAULT_CONTROL_CERT_FILE = '/etc/unbound/unbound_control.pem'
+
+
+class UnboundControlError(Exception):
+    pass
+
+
+class UnboundControlClient(object):
+    """Minimal in-process implementation of the unbound remote control protocol.
+
+    The client either connects to the control Unix socket (`control-interface: /path`)
+    or to the TCP control port, optionally over TLS with the keys generated by
+    unbound-control-setup. It sends `UBCT<version> <command>` and yields the
+    lines returned by the server until it closes the connection.
+    """
+
+    def __init__(
+        self,
+        socket_path=None,
+        host='127.0.0.1',
+        port=DEFAULT_CONTROL_PORT,
+        use_cert=True,
+        server_cert_file=DEFAULT_SERVER_CERT_FILE,
+        control_key_file=DEFAULT_CONTROL_KEY_FILE,
+        control_cert_file=DEFAULT_CONTROL_CERT_FILE,
+        timeout=5,
+    ):
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.use_cert = use_cert
+        self.server_cert_file = server_cert_file
+        self.control_key_file = control_key_file
+        self.control_cert_file = control_cert_file
+        self.timeout = timeout
+        self._ssl_context = None
+
+    def _connect(self):
+        if self.socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except Exception:
+                sock.close()
+                raise
+            return sock
+
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        if not self.use_cert:
+            return sock
+
+        try:
+            return self._get_ssl_context().wrap_socket(sock)
+        except Exception:
+            sock.close()
+            raise
+
+    def _get_ssl_context(self):
+        # Building the context means reading the keys from disk, so keep it for the
+        # life of the client.
+        if self._ssl_context is None:
+            context = ssl.create_default_context(cafile=self.server_cert_file)
+            # unbound-control-setup issues a self-signed server certificate for the
+            # name "unbound", which never matches the host we connect to.
+            context.check_hostname = False
+            context.load_cert_chain(self.control_cert_file, self.control_key_file)
+            self._ssl_context = context
+        return self._ssl_context
+
+    def run(self, command):
+        """Send `command` to the server and yield its output one line at a time."""
+        sock = self._connect()
+        try:
+            sock.sendall('UBCT{} {}\n'.format(UNBOUND_CONTROL_VERSION, command).encode('ascii'))
+            reader = sock.makefile('rb')
+            try:
+                first = True
+                for raw_line in reader:
+                    line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+                    if first:
+                        first = False
+                        if line.startswith('error '):
+                            raise UnboundControlError(line)
+                    yield line
+            finally:
+                reader.close()
+        finally:
+            sock.close()
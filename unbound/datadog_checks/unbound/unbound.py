@@ -5,22 +5,48 @@ import socket
 from datadog_checks.base import AgentCheck, ConfigurationError, is_affirmative
 from datadog_checks.base.utils.subprocess_output import get_subprocess_output
 
+from .control import DEFAULT_CONTROL_PORT, UnboundControlClient
+
 EVENT_TYPE = 'unbound'
 
+# total.num.queries=12
+STAT_LINE = re.compile(r'(\S+)=(.*\d)')
+
 
 class UnboundCheck(AgentCheck):
     # Stats info https://unbound.net/documentation/unbound-control.html
 
     SERVICE_CHECK_NAME = 'unbound.can_get_stats'
 
+    def __init__(self, name, init_config, instances):
+        super(UnboundCheck, self).__init__(name, init_config, instances)
+        self._control_client = None
+        self._stat_tags = None
+        self._stats = {}
+
     def check(self, instance):
+        stats_command = instance.get('stats_command', 'stats')
+        tags = instance.get('tags', [])
+
+        if is_affirmative(instance.get('use_native_client', False)):
+            lines = self.query_unbound_control(instance, stats_command, tags)
+            data = [match.groups() for match in map(STAT_LINE.search, lines) if match]
+            if not data:
+                self.service_check(
+                    self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL, message="unable to parse stats", tags=tags
+                )
+                raise Exception("unable to parse output of '{}'".format(stats_command))
+        else:
+            data = self.run_unbound_control(instance, stats_command, tags)
 
+        self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK, tags=tags)
+        self.process_stats(data, tags)
+
+    def run_unbound_control(self, instance, stats_command, tags):
         use_sudo = is_affirmative(instance.get('use_sudo', False))
         unbound_control = instance.get('unbound_control', 'unbound-control')
-        stats_command = instance.get('stats_command', 'stats')
         host = instance.get('host')
         config_file = instance.get('config_file')
-        tags = instance.get('tags', [])
 
         command = []
         if use_sudo:
@@ -50,34 +76,56 @@ class UnboundCheck(AgentCheck):
         # unwanted.queries=3
 
         # [(u'thread0.num.queries', u'12'), (u'thread0.num.queries_ip_ratelimited', u'45')...]
-        data = re.findall(r'(\S+)=(.*\d)', ub_out)
+        data = STAT_LINE.findall(ub_out)
 
         if not data:
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL, message="unable to parse stats", tags=tags)
             raise Exception("unable to parse output '{}'".format(ub_out))
 
-        self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK, tags=tags)
-
-        for stat in data:
-            self.log.debug('processing %s', stat)
-
-            # Some metric names from unbound make more sense to record as name + tag in datadog.
-            metric_name, all_tags = self.metric_name_to_tags(stat[0], tags)
-
-            unbound_metric_name = 'unbound.{}'.format(metric_name)
+        return data
+
+    def process_stats(self, data, tags):
+        # The set of stat names reported by a given unbound is stable, so classify each
+        # name once and keep the result (with the final tag list) across runs.
+        if tags != self._stat_tags:
+            self._stat_tags = list(tags)
+            self._stats = {}
+        stats = self._stats
+
+        for stat_name, value in data:
+            try:
+                metric_name, submit, all_tags = stats[stat_name]
+            except KeyError:
+                metric_name, submit, all_tags = stats[stat_name] = self.classify_stat(stat_name, tags)
+
+            if submit is None:  # dont send histogram metrics
+                continue
+            submit(metric_name, float(value), tags=all_tags)
+
+    def classify_stat(self, stat_name, tags):
+        """Returns a tuple (metric_name, submit, all_tags) for a raw unbound stat name, where
+        submit is the method used to send it (None if it should be skipped) and all_tags are
+        the tags provided to the check, with any additional for this metric if there are any
+        """
+        # Some metric names from unbound make more sense to record as name + tag in datadog.
+        metric_name, extra_tags = metric_name_to_tags(stat_name)
+        all_tags = tags + extra_tags if extra_tags else tags
+
+        if 'histogram' in metric_name:
+            submit = None
+        elif any(count in metric_name for count in ['num.', 'unwanted', '.count']):
+            submit = self.count
+        else:
+            submit = self.gauge
 
-            if 'histogram' in metric_name:  # dont send histogram metrics
-                self.log.debug('unbound.%s:%s', unbound_metric_name, stat[1])
-            else:
-                if any(count in metric_name for count in ['num.', 'unwanted', '.count']):
-                    self.log.debug('count: %s', stat)
-                    self.count(unbound_metric_name, stat[1], tags=all_tags)
-                elif 'time.' in metric_name:
-                    self.log.debug('gauge (time): %s', stat)
-                    self.gauge(unbound_metric_name, float(stat[1]), tags=all_tags)
-                else:
-                    self.log.debug('gauge: %s', stat)
-                    self.gauge(unbound_metric_name, float(stat[1]), tags=all_tags)
+        self.log.debug(
+            'classified %s as unbound.%s (%s, tags: %s)',
+            stat_name,
+            metric_name,
+            submit.__name__ if submit else 'skipped',
+            all_tags,
+        )
+        return 'unbound.{}'.format(metric_name), submit, all_tags
 
     def call_unbound_control(self, command, tags):
         try:
@@ -106,142 +154,77 @@ class UnboundCheck(AgentCheck):
 
         return ub_out
 
-    def tag_handler(self, metric_name):
-        TAG_HANDLERS = {
-            'thread': self.thread_handler,
-            'num.query.type': self.query_type_handler,
-            'num.query.class': self.query_class_handler,
-            'num.query.opcode': self.query_opcode_handler,
-            'num.query.flags': self.query_flags_handler,
-            'num.answer.rcode': self.answer_rcode_handler,
-        }
-
-        handlers = [TAG_HANDLERS[prefix] for prefix in TAG_HANDLERS.keys() if metric_name.startswith(prefix)]
-        num_handlers = len(handlers)
-        if num_handlers == 0:
-            return None
-        if num_handlers == 1:
-            return handlers[0]
-        raise Exception("more than one handler for '" + metric_name + "': " + handlers)
-
-    def query_type_handler(self, metric_name, tags):
-        # Split out the query type from the rest of the metric name
-        metric_name_parts = metric_name.rsplit('.', 1)
-        query_type = metric_name_parts[1]
-
-        orig_metric_name = metric_name
-        metric_name = metric_name_parts[0]
-
-        all_tags = tags + ['query_type:' + query_type]
-        self.log.debug(
-            'translating query type metric %s to %s (query_type: %s)', orig_metric_name, metric_name, query_type
-        )
-        self.log.debug('all_tags: %s', all_tags)
-
-        return metric_name, all_tags
-
-    def query_class_handler(self, metric_name, tags):
-        # Split out the query class from the rest of the metric name
-        metric_name_parts = metric_name.rsplit('.', 1)
-        query_class = metric_name_parts[1]
-
-        orig_metric_name = metric_name
-        metric_name = metric_name_parts[0]
-
-        all_tags = tags + ['query_class:' + query_class]
-        self.log.debug(
-            'translating query class metric %s to %s (query_class: %s)', orig_metric_name, metric_name, query_class
-        )
-        self.log.debug('all_tags: %s', all_tags)
-
-        return metric_name, all_tags
-
-    def query_opcode_handler(self, metric_name, tags):
-        # Split out the query opcode from the rest of the metric name
-        metric_name_parts = metric_name.rsplit('.', 1)
-        opcode = metric_name_parts[1]
-
-        orig_metric_name = metric_name
-        metric_name = metric_name_parts[0]
-
-        all_tags = tags + ['opcode:' + opcode]
-        self.log.debug('translating query opcode metric %s to %s (opcode: %s)', orig_metric_name, metric_name, opcode)
-        self.log.debug('all_tags: %s', all_tags)
-
-        return metric_name, all_tags
-
-    def query_flags_handler(self, metric_name, tags):
-        # Split out the query flag from the rest of the metric name
-        metric_name_parts = metric_name.rsplit('.', 1)
-        flag = metric_name_parts[1]
-
-        orig_metric_name = metric_name
-        metric_name = metric_name_parts[0]
-
-        all_tags = tags + ['flag:' + flag]
-        self.log.debug('translating query flag metric %s to %s (flag: %s)', orig_metric_name, metric_name, flag)
-        self.log.debug('all_tags: %s', all_tags)
-
-        return metric_name, all_tags
-
-    def answer_rcode_handler(self, metric_name, tags):
-        # Split out the rcode from the rest of the metric name
-        metric_name_parts = metric_name.rsplit('.', 1)
-        rcode = metric_name_parts[1]
+    def get_control_client(self, instance):
+        if self._control_client is None:
+            socket_path = instance.get('control_socket')
+            host, port = None, DEFAULT_CONTROL_PORT
+            if not socket_path:
+                host, _, port = (instance.get('host') or '127.0.0.1').partition('@')
+                host = hostname_to_ip(host)
+                port = int(port) if port else DEFAULT_CONTROL_PORT
+
+            kwargs = {}
+            for option in ('server_cert_file', 'control_key_file', 'control_cert_file'):
+                if instance.get(option):
+                    kwargs[option] = instance[option]
+
+            self._control_client = UnboundControlClient(
+                socket_path=socket_path,
+                host=host,
+                port=port,
+                use_cert=is_affirmative(instance.get('control_use_cert', True)),
+                timeout=float(instance.get('control_timeout', 5)),
+                **kwargs
+            )
+        return self._control_client
 
-        # Handle e.g. num.answer.rcode.NOERROR, but leave
-        # num.answer.rcode.nodata along since it's special.
-        if rcode == 'nodata':
-            return metric_name, tags
+    def query_unbound_control(self, instance, command, tags):
+        """Yields the output lines of `command`, talking to the remote control
+        interface directly instead of running unbound-control
+        """
+        client = self.get_control_client(instance)
+        try:
+            for line in client.run(command):
+                yield line
+        except Exception as e:
+            self.service_check(
+                self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL, message="exception collecting stats", tags=tags
+            )
+            raise Exception("Unable to get unbound stats: {}".format(str(e)))
 
-        orig_metric_name = metric_name
-        metric_name = metric_name_parts[0]
 
-        all_tags = tags + ['rcode:' + rcode]
-        self.log.debug('translating num.answer.rcode %s to %s (rcode: %s)', orig_metric_name, metric_name, rcode)
-        self.log.debug('all_tags: %s', all_tags)
+# Stats whose last name component is sent as a tag, e.g. num.query.type.A is sent as
+# num.query.type with the query_type:A tag.  It makes metadata.csv more compact, but also
+# more predictable/future proof, as some metric names are dynamic.
+SUFFIX_TAGS = {
+    'num.query.type': 'query_type',
+    'num.query.class': 'query_class',
+    'num.query.opcode': 'opcode',
+    'num.query.flags': 'flag',
+    'num.answer.rcode': 'rcode',
+}
 
-        return metric_name, all_tags
 
-    def thread_handler(self, metric_name, tags):
+def metric_name_to_tags(metric_name):
+    """Returns a tuple (metric_name, extra_tags) with the name to use in datadog and the
+    tags extracted from the unbound stat name
+    """
+    if metric_name.startswith('thread'):
         # There are separate counters for each thread.  If we don't do any
         # massaging, it's difficult to define the complete set of possible
         # metrics that we might generate.  Instead, remove the thread number
         # from the metric name, and add it as a tag.
+        thread, _, rest = metric_name.partition('.')
+        return 'thread.' + rest, ['thread:' + thread[len('thread') :]]
 
-        # Split the first part of the metric name (e.g. thread0) from the rest
-        metric_name_parts = metric_name.split('.', 1)
-        thread = metric_name_parts[0]
-
-        # Grab the actual thread number
-        thread_num = thread[len('thread') :]
-
-        # Rebuild the metric name without the thread number
-        orig_metric_name = metric_name
-        metric_name = 'thread.' + metric_name_parts[1]
-
-        # Add the thread number as a tag
-        all_tags = tags + ['thread:' + thread_num]
-
-        self.log.debug('translating thread metric %s to %s (thread_num: %s)', orig_metric_name, metric_name, thread_num)
-        self.log.debug('all_tags: %s', all_tags)
-
-        return metric_name, all_tags
-
-    def metric_name_to_tags(self, metric_name, tags):
-        """Returns a tuple (metric_name, all_tags) where all_tags are the tags provided
-        to the check, with any additional for this metric if there are any
-        """
-        # Some metrics from unbound make more sense to handle as name + tag in
-        # datadog.  If nothing else, it makes metadata.csv more compact, but
-        # also more predictable/future proof, as some metric names are dynamic.
-        handler = self.tag_handler(metric_name)
-        if handler is not None:
-            metric_name, all_tags = handler(metric_name, tags)
-        else:
-            all_tags = tags
+    prefix, _, suffix = metric_name.rpartition('.')
+    tag_name = SUFFIX_TAGS.get(prefix)
+    # Handle e.g. num.answer.rcode.NOERROR, but leave num.answer.rcode.nodata
+    # alone since it's special.
+    if tag_name is None or (tag_name == 'rcode' and suffix == 'nodata'):
+        return metric_name, []
 
-        return metric_name, all_tags
+    return prefix, ['{}:{}'.format(tag_name, suffix)]
 
 
 # From https://stackoverflow.com/a/377028.  Once we can depend on python
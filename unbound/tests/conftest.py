@@ -1,5 +1,7 @@
 import logging
 import os
+import socket
+import threading
 
 import mock
 import pytest
@@ -70,3 +72,61 @@ def env_setup(monkeypatch):
     log.debug('env_setup: no_sbin_path: %s', no_sbin_path)
     monkeypatch.setenv('PATH', no_sbin_path)
     log.debug('env_setup: after: PATH: %s', os.environ['PATH'])
+
+
+class StubControlServer(object):
+    """Serves a stats fixture over the unbound remote control protocol."""
+
+    def __init__(self, sock, stats):
+        self.sock = sock
+        self.stats = stats
+        self.commands = []
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            try:
+                reader = conn.makefile('rb')
+                self.commands.append(reader.readline().decode('ascii').rstrip('\n'))
+                reader.close()
+                conn.sendall(self.stats.encode('utf-8'))
+            finally:
+                conn.close()
+
+
+@pytest.fixture
+def unbound_control_socket(tmp_path):
+    with open(os.path.join(get_here(), 'fixtures', 'stats.basic.1.9.2'), 'r') as f:
+        stats = f.read()
+
+    path = str(tmp_path / 'unbound.ctl')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(5)
+    server = StubControlServer(sock, stats)
+    server.thread.start()
+    server.path = path
+    yield server
+    sock.shutdown(socket.SHUT_RDWR)
+    sock.close()
+
+
+@pytest.fixture
+def unbound_control_tcp():
+    with open(os.path.join(get_here(), 'fixtures', 'stats.basic.1.9.2'), 'r') as f:
+        stats = f.read()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    server = StubControlServer(sock, stats)
+    server.thread.start()
+    server.port = sock.getsockname()[1]
+    yield server
+    sock.shutdown(socket.SHUT_RDWR)
+    sock.close()
@@ -0,0 +1,17 @@
+import os
+
+import mock
+
+from datadog_checks.dev import get_here
+from datadog_checks.unbound import UnboundCheck
+
+
+def test_process_extended_stats(benchmark, aggregator):
+    # The basic stats plus the ones enabled by extended-statistics
+    with open(os.path.join(get_here(), 'fixtures', 'stats.extended.1.9.2'), 'r') as f:
+        stats = f.read()
+
+    check = UnboundCheck('unbound', {}, [{}])
+    with mock.patch('datadog_checks.unbound.unbound.which', return_value='arbitrary'):
+        with mock.patch('datadog_checks.unbound.unbound.get_subprocess_output', return_value=(stats, '', 0)):
+            benchmark(check.check, {'tags': ['foo:bar']})
@@ -166,6 +166,53 @@ def test_hostname_without_port(aggregator, mock_which, mock_basic_stats_1_4_22):
     aggregator.assert_service_check(UnboundCheck.SERVICE_CHECK_NAME, status=AgentCheck.OK)
 
 
+def test_native_client_unix_socket(aggregator, unbound_control_socket):
+    instance = {'use_native_client': True, 'control_socket': unbound_control_socket.path, 'tags': ['foo:bar']}
+    check = UnboundCheck('unbound', {}, [instance])
+    with mock.patch('datadog_checks.unbound.unbound.get_subprocess_output') as mock_subprocess:
+        check.check(instance)
+        aggregator.reset()
+        check.check(instance)
+    mock_subprocess.assert_not_called()
+
+    assert unbound_control_socket.commands == ['UBCT1 stats', 'UBCT1 stats']
+    aggregator.assert_service_check(UnboundCheck.SERVICE_CHECK_NAME, status=AgentCheck.OK)
+    assert_basic_stats_1_9_2(aggregator, ['foo:bar'])
+
+
+def test_native_client_tcp(aggregator, unbound_control_tcp):
+    instance = {
+        'use_native_client': True,
+        'host': '127.0.0.1@{}'.format(unbound_control_tcp.port),
+        'control_use_cert': False,
+        'stats_command': 'stats_noreset',
+    }
+    check = UnboundCheck('unbound', {}, [instance])
+    check.check(instance)
+
+    assert unbound_control_tcp.commands == ['UBCT1 stats_noreset']
+    aggregator.assert_service_check(UnboundCheck.SERVICE_CHECK_NAME, status=AgentCheck.OK)
+    assert_basic_stats_1_9_2(aggregator, [])
+    aggregator.assert_all_metrics_covered()
+
+
+def test_native_client_error_reply(aggregator, unbound_control_socket):
+    unbound_control_socket.stats = 'error version mismatch\n'
+    instance = {'use_native_client': True, 'control_socket': unbound_control_socket.path}
+    check = UnboundCheck('unbound', {}, [instance])
+    with pytest.raises(Exception, match='Unable to get unbound stats: error version mismatch'):
+        check.check(instance)
+    aggregator.assert_service_check(UnboundCheck.SERVICE_CHECK_NAME, status=AgentCheck.CRITICAL)
+
+
+def test_native_client_connection_refused(aggregator, tmp_path):
+    instance = {'use_native_client': True, 'control_socket': str(tmp_path / 'missing.ctl')}
+    check = UnboundCheck('unbound', {}, [instance])
+    with pytest.raises(Exception, match='Unable to get unbound stats: .*'):
+        check.check(instance)
+    aggregator.assert_service_check(UnboundCheck.SERVICE_CHECK_NAME, status=AgentCheck.CRITICAL)
+
+
 def assert_basic_stats_1_9_2(aggregator, tags):
     thread0_tags = tags + ['thread:0']
     aggregator.assert_metric(
@@ -0,0 +1,104 @@
+# (C) Datadog, Inc. 2010-2016
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+import re
+import socket
+
+DEFAULT_UPSD_PORT = 3493
+
+# Words of a reply line, quoted ones may contain spaces and backslash-escaped quotes:
+# VAR myups ups.status "OL CHRG"
+WORD = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+ESCAPED = re.compile(r'\\(.)')
+
+
+class NutError(Exception):
+    pass
+
+
+def split_line(line):
+    """Split a reply line of upsd into its words, unquoting the quoted ones."""
+    return [bare or ESCAPED.sub(r'\1', quoted) for quoted, bare in WORD.findall(line)]
+
+
+class NutClient(object):
+    """Minimal implementation of the network protocol of upsd, the server upsc talks to.
+
+    Every command is sent over the same TCP connection, opened on `connect` and closed
+    on `close`. The replies of LIST commands are read from the socket one line at a time,
+    see docs/net-protocol.txt in the NUT sources.
+    """
+
+    def __init__(self, host='localhost', port=DEFAULT_UPSD_PORT, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile('rb')
+
+    def close(self):
+        if self._sock is None:
+            return
+        try:
+            self._sock.sendall(b'LOGOUT\n')
+        except socket.error:
+            # upsd already went away
+            pass
+        finally:
+            self._reader.close()
+            self._sock.close()
+            self._reader = self._sock = None
+
+    def list_ups(self):
+        """Return the names of the UPSes served by upsd."""
+        # Read the whole reply, the caller sends other commands while going through the names
+        return [words[1] for words in self._list('UPS')]
+
+    def list_var(self, ups):
+        """Yield the (name, value) of every variable of `ups`, as they are read."""
+        for words in self._list('VAR {}'.format(ups)):
+            yield words[2], words[3]
+
+    def _list(self, query):
+        if self._sock is None:
+            raise NutError('Not connected to upsd')
+        try:
+            self._sock.sendall('LIST {}\n'.format(query).encode('utf-8'))
+        except socket.timeout:
+            self.close()
+            raise NutError('Timed out sending LIST {}'.format(query))
+        begin = self._readline(query)
+        if begin != 'BEGIN LIST {}'.format(query):
+            raise NutError('Unexpected reply to LIST {}: {}'.format(query, begin))
+
+        end = 'END LIST {}'.format(query)
+        while True:
+            line = self._readline(query)
+            if line == end:
+                return
+            yield split_line(line)
+
+    def _readline(self, query):
+        try:
+            raw_line = self._reader.readline()
+        except socket.timeout:
+            # A late reply would be taken for the one to the next command, don't use this connection anymore
+            self.close()
+            raise NutError('Timed out waiting for the reply to LIST {}'.format(query))
+        if not raw_line:
+            raise NutError('Connection closed by upsd')
+        line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+        if line.startswith('ERR '):
+            raise NutError(line)
+        return line
@@ -1,51 +1,48 @@
 # (C) Datadog, Inc. 2010-2016
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
-import os
 import re
-import subprocess
 
 from datadog_checks.base import AgentCheck, ensure_unicode
 
+from .nut import DEFAULT_UPSD_PORT, NutClient, NutError
+
 EVENT_TYPE = SOURCE_TYPE_NAME = 'upsc'
 
 
 class UpscCheck(AgentCheck):
 
-    DEV_NULL = open(os.devnull, 'w')
     DEFAULT_STRING_TAGS = ['device.mfr', 'device.model']
     DEFAULT_EXCLUDED_TAGS = ['ups.vendorid', 'ups.productid', 'driver.version.internal', 'driver.version']
 
-    def list_ups_devices(self):
+    def list_ups_devices(self, client):
         """Generate and return the list of configured devices.
 
+        :param client: client connected to upsd
+        :type client: NutClient
         :return: list of devices by name
         :rtype: list[str]
         """
         try:
-            results = subprocess.check_output(['upsc', '-l'], stderr=self.DEV_NULL)
-            return [r.strip() for r in results.split('\n')]
-        except subprocess.CalledProcessError as e:
+            return client.list_ups()
+        except NutError as e:
             self.log.error("Unable to query devices: %s", e)
             return []
 
-    def query_ups_device(self, name):
+    def query_ups_device(self, client, name):
         """Query ups device and return results
 
+        :param client: client connected to upsd
+        :type client: NutClient
         :param name: UPS device name from `list_ups_devices`
         :type name: str
         :return: raw results in simple form
         :rtype: dict(str, str)
         """
         try:
-            results = subprocess.check_output(['upsc', name], stderr=self.DEV_NULL)
-            stats = {}
-            for line in results.splitlines(False):
-                key, val = line.split(':', 1)
-                stats[key] = val.strip()
-            return stats
-        except subprocess.CalledProcessError as e:
-            self.log.error("Unable to query device %s", name, e)
+            return dict(client.list_var(name))
+        except NutError as e:
+            self.log.error("Unable to query device %s: %s", name, e)
             return {}
 
     def convert_and_filter_stats(self, stats):
@@ -87,7 +84,12 @@ class UpscCheck(AgentCheck):
     def check(self, instance):
         self.update_from_config(instance)
 
-        for device in self.list_ups_devices():
+        # Every device is queried over the same connection to upsd
+        with NutClient(self.host, self.port, self.timeout) as client:
+            self.check_devices(client)
+
+    def check_devices(self, client):
+        for device in self.list_ups_devices(client):
             if device not in self.excluded_devices:
                 excluded = False
                 for r in self.excluded_devices_re:
@@ -100,7 +102,7 @@ class UpscCheck(AgentCheck):
                 self.log.debug("querying device: %s", device)
 
                 # query stats
-                raw_stats = self.query_ups_device(device)
+                raw_stats = self.query_ups_device(client, device)
                 stats, tags = self.convert_and_filter_stats(raw_stats)
 
                 # report stats
@@ -113,6 +115,10 @@ class UpscCheck(AgentCheck):
         :param instance: Agent config instance.
         :return: None
         """
+        self.host = instance.get('host', 'localhost')
+        self.port = int(instance.get('port', DEFAULT_UPSD_PORT))
+        self.timeout = float(instance.get('timeout', 5))
+
         self.string_tags = list(self.DEFAULT_STRING_TAGS)
         self.string_tags.extend(instance.get('string_tags', []))
 
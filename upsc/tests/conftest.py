@@ -1,3 +1,6 @@
+import socket
+import threading
+
 import pytest
 
 
@@ -9,3 +12,65 @@ def dd_environment():
 @pytest.fixture
 def instance():
     return {}
+
+
+class FakeUpsd(object):
+    """Answers the LIST UPS and LIST VAR commands of the upsd network protocol for `devices`."""
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.commands = []
+        self.connections = 0
+        # Commands left unanswered
+        self.stalled = set()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            reader = conn.makefile('rb')
+            try:
+                for raw_line in reader:
+                    command = raw_line.decode('utf-8').rstrip('\n')
+                    self.commands.append(command)
+                    if command == 'LOGOUT':
+                        conn.sendall(b'OK Goodbye\n')
+                        break
+                    if command not in self.stalled:
+                        conn.sendall(self.reply(command).encode('utf-8'))
+            finally:
+                reader.close()
+                conn.close()
+
+    def reply(self, command):
+        if command == 'LIST UPS':
+            lines = ['UPS {} "{} description"'.format(name, name) for name in self.devices]
+        elif command.startswith('LIST VAR '):
+            name = command.split(' ', 2)[2]
+            if name not in self.devices:
+                return 'ERR UNKNOWN-UPS\n'
+            lines = [
+                'VAR {} {} "{}"'.format(name, var, value.replace('\\', '\\\\').replace('"', '\\"'))
+                for var, value in self.devices[name].items()
+            ]
+        else:
+            return 'ERR UNKNOWN-COMMAND\n'
+        return '\n'.join(['BEGIN {}'.format(command)] + lines + ['END {}'.format(command)]) + '\n'
+
+
+@pytest.fixture
+def upsd():
+    server = FakeUpsd({})
+    server.thread.start()
+    yield server
+    server.sock.shutdown(socket.SHUT_RDWR)
+    server.sock.close()
@@ -2,10 +2,12 @@
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
 import re
+import socket
 
-import mock
+import pytest
 
 from datadog_checks.upsc import UpscCheck
+from datadog_checks.upsc.nut import NutClient, NutError, split_line
 
 from .common import INSTANCES
 
@@ -23,21 +25,48 @@ def test_load_from_config(aggregator):
     assert [re.compile(r'ignore\..*')] == check.excluded_devices_re
 
 
-@mock.patch('subprocess.check_output')
-def test_list_ups_devices(mock_iocall):
+def test_list_ups_devices(upsd):
     check = UpscCheck('upsc ', {}, {}, INSTANCES)
     check.update_from_config(INSTANCES[0])
+    upsd.devices = {'ignoreme': {}, 'ignore.me.too': {}, 'testUps': {}}
 
-    mock_iocall.return_value = '\n'.join(['ignoreme', 'ignore.me.too', 'testUps'])
-    assert sorted(['ignoreme', 'ignore.me.too', 'testUps']) == sorted(check.list_ups_devices())
+    with NutClient('127.0.0.1', upsd.port) as client:
+        assert sorted(['ignoreme', 'ignore.me.too', 'testUps']) == sorted(check.list_ups_devices(client))
 
 
-@mock.patch('subprocess.check_output')
-def test_query_ups_device(mock_iocall):
+def test_query_ups_device(upsd):
     check = UpscCheck('upsc ', {}, {}, INSTANCES)
     check.update_from_config(INSTANCES[0])
-    mock_iocall.return_value = '\n'.join(['ups.status: OL', 'battery.charge: 100'])
-    assert {'ups.status': 'OL', 'battery.charge': '100'} == check.query_ups_device('testUps')
+    upsd.devices = {'testUps': {'ups.status': 'OL', 'battery.charge': '100', 'ups.mfr': 'APC "Smart" \\ UPS'}}
+
+    with NutClient('127.0.0.1', upsd.port) as client:
+        assert {'ups.status': 'OL', 'battery.charge': '100', 'ups.mfr': 'APC "Smart" \\ UPS'} == check.query_ups_device(
+            client, 'testUps'
+        )
+        # The connection stays usable after an error reply
+        assert {} == check.query_ups_device(client, 'missing')
+        assert 'OL' == dict(client.list_var('testUps'))['ups.status']
+
+
+def test_query_ups_device_timeout(upsd):
+    check = UpscCheck('upsc ', {}, {}, INSTANCES)
+    check.update_from_config(INSTANCES[0])
+    upsd.devices = {'slowUps': {'ups.status': 'OL'}}
+    upsd.stalled.add('LIST VAR slowUps')
+
+    with NutClient('127.0.0.1', upsd.port, timeout=0.1) as client:
+        with pytest.raises(NutError, match='Timed out waiting for the reply to LIST VAR slowUps'):
+            list(client.list_var('slowUps'))
+        # The connection isn't used anymore, a late reply can't be mistaken for the one to another command
+        with pytest.raises(NutError, match='Not connected'):
+            client.list_ups()
+        assert {} == check.query_ups_device(client, 'slowUps')
+
+
+def test_split_line():
+    assert ['VAR', 'ups1', 'ups.status', 'OL CHRG'] == split_line('VAR ups1 ups.status "OL CHRG"')
+    assert ['VAR', 'ups1', 'ups.mfr', 'a "b" \\ c'] == split_line('VAR ups1 ups.mfr "a \\"b\\" \\\\ c"')
+    assert ['VAR', 'ups1', 'ups.id', ''] == split_line('VAR ups1 ups.id ""')
 
 
 def test_convert_and_filter_stats():
@@ -58,35 +87,29 @@ def test_convert_and_filter_stats():
     )
 
 
-@mock.patch('subprocess.check_output')
-def test_check(mock_iocall, aggregator):
+def test_check(aggregator, upsd):
     """
     Testing Upsc check.
     """
     check = UpscCheck('upsc ', {}, {}, INSTANCES)
+    instance = dict(INSTANCES[0], host='127.0.0.1', port=upsd.port)
 
-    # run your actual tests...
-    mock_list_results = '\n'.join(['ignoreme', 'ignore.me.too', 'testUps'])
-    mock_query_results = '\n'.join(
-        [
-            'ups.status: OL',
-            'battery.charge: 100',
-            'ups.testStringTag: foo Bar-*/baz',
-            'ups.ignoreme: 1',
-            'ups.ignore.me.too: 3',
-            'device.mfr: CPS',
-            'device.model: OR700VAU1',
-        ]
-    )
-
-    results = [mock_list_results, mock_query_results, mock_query_results, mock_query_results, mock_query_results]
-
-    def sequence_calls(*args, **kwargs):
-        return results.pop(0)
+    stats = {
+        'ups.status': 'OL',
+        'battery.charge': '100',
+        'ups.testStringTag': 'foo Bar-*/baz',
+        'ups.ignoreme': '1',
+        'ups.ignore.me.too': '3',
+        'device.mfr': 'CPS',
+        'device.model': 'OR700VAU1',
+    }
+    upsd.devices = {'ignoreme': stats, 'ignore.me.too': stats, 'testUps': stats}
 
-    mock_iocall.side_effect = sequence_calls
+    check.check(instance)
 
-    check.check(INSTANCES[0])
+    # One connection for every device, excluded devices are not queried
+    assert 1 == upsd.connections
+    assert ['LIST UPS', 'LIST VAR testUps', 'LOGOUT'] == upsd.commands
 
     test_tags = ['foo:bar', 'ups.testStringTag:foo__bar_baz', 'device.mfr:cps', 'device.model:or700_vau1']
 
@@ -96,3 +119,16 @@ def test_check(mock_iocall, aggregator):
         aggregator.assert_metric('upsc.{}'.format(name), count=count, value=value, tags=test_tags)
 
     aggregator.assert_all_metrics_covered()
+
+
+def test_check_upsd_unreachable(aggregator):
+    check = UpscCheck('upsc ', {}, {}, INSTANCES)
+    # A port nothing listens on
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    with pytest.raises(socket.error):
+        check.check(dict(INSTANCES[0], host='127.0.0.1', port=port))
+    aggregator.assert_all_metrics_covered()
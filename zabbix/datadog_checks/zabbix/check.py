@@ -1,9 +1,39 @@
 import json
+import math
+import threading
+import time
+from collections import defaultdict
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
-from datadog_checks.base import AgentCheck, ConfigurationError
+import requests
+
+from datadog_checks.base import AgentCheck, ConfigurationError, is_affirmative
+from datadog_checks.base.utils.http import RequestsWrapper
 
 from .metrics import METRICS
 
+ITEM_OUTPUT = ['itemid', 'name', 'hostid', 'value_type']
+HISTORY_MODES = ('lastvalue', 'history')
+DEFAULT_HISTORY_WINDOW = 600
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_INVENTORY_TTL = 3600
+DEFAULT_SHARD_WORKERS = 4
+DEFAULT_SHARD_TIMEOUT = 30
+NO_DEADLINE = float('inf')
+SHARD_BY = ('proxy', 'hostgroup')
+
+# Error data returned by the API when the token of a user session is not valid anymore
+SESSION_EXPIRED_ERRORS = ('Session terminated, re-login, please.', 'Not authorised.', 'Not authorized.')
+
+
+class SessionExpired(Exception):
+    pass
+
+
+class ShardTimeout(Exception):
+    pass
+
 
 class ZabbixCheck(AgentCheck):
 
@@ -13,19 +43,51 @@ class ZabbixCheck(AgentCheck):
         super(ZabbixCheck, self).__init__(name, init_config, instances)
         self.tags = self.instance.get('tags', [])
 
+        # Token of the user session, kept across runs and only renewed when it expires
+        self._token = None
+
+        # Hosts, items and shards, kept until they change or for inventory_ttl seconds
+        self._inventory = None
+        self._inventory_expiration = 0
+
+        # HTTP client of each shard, sessions can't be shared by the threads collecting the shards
+        self._shard_http = {}
+        # HTTP client and deadline of the shard collected by the current thread
+        self._local = threading.local()
+
     def request(self, zabbix_api, req_data):
         req_header = {
             'Content-Type': 'application/json-rpc',
         }
+        http = getattr(self._local, 'http', None) or self.http
+        options = {}
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ShardTimeout()
+            # Don't wait on the server past the deadline of the shard
+            options['timeout'] = tuple(min(timeout, remaining) for timeout in http.options['timeout'])
 
         try:
-            res = self.http.post(zabbix_api, data=req_data.encode(), headers=req_header)
+            # Keep the connection alive between requests and runs
+            res = http.post(zabbix_api, data=req_data.encode(), headers=req_header, persist=True, **options)
+        except requests.exceptions.Timeout:
+            if deadline is None:
+                raise
+            raise ShardTimeout()
         except Exception as e:
             self.log.debug("Unable to get make request to api=%s with req_data=%s", zabbix_api, req_data)
             self.warning("Request failed: %s", str(e))
             self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.CRITICAL, tags=self.tags)
             raise
-        return res.json()
+
+        response = res.json()
+        for entry in response if isinstance(response, list) else [response]:
+            error = entry.get('error') or {}
+            if error.get('data') in SESSION_EXPIRED_ERRORS:
+                raise SessionExpired(error['data'])
+        return response
 
     def login(self, zabbix_user, zabbix_pass, zabbix_api):
         req_data = json.dumps(
@@ -48,34 +110,24 @@ class ZabbixCheck(AgentCheck):
         self.log.debug("Logging out: %s", response)
         return response
 
-    def get_hosts(self, token, zabbix_api, hosts=None):
+    def get_hosts(self, token, zabbix_api, hosts=None, shard_by=None):
+        params = {'output': ['hostid', 'host']}
         if hosts is not None:
-            req_data = json.dumps(
-                {
-                    'jsonrpc': '2.0',
-                    'method': 'host.get',
-                    'params': {'filter': {'host': hosts}, 'output': ['hostid', 'host']},
-                    'auth': token,
-                    'id': 1,
-                }
-            )
-        else:
-            req_data = json.dumps(
-                {
-                    'jsonrpc': '2.0',
-                    'method': 'host.get',
-                    'params': {'output': ['hostid', 'host']},
-                    'auth': token,
-                    'id': 1,
-                }
-            )
+            params['filter'] = {'host': hosts}
+        # Also get what hosts are partitioned by
+        if shard_by == 'proxy':
+            params['output'].append('proxy_hostid')
+        elif shard_by == 'hostgroup':
+            params['selectGroups'] = ['groupid']
+
+        req_data = json.dumps({'jsonrpc': '2.0', 'method': 'host.get', 'params': params, 'auth': token, 'id': 1})
         response = self.request(zabbix_api, req_data)
 
         result = response.get('result')
         self.log.debug("Getting zabbix items: %s", result)
         return result
 
-    def get_items(self, token, hostids, zabbix_api, items=None):
+    def get_items(self, token, hostids, zabbix_api, items=None, output=ITEM_OUTPUT):
         if items is not None:
             req_data = json.dumps(
                 {
@@ -84,7 +136,7 @@ class ZabbixCheck(AgentCheck):
                     'params': {
                         'hostids': hostids,
                         'filter': {'name': items},
-                        'output': ['itemid', 'name', 'hostid', 'value_type'],
+                        'output': output,
                     },
                     'auth': token,
                     'id': 1,
@@ -95,7 +147,7 @@ class ZabbixCheck(AgentCheck):
                 {
                     'jsonrpc': '2.0',
                     'method': 'item.get',
-                    'params': {'hostids': hostids, 'output': ['itemid', 'name', 'hostid', 'value_type']},
+                    'params': {'hostids': hostids, 'output': output},
                     'auth': token,
                     'id': 1,
                 }
@@ -103,91 +155,312 @@ class ZabbixCheck(AgentCheck):
         response = self.request(zabbix_api, req_data)
         return response.get('result')
 
-    def get_history(self, token, hostid, itemid, value_type, zabbix_api):
-        req_data = json.dumps(
-            {
-                'jsonrpc': '2.0',
-                'method': 'history.get',
-                'params': {
-                    'hostids': hostid,
-                    'itemids': itemid,
-                    'output': ['itemid', 'value'],
-                    'history': value_type,
-                    'sortfield': 'clock',
-                    'sortorder': 'DESC',
-                    'limit': 1,
-                },
-                'auth': token,
-                'id': 1,
-            }
-        )
+    def get_latest_history(self, token, items, zabbix_api, history_window):
+        """Returns the latest value of each item, with one history.get call per value type
+        for values stored during the last `history_window` seconds.
+        """
+        itemids_by_type = defaultdict(list)
+        for item in items:
+            itemids_by_type[item['value_type']].append(item['itemid'])
 
-        response = self.request(zabbix_api, req_data)
-        result = response.get('result')
+        time_from = int(time.time()) - history_window
+        values = {}
+        for value_type, itemids in itemids_by_type.items():
+            req_data = json.dumps(
+                {
+                    'jsonrpc': '2.0',
+                    'method': 'history.get',
+                    'params': {
+                        'itemids': itemids,
+                        'output': ['itemid', 'value'],
+                        'history': value_type,
+                        'time_from': time_from,
+                        'sortfield': 'clock',
+                        'sortorder': 'DESC',
+                    },
+                    'auth': token,
+                    'id': 1,
+                }
+            )
+            response = self.request(zabbix_api, req_data)
+            # Sorted by most recent first, so keep the first value of each item
+            for entry in response.get('result') or []:
+                values.setdefault(entry['itemid'], entry['value'])
 
-        return result
+        return values
+
+    def get_history_batch(self, token, items, zabbix_api, batch_size):
+        """Returns the latest value of each item, sending the per-item history.get calls
+        as JSON-RPC batches of `batch_size` requests.
+        """
+        values = {}
+        for start in range(0, len(items), batch_size):
+            batch = items[start : start + batch_size]
+            req_data = json.dumps(
+                [
+                    {
+                        'jsonrpc': '2.0',
+                        'method': 'history.get',
+                        'params': {
+                            'itemids': item['itemid'],
+                            'output': ['itemid', 'value'],
+                            'history': item['value_type'],
+                            'sortfield': 'clock',
+                            'sortorder': 'DESC',
+                            'limit': 1,
+                        },
+                        'auth': token,
+                        'id': request_id,
+                    }
+                    for request_id, item in enumerate(batch)
+                ]
+            )
+            response = self.request(zabbix_api, req_data)
+            if not isinstance(response, list):
+                # The server doesn't support batches and answered with a single error
+                raise Exception('JSON-RPC batch requests are not supported: {}'.format(response.get('error')))
+
+            for entry in response:
+                for value in entry.get('result') or []:
+                    values[value['itemid']] = value['value']
+
+        return values
+
+    def cancel(self):
+        # Only sessions opened with user.login can be closed
+        zabbix_api = self.instance.get('zabbix_api')
+        if self._token is not None and zabbix_api and not self.instance.get('zabbix_api_token'):
+            try:
+                self.logout(self._token, zabbix_api)
+            except Exception as e:
+                self.log.debug("Unable to log out: %s", str(e))
+        self._token = None
+        self.http.session.close()
+        for http in self._shard_http.values():
+            http.session.close()
+        self._shard_http = {}
 
     def check(self, instance):
         zabbix_user = instance.get('zabbix_user')
         zabbix_pass = instance.get('zabbix_password')
         zabbix_api = instance.get('zabbix_api')
+        zabbix_api_token = instance.get('zabbix_api_token')
 
-        if not zabbix_user:
-            raise ConfigurationError('Configuration error, please specify zabbix_user.')
+        if not zabbix_api_token:
+            if not zabbix_user:
+                raise ConfigurationError('Configuration error, please specify zabbix_api_token or zabbix_user.')
 
-        if not zabbix_pass:
-            raise ConfigurationError('Configuration error, please specify zabbix_pass.')
+            if not zabbix_pass:
+                raise ConfigurationError('Configuration error, please specify zabbix_password.')
 
         if not zabbix_api:
             raise ConfigurationError('Configuration error, please specify zabbix_api.')
 
-        hosts = instance.get('hosts')
-        metrics = instance.get('metrics')
+        history_mode = instance.get('history_mode', 'lastvalue')
+        if history_mode not in HISTORY_MODES:
+            raise ConfigurationError(
+                'Configuration error, history_mode must be one of: {}.'.format(', '.join(HISTORY_MODES))
+            )
 
-        # Get token
-        token = self.login(zabbix_user, zabbix_pass, zabbix_api)
+        shard_by = instance.get('shard_by')
+        if shard_by is not None and shard_by not in SHARD_BY:
+            raise ConfigurationError('Configuration error, shard_by must be one of: {}.'.format(', '.join(SHARD_BY)))
 
-        # Get hosts
-        if hosts is not None:
-            zabbixhosts = self.get_hosts(token, zabbix_api, hosts)
+        # API tokens are used as is, otherwise reuse the session of the previous runs
+        if zabbix_api_token:
+            self.collect(zabbix_api_token, zabbix_api, instance)
         else:
-            zabbixhosts = self.get_hosts(token, zabbix_api)
+            if self._token is None:
+                self._token = self.login(zabbix_user, zabbix_pass, zabbix_api)
+            try:
+                self.collect(self._token, zabbix_api, instance)
+            except SessionExpired as e:
+                self.log.debug("Session expired (%s), logging in again", str(e))
+                self._token = self.login(zabbix_user, zabbix_pass, zabbix_api)
+                self.collect(self._token, zabbix_api, instance)
+
+        self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK, tags=self.tags)
+
+    def get_inventory(self, token, zabbix_api, instance, names):
+        """Returns a tuple (hostdic, items, shards) where items maps item ids to their
+        description, and shards maps shard keys to the ids of their hosts.
+
+        Hosts and items are cached for `inventory_ttl` seconds, or until the items of
+        the hosts change.
+        """
+        now = time.time()
+        if self._inventory is not None and now < self._inventory_expiration:
+            return self._inventory
+
+        # Get hosts
+        shard_by = instance.get('shard_by')
+        zabbixhosts = self.get_hosts(token, zabbix_api, instance.get('hosts'), shard_by=shard_by)
 
         hostdic = {}
         hostids = []
+        shards = defaultdict(list)
         for host in zabbixhosts:
             hostdic[host['hostid']] = host['host']
             hostids.append(host['hostid'])
+            if shard_by == 'proxy':
+                # 0 for hosts monitored by the server itself
+                shards[host.get('proxy_hostid', '0')].append(host['hostid'])
+            elif shard_by == 'hostgroup':
+                # Hosts can be in several groups, only collect them once
+                groupids = [group['groupid'] for group in host.get('groups') or []]
+                shards[min(groupids, key=int) if groupids else '0'].append(host['hostid'])
+            else:
+                shards[None].append(host['hostid'])
 
         # Get items
+        zabbixitems = self.get_items(token, hostids, zabbix_api, names, output=ITEM_OUTPUT)
+        items = {item['itemid']: item for item in zabbixitems}
+
+        self._inventory = hostdic, items, shards
+        self._inventory_expiration = now + int(instance.get('inventory_ttl', DEFAULT_INVENTORY_TTL))
+        return self._inventory
+
+    def collect_shard(self, token, zabbix_api, instance, names, hostids, items, deadline):
+        """Returns a tuple (values, itemids, complete) with the last value of the items of the
+        hosts `hostids`, the ids of all their current items and whether all values could be
+        fetched before `deadline`.
+        """
+        history_mode = instance.get('history_mode', 'lastvalue')
+        value_output = ['lastvalue', 'lastclock'] if history_mode == 'lastvalue' else []
+
+        # Only transfer the items we have a metric for
+        try:
+            zabbixitems = self.get_items(token, hostids, zabbix_api, names, output=['itemid'] + value_output)
+        except ShardTimeout:
+            return {}, set(), False
+
+        values = {}
+        itemids = set()
+        for item in zabbixitems:
+            itemids.add(item['itemid'])
+            # A lastclock of 0 means the item has no value in the server cache
+            if item.get('lastclock', '0') != '0':
+                values[item['itemid']] = item['lastvalue']
+
+        # Items were added, let the caller refresh them first
+        if not itemids.issubset(items):
+            return values, itemids, True
+
+        # Get metrics value of the remaining items
+        missing = [items[itemid] for itemid in itemids if itemid not in values]
+        if missing:
+            if time.time() >= deadline:
+                return values, itemids, False
+            try:
+                if is_affirmative(instance.get('jsonrpc_batch', False)):
+                    batch_size = int(instance.get('batch_size', DEFAULT_BATCH_SIZE))
+                    values.update(self.get_history_batch(token, missing, zabbix_api, batch_size))
+                else:
+                    history_window = int(instance.get('history_window', DEFAULT_HISTORY_WINDOW))
+                    values.update(self.get_latest_history(token, missing, zabbix_api, history_window))
+            except ShardTimeout:
+                return values, itemids, False
+
+        return values, itemids, True
+
+    def collect(self, token, zabbix_api, instance):
+        metrics = instance.get('metrics')
         if metrics is not None:
-            zabbixitems = self.get_items(token, hostids, zabbix_api, metrics)
+            for name in metrics:
+                if name not in METRICS:
+                    self.log.debug("Item name %s not found in metric mapping", name)
+            names = [name for name in metrics if name in METRICS]
         else:
-            zabbixitems = self.get_items(token, hostids, zabbix_api)
+            names = list(METRICS)
 
-        # Get metrics value
-        for item in zabbixitems:
-            hostid = item['hostid']
-            itemid = item['itemid']
-            value_type = item['value_type']
-            item_name = item['name']
+        hostdic, items, shards = self.get_inventory(token, zabbix_api, instance, names)
 
-            if item_name in METRICS:
-                history = self.get_history(token, hostid, itemid, value_type, zabbix_api)
-                mname = METRICS[item_name]
+        if instance.get('shard_by'):
+            results = self.collect_shards(token, zabbix_api, instance, names, shards, items)
+        else:
+            values, itemids, _ = self.collect_shard(
+                token, zabbix_api, instance, names, list(hostdic), items, NO_DEADLINE
+            )
+            if itemids != set(items):
+                self.log.debug("Zabbix items changed, refreshing hosts and items")
+                self._inventory = None
+                hostdic, items, _ = self.get_inventory(token, zabbix_api, instance, names)
+                values, itemids, _ = self.collect_shard(
+                    token, zabbix_api, instance, names, list(hostdic), items, NO_DEADLINE
+                )
+            results = [values]
 
+        for values in results:
+            for itemid, value in values.items():
                 try:
-                    dd_metricname = 'zabbix.' + mname
-                    dd_metricvalue = history[0]['value']
-                    dd_hostname = hostdic[hostid].replace(' ', '_')
+                    item = items[itemid]
+                    dd_metricname = 'zabbix.' + METRICS[item['name']]
+                    dd_hostname = hostdic[item['hostid']].replace(' ', '_')
                 except Exception as e:
                     self.log.debug("Unable to get metric for item %s: %s", itemid, str(e))
                 else:
-                    self.gauge(dd_metricname, dd_metricvalue, tags=self.tags, hostname=dd_hostname, device_name=None)
-            else:
-                self.log.debug("Item name %s not found in metric mapping", item_name)
+                    self.gauge(dd_metricname, value, tags=self.tags, hostname=dd_hostname, device_name=None)
 
-        # Revoke token
-        result = self.logout(token, zabbix_api)
-        self.log.debug("Logged out: %s", result)
-        self.service_check(self.SERVICE_CHECK_NAME, AgentCheck.OK, tags=self.tags)
+    def collect_shards(self, token, zabbix_api, instance, names, shards, items):
+        """Collects the shards concurrently and returns the values fetched for each of them.
+        Shards running out of their `shard_timeout` budget return the values fetched so far.
+        """
+        workers = int(instance.get('shard_workers', DEFAULT_SHARD_WORKERS))
+        shard_timeout = float(instance.get('shard_timeout', DEFAULT_SHARD_TIMEOUT))
+
+        # Keep the HTTP clients of the current shards only
+        self._shard_http = {
+            shard: self._shard_http.get(shard)
+            or RequestsWrapper(self.instance or {}, self.init_config, self.HTTP_CONFIG_REMAPPER, self.log)
+            for shard in shards
+        }
+
+        workers = max(1, min(workers, len(shards)))
+        pool = ThreadPool(workers)
+        try:
+            pending = []
+            for shard, hostids in shards.items():
+                # The time budget of each shard starts when a worker picks it up
+                args = (shard, token, zabbix_api, instance, names, hostids, items, shard_timeout)
+                pending.append((shard, pool.apply_async(self._collect_shard_with_budget, args)))
+            # Shards wait for a worker in turns, each turn lasts at most shard_timeout seconds
+            deadline = time.time() + shard_timeout * math.ceil(len(shards) / float(workers))
+
+            results = []
+            changed = False
+            for shard, result in pending:
+                try:
+                    values, itemids, complete = result.get(timeout=max(0, deadline - time.time()))
+                except TimeoutError:
+                    # Requests stop waiting on the server at the deadline of their shard, don't wait for them
+                    self.warning("Shard %s took more than %s seconds, reporting partial results", shard, shard_timeout)
+                    continue
+                except SessionExpired:
+                    raise
+                except Exception as e:
+                    self.warning("Unable to collect shard %s: %s", shard, str(e))
+                    continue
+
+                if not complete:
+                    self.warning("Shard %s took more than %s seconds, reporting partial results", shard, shard_timeout)
+                if not itemids.issubset(items):
+                    changed = True
+                results.append(values)
+        finally:
+            # Not joined, so that a shard still running doesn't hold up the run
+            pool.close()
+
+        # Refresh hosts and items on the next run
+        if changed:
+            self.log.debug("Zabbix items changed, refreshing hosts and items on the next run")
+            self._inventory = None
+        return results
+
+    def _collect_shard_with_budget(self, shard, token, zabbix_api, instance, names, hostids, items, shard_timeout):
+        deadline = time.time() + shard_timeout
+        self._local.http = self._shard_http[shard]
+        self._local.deadline = deadline
+        try:
+            return self.collect_shard(token, zabbix_api, instance, names, hostids, items, deadline)
+        finally:
+            self._local.http = self._local.deadline = None
@@ -1,3 +1,8 @@
+import json
+import time
+
+import mock
+
 EXPECTED_METRICS = [
     "zabbix.cache.write",
     "zabbix.cache.value.hits",
@@ -41,3 +46,128 @@ EXPECTED_METRICS = [
     "zabbix.process.internal.lld_manager",
     "zabbix.process.internal.lld_worker",
 ]
+
+HOSTS = {'10084': 'Zabbix server', '10085': 'web 1'}
+HOST_PROXIES = {'10084': '0', '10085': '10100'}
+HOST_GROUPS = {'10084': ['4'], '10085': ['7', '2']}
+
+ITEMS = [
+    # itemid, hostid, name, value_type, lastclock, lastvalue
+    ('1', '10084', 'Zabbix queue', '3', '1637000000', '12'),
+    ('2', '10084', 'Zabbix value cache hits', '0', '1637000000', '4.5'),
+    ('3', '10084', 'Memory utilization', '0', '0', '0'),
+    ('4', '10085', 'Memory utilization', '0', '1637000000', '20.5'),
+    ('5', '10085', 'Number of CPUs', '3', '0', '0'),
+    ('6', '10085', 'Not a mapped item', '3', '1637000000', '1'),
+]
+
+# Latest value in the history of items without a last value
+HISTORY = {'3': '42.5', '5': '8'}
+
+
+def mock_api(api):
+    """Sends the requests made through the persistent HTTP session to `api`"""
+
+    def post(session, url, data=None, **kwargs):
+        payload = json.loads(data.decode())
+        method = payload[0]['method'] if isinstance(payload, list) else payload['method']
+        api.http_sessions.setdefault(method, set()).add(session)
+        api.timeouts.append(kwargs.get('timeout'))
+        response = mock.MagicMock()
+        response.json.return_value = api(url, data.decode())
+        return response
+
+    return mock.patch('requests.Session.post', autospec=True, side_effect=post)
+
+
+class FakeZabbixApi(object):
+    """Answers JSON-RPC requests from HOSTS, ITEMS and HISTORY"""
+
+    def __init__(self, batch=True):
+        self.batch = batch
+        self.requests = []
+        self.sessions = 0
+        self.tokens = {'api-token'}
+        self.items = list(ITEMS)
+        self.item_filters = []
+        # HTTP sessions by method, and timeout of every request
+        self.http_sessions = {}
+        self.timeouts = []
+        # Hosts whose items are slow to get, or fail to be fetched
+        self.slow_hosts = set()
+        self.failing_hosts = set()
+
+    def __call__(self, zabbix_api, req_data):
+        payload = json.loads(req_data)
+        if isinstance(payload, list):
+            self.requests.append([request['method'] for request in payload])
+            if not self.batch:
+                return {'jsonrpc': '2.0', 'error': {'code': -32600, 'message': 'Invalid request.'}, 'id': None}
+            return [self.handle(request) for request in payload]
+
+        self.requests.append(payload['method'])
+        return self.handle(payload)
+
+    def handle(self, request):
+        if request['method'] != 'user.login' and request.get('auth') not in self.tokens:
+            error = {'code': -32602, 'message': 'Invalid params.', 'data': 'Session terminated, re-login, please.'}
+            return {'jsonrpc': '2.0', 'error': error, 'id': request['id']}
+        result = getattr(self, request['method'].replace('.', '_'))(request['params'])
+        return {'jsonrpc': '2.0', 'result': result, 'id': request['id']}
+
+    def expire_sessions(self):
+        self.tokens = {'api-token'}
+
+    def user_login(self, params):
+        self.sessions += 1
+        token = 'token{}'.format(self.sessions)
+        self.tokens.add(token)
+        return token
+
+    def user_logout(self, params):
+        return True
+
+    def host_get(self, params):
+        names = params.get('filter', {}).get('host')
+        result = []
+        for hostid, host in HOSTS.items():
+            if names is not None and host not in names:
+                continue
+            result.append({'hostid': hostid, 'host': host})
+            if 'proxy_hostid' in params['output']:
+                result[-1]['proxy_hostid'] = HOST_PROXIES[hostid]
+            if 'selectGroups' in params:
+                result[-1]['groups'] = [{'groupid': groupid} for groupid in HOST_GROUPS[hostid]]
+        return result
+
+    def item_get(self, params):
+        names = params.get('filter', {}).get('name')
+        self.item_filters.append(names)
+        if self.failing_hosts.intersection(params['hostids']):
+            raise Exception('Connection reset')
+        if self.slow_hosts.intersection(params['hostids']):
+            time.sleep(0.5)
+        result = []
+        for itemid, hostid, name, value_type, lastclock, lastvalue in self.items:
+            if hostid not in params['hostids'] or (names is not None and name not in names):
+                continue
+            item = {
+                'itemid': itemid,
+                'hostid': hostid,
+                'name': name,
+                'value_type': value_type,
+                'lastclock': lastclock,
+                'lastvalue': lastvalue,
+            }
+            result.append({key: value for key, value in item.items() if key in params['output']})
+        return result
+
+    def history_get(self, params):
+        itemids = params['itemids']
+        if not isinstance(itemids, list):
+            itemids = [itemids]
+        values = [{'itemid': itemid, 'value': HISTORY[itemid]} for itemid in itemids if itemid in HISTORY]
+        for itemid in itemids:
+            lastvalue = next(item[5] for item in self.items if item[0] == itemid)
+            values.append({'itemid': itemid, 'value': lastvalue})
+        return values[: params.get('limit')]
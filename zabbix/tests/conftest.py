@@ -49,3 +49,8 @@ def instance_missing_pass():
 def instance_missing_url():
     instance = {"zabbix_user": "zabbix", "zabbix_password": "zabbix"}
     return instance
+
+
+@pytest.fixture
+def instance():
+    return {'zabbix_user': 'Admin', 'zabbix_password': 'zabbix', 'zabbix_api': 'http://localhost/api_jsonrpc.php'}
@@ -1,20 +1,26 @@
+import time
+
+import mock
 import pytest
 
 from datadog_checks.base import ConfigurationError
 from datadog_checks.zabbix import ZabbixCheck
+from datadog_checks.zabbix.metrics import METRICS
+
+from .common import FakeZabbixApi, mock_api
 
 
 def test_empty_instance(aggregator, instance_empty):
     check = ZabbixCheck('zabbix', {}, [instance_empty])
 
-    with pytest.raises(ConfigurationError):
+    with pytest.raises(ConfigurationError, match='zabbix_api_token or zabbix_user'):
         check.check(instance_empty)
 
 
 def test_missing_pass(aggregator, instance_missing_pass):
     check = ZabbixCheck('zabbix', {}, [instance_missing_pass])
 
-    with pytest.raises(ConfigurationError):
+    with pytest.raises(ConfigurationError, match='zabbix_password'):
         check.check(instance_missing_pass)
 
 
@@ -23,3 +29,229 @@ def test_missing_url(aggregator, instance_missing_url):
 
     with pytest.raises(ConfigurationError):
         check.check(instance_missing_url)
+
+
+def assert_item_metrics(aggregator):
+    aggregator.assert_metric('zabbix.queue.size', value=12, hostname='Zabbix_server', count=1)
+    aggregator.assert_metric('zabbix.cache.value.hits', value=4.5, hostname='Zabbix_server', count=1)
+    aggregator.assert_metric('zabbix.memory.used', value=42.5, hostname='Zabbix_server', count=1)
+    aggregator.assert_metric('zabbix.memory.used', value=20.5, hostname='web_1', count=1)
+    aggregator.assert_metric('zabbix.cpu.count', value=8, hostname='web_1', count=1)
+    aggregator.assert_all_metrics_covered()
+    aggregator.assert_service_check(ZabbixCheck.SERVICE_CHECK_NAME, status=ZabbixCheck.OK)
+
+
+def test_lastvalue(aggregator, instance):
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+
+    assert_item_metrics(aggregator)
+    # Only the items without a last value are read from the history, one request per value type
+    assert api.requests == ['user.login', 'host.get', 'item.get', 'item.get', 'history.get', 'history.get']
+
+
+def test_history(aggregator, instance):
+    instance['history_mode'] = 'history'
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+
+    assert_item_metrics(aggregator)
+    assert api.requests == ['user.login', 'host.get', 'item.get', 'item.get', 'history.get', 'history.get']
+
+
+def test_jsonrpc_batch(aggregator, instance):
+    instance.update({'history_mode': 'history', 'jsonrpc_batch': True, 'batch_size': 3})
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+
+    assert_item_metrics(aggregator)
+    assert api.requests == [
+        'user.login',
+        'host.get',
+        'item.get',
+        'item.get',
+        ['history.get', 'history.get', 'history.get'],
+        ['history.get', 'history.get'],
+    ]
+
+
+def test_jsonrpc_batch_unsupported(aggregator, instance):
+    instance['jsonrpc_batch'] = True
+    check = ZabbixCheck('zabbix', {}, [instance])
+    with mock_api(FakeZabbixApi(batch=False)):
+        with pytest.raises(Exception, match='JSON-RPC batch requests are not supported'):
+            check.check(instance)
+
+
+def test_invalid_history_mode(aggregator, instance):
+    instance['history_mode'] = 'foo'
+    check = ZabbixCheck('zabbix', {}, [instance])
+
+    with pytest.raises(ConfigurationError):
+        check.check(instance)
+
+
+def test_session_reused_across_runs(aggregator, instance):
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+        check.check(instance)
+
+    assert api.requests.count('user.login') == 1
+    assert 'user.logout' not in api.requests
+
+    with mock_api(api):
+        check.cancel()
+    assert api.requests[-1] == 'user.logout'
+
+
+def test_session_expired(aggregator, instance):
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+        api.expire_sessions()
+        aggregator.reset()
+        check.check(instance)
+
+    assert api.sessions == 2
+    assert_item_metrics(aggregator)
+
+
+def test_api_token(aggregator):
+    instance = {'zabbix_api_token': 'api-token', 'zabbix_api': 'http://localhost/api_jsonrpc.php'}
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+        check.cancel()
+
+    assert_item_metrics(aggregator)
+    assert 'user.login' not in api.requests
+    assert 'user.logout' not in api.requests
+
+
+def test_inventory_cached(aggregator, instance):
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock.patch('datadog_checks.zabbix.check.time.time', return_value=1000):
+        with mock_api(api):
+            check.check(instance)
+            aggregator.reset()
+            del api.requests[:]
+            check.check(instance)
+
+    assert_item_metrics(aggregator)
+    assert api.requests == ['item.get', 'history.get', 'history.get']
+    # Unmapped items are filtered out by the server
+    assert api.item_filters == [list(METRICS)] * 3
+
+
+def test_inventory_refreshed_on_change(aggregator, instance):
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+        api.items.append(('7', '10085', 'Zabbix queue', '3', '1637000000', '3'))
+        aggregator.reset()
+        del api.requests[:]
+        check.check(instance)
+
+    assert api.requests == ['item.get', 'host.get', 'item.get', 'item.get', 'history.get', 'history.get']
+    aggregator.assert_metric('zabbix.queue.size', value=3, hostname='web_1', count=1)
+
+
+def test_inventory_ttl(aggregator, instance):
+    instance['inventory_ttl'] = 60
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        with mock.patch('datadog_checks.zabbix.check.time.time', return_value=1000):
+            check.check(instance)
+        del api.requests[:]
+        with mock.patch('datadog_checks.zabbix.check.time.time', return_value=1060):
+            check.check(instance)
+
+    assert api.requests == ['host.get', 'item.get', 'item.get', 'history.get', 'history.get']
+
+
+def test_metrics_filter(aggregator, instance):
+    instance['metrics'] = ['Zabbix queue', 'Not a mapped item']
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+
+    assert api.item_filters == [['Zabbix queue']] * 2
+    aggregator.assert_metric('zabbix.queue.size', count=1)
+    aggregator.assert_all_metrics_covered()
+
+
+@pytest.mark.parametrize('shard_by', ['proxy', 'hostgroup'])
+def test_shards(aggregator, instance, shard_by):
+    instance['shard_by'] = shard_by
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.check(instance)
+
+    assert_item_metrics(aggregator)
+    # The values of each shard are fetched separately
+    assert api.requests.count('item.get') == 3
+    # Each with its own HTTP session, besides the one used for the inventory
+    assert len(api.http_sessions['item.get']) == 3
+    assert len(api.http_sessions['history.get'] - api.http_sessions['host.get']) == 2
+
+
+def test_slow_shard(aggregator, instance):
+    instance.update({'shard_by': 'proxy', 'shard_timeout': 0.1})
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.get_inventory('api-token', instance['zabbix_api'], instance, list(METRICS))
+        api.slow_hosts.add('10085')
+        start = time.time()
+        check.check(instance)
+        elapsed = time.time() - start
+
+    # The run doesn't wait for the items of the slow shard, its values are missing
+    assert elapsed < 0.4
+    aggregator.assert_metric('zabbix.queue.size', hostname='Zabbix_server', count=1)
+    aggregator.assert_metric('zabbix.cache.value.hits', hostname='Zabbix_server', count=1)
+    aggregator.assert_metric('zabbix.memory.used', value=42.5, hostname='Zabbix_server', count=1)
+    aggregator.assert_all_metrics_covered()
+    # Requests of the shards don't wait on the server past their deadline, unlike those of the inventory and login
+    assert [timeout for timeout in api.timeouts if max(timeout) > 0.1] == [(10.0, 10.0)] * 3
+    assert len(api.timeouts) > 3
+    assert 'Shard 10100 took more than 0.1 seconds, reporting partial results' in check.warnings
+
+
+def test_failing_shard(aggregator, instance):
+    instance['shard_by'] = 'proxy'
+    check = ZabbixCheck('zabbix', {}, [instance])
+    api = FakeZabbixApi()
+    with mock_api(api):
+        check.get_inventory('api-token', instance['zabbix_api'], instance, list(METRICS))
+        api.failing_hosts.add('10085')
+        check.check(instance)
+
+    aggregator.assert_metric('zabbix.queue.size', hostname='Zabbix_server', count=1)
+    aggregator.assert_metric('zabbix.cache.value.hits', hostname='Zabbix_server', count=1)
+    aggregator.assert_metric('zabbix.memory.used', hostname='Zabbix_server', count=1)
+    aggregator.assert_all_metrics_covered()
+    assert 'Unable to collect shard 10100: Connection reset' in check.warnings
+
+
+def test_invalid_shard_by(aggregator, instance):
+    instance['shard_by'] = 'foo'
+    check = ZabbixCheck('zabbix', {}, [instance])
+
+    with pytest.raises(ConfigurationError):
+        check.check(instance)